@@ -0,0 +1,230 @@
+"""
+Add one new dataset to an existing OTU table, without re-running the
+merge, clustering and reprovenancing of every dataset.
+
+This
+1. dereplicates the dataset's raw_trimmed fasta into the dereplication
+   directory, like dereplicate_individual_datasets.py -d
+1. assigns its unique sequences, largest first, to the most similar
+   existing OTU centroid in the otu_seqs fasta, at the clustering identity
+   (see cluster_otus.py). Sequences that don't match any become new OTUs,
+   labeled seqID--dataset-id like the relabeled sequences in the master
+   map, and later sequences can join those too.
+1. appends the new OTUs' centroids to the otu_seqs fasta
+1. sums the dataset's sample counts per OTU and appends them to the OTU
+   table store (see table_store.py) as new samples, with new columns for
+   the new OTUs
+
+so the work depends on the size of the new dataset, not of the whole
+collection (apart from reading the centroids). Each sequence's assignment
+is written to derep_dir/dataset.otu_assignments.tab, in the same otu/match
+format as the clustering results.
+
+The steps run in that order so the store never has OTUs that aren't in
+the fasta. If adding the samples fails, re-running assigns the sequences
+to the new OTUs' centroids and adds their columns then.
+
+Results can differ slightly from a full re-run: there, the new dataset's
+sequences would also change the sizes (and so the order) of every
+sequence in the clustering. Once several datasets have been added, re-run
+pipeline.py -d -c to re-cluster everything together.
+"""
+import os
+import sys
+import shutil
+import argparse
+
+import numpy as np
+
+import derep_maps
+import job_runner
+import instrument
+from cluster_otus import cluster
+from fasta_io import iter_fasta, open_fasta
+from fasta_index import record_id
+from otu_table import SparseTableBuilder
+from table_store import TableStore, append_rows
+from dereplicate_individual_datasets import dataset_label, derep_command, derep_outputs
+
+DEREP_DIR = 'data/derep_datasets'
+
+
+def read_sized_fasta(fname):
+    """
+    Read a raw_dereplicated fasta, largest sequences first.
+
+    Returns
+    -------
+    records : list
+        (header without '>', sequence) tuples
+    """
+    records = []
+    sizes = []
+    for sid, seq in iter_fasta(fname):
+        size = [f for f in sid.split(';') if f.startswith('size=')]
+        sizes.append(int(size[0][len('size='):]) if size else 1)
+        records.append((sid[1:], seq.upper()))
+    order = np.argsort(-np.array(sizes, dtype=np.int64), kind='stable')
+    return [records[i] for i in order]
+
+
+def assign_sequences(records, centroids, label, identity=0.97, k=8, processes=1,
+                     batch_size=2000, table_out=None):
+    """
+    Assign sequences to existing OTU centroids, or to new OTUs.
+
+    Parameters
+    ----------
+    records : list
+        (header, sequence) of the dataset's unique sequences, largest first
+    centroids : list
+        (OTU ID, sequence) of the existing OTUs
+    label : str
+        dataset ID for labeling new OTUs (seqID--label)
+    table_out : str
+        if given, write each sequence's otu/match line to this file
+
+    Returns
+    -------
+    seq_to_otu : dict
+        {seqID: OTU ID}
+    new_otus : list
+        (header, sequence) of the new OTUs' centroids, headers relabeled
+    """
+    nexisting = len(centroids)
+    seq_to_otu = {}
+    new_otus = []
+    lines = []
+    for seqnum, centroid, ident in cluster([seq for _, seq in records], identity, k, processes,
+                                           batch_size, [seq for _, seq in centroids]):
+        header, seq = records[seqnum]
+        seqid = record_id(header)
+        if centroid == seqnum:
+            otu = seqid + '--' + label
+            new_otus.append((otu + header[len(seqid):], seq))
+            lines.append(header + '\totu\t*\t*\t*\n')
+        else:
+            if centroid < 0:
+                otu = centroids[centroid + nexisting][0]
+            else:
+                otu = seq_to_otu[record_id(records[centroid][0])]
+            lines.append('{}\tmatch\t{:.1f}\t*\t{}\n'.format(header, 100 * ident, otu))
+        seq_to_otu[seqid] = otu
+    if table_out is not None:
+        with open(table_out, 'w') as f:
+            f.writelines(lines)
+    return seq_to_otu, new_otus
+
+
+def dataset_table(map_file, dataset, seq_to_otu):
+    """
+    Sum a dataset's sample counts per OTU. Samples are labeled
+    dataset--sample, as in the combined table.
+
+    Returns
+    -------
+    table, sample_ids, otu_ids
+        as SparseTableBuilder.tocsr
+    """
+    symbols = derep_maps.SymbolTable()
+    derep = derep_maps.parse_one_map_file(map_file, symbols)
+    otu_codes = {seqid: symbols.intern(otu) for seqid, otu in seq_to_otu.items()}
+    # Sequences that aren't in the fasta (or map) are dropped, as in reprovenancing
+    lookup = np.full(len(symbols), -1, dtype=derep_maps.CODE_DTYPE)
+    for code in np.unique(derep.seqs).tolist():
+        lookup[code] = otu_codes.get(symbols[code], -1)
+    otus, samples, counts = derep_maps.collapse_derep_map(derep, lookup)
+    collapsed = derep_maps.compact_samples(dataset, otus, samples, counts, symbols)
+    builder = SparseTableBuilder()
+    derep_maps.add_to_table(builder, collapsed, symbols)
+    return builder.tocsr()
+
+
+def append_centroids(otu_seqs, new_otus):
+    """
+    Append new OTUs' centroids to the otu_seqs fasta. A copy with them
+    added is renamed into place, so otu_seqs is never left half written.
+    """
+    out_dir, f = os.path.split(otu_seqs)
+    tmp = os.path.join(out_dir, '.tmp.' + f)
+    shutil.copyfile(otu_seqs, tmp)
+    try:
+        with open_fasta(tmp, 'a') as fout:
+            for header, seq in new_otus:
+                fout.write('>' + header + '\n' + seq + '\n')
+        os.rename(tmp, otu_seqs)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def read_centroids(otu_seqs):
+    """(OTU ID, sequence) for each centroid in an otu_seqs fasta."""
+    return [(record_id(sid[1:]), seq.upper()) for sid, seq in iter_fasta(otu_seqs)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('trimmed_fasta', help='the new dataset\'s raw_trimmed fasta (dataset.raw_trimmed.fasta)')
+    parser.add_argument('otu_seqs', help='OTU centroids fasta from clustering (new OTUs are appended to it)')
+    parser.add_argument('store', help='OTU table store to add the dataset\'s samples to (see table_store.py)')
+    parser.add_argument('--derep_dir', help='directory for the dereplicated dataset '
+                        + '(default: {})'.format(DEREP_DIR), default=DEREP_DIR)
+    parser.add_argument('-s', '--skip_derep', help='use the dataset\'s existing dereplicated files',
+                        action='store_true', default=False)
+    parser.add_argument('-e', help='dereplicate with ~/scripts/3.dereplicate.py instead of derep_engine.py',
+                        action='store_true', default=False)
+    parser.add_argument('--id', help='minimum identity to join an OTU [default: %(default)s]',
+                        type=float, default=0.97)
+    parser.add_argument('-k', help='k-mer length for the candidate prefilter [default: %(default)s]',
+                        type=int, default=8)
+    parser.add_argument('-p', '--processes', help='number of processes [default: %(default)s]',
+                        type=int, default=1)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure_from_args(args)
+
+    in_dir, f = os.path.split(args.trimmed_fasta)
+    if not f.endswith('.raw_trimmed.fasta'):
+        sys.exit('{} should be named dataset.raw_trimmed.fasta'.format(args.trimmed_fasta))
+    map_file, derep_fasta, _ = derep_outputs(args.derep_dir, f)
+    dataset = os.path.basename(map_file).split('.')[0]
+
+    # Fail before doing any work if the dataset is already there
+    store = TableStore(args.store)
+    if store.sample_rows([dataset + '--']):
+        sys.exit('{} already has samples from {}'.format(args.store, dataset))
+
+    if not args.skip_derep:
+        print('Dereplicating {}'.format(dataset))
+        try:
+            with instrument.stage('dereplicate', inputs=[args.trimmed_fasta]):
+                job_runner.run_jobs([(dataset, derep_command(in_dir, args.derep_dir, f, args.e))], max_procs=1)
+        except job_runner.JobFailed as e:
+            sys.exit('Dereplication failed: {}'.format(e))
+
+    print('Assigning sequences to OTUs')
+    with instrument.stage('read_centroids', inputs=[args.otu_seqs]) as s:
+        centroids = read_centroids(args.otu_seqs)
+        s.records = len(centroids)
+    assignments = os.path.join(args.derep_dir, dataset + '.otu_assignments.tab')
+    with instrument.stage('assign_sequences', inputs=[derep_fasta], outputs=[assignments]) as s:
+        records = read_sized_fasta(derep_fasta)
+        seq_to_otu, new_otus = assign_sequences(records, centroids, dataset_label(derep_fasta),
+                                                args.id, args.k, args.processes, table_out=assignments)
+        s.records = len(records)
+    print('{} sequences: {} in existing OTUs, {} new OTUs'.format(
+        len(records), len(records) - len(new_otus), len(new_otus)))
+
+    with instrument.stage('dataset_table', inputs=[map_file]) as s:
+        table, sample_ids, otu_ids = dataset_table(map_file, dataset, seq_to_otu)
+        s.records = table.nnz
+
+    # Centroids first: if adding the samples then fails, a re-run finds the
+    # new OTUs among the centroids and gives them their store columns
+    if new_otus:
+        with instrument.stage('append_centroids', outputs=[args.otu_seqs], records=len(new_otus)):
+            append_centroids(args.otu_seqs, new_otus)
+    print('Adding {} samples to {}'.format(len(sample_ids), args.store))
+    with instrument.stage('append_rows', outputs=[args.store], records=table.nnz):
+        append_rows(args.store, table, sample_ids, otu_ids)
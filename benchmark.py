@@ -0,0 +1,345 @@
+"""
+Time each processing step on synthetic data (see synthetic_data.py) at
+several scales, and write the results as a JSON report.
+
+The scripts (relabel_raw_trimmed.py, update_concated_derep_fasta.py,
+manipulate_metadata_files.py) are timed end to end as subprocesses.
+The parsing and collapsing functions in reprovenance_all_files.py and
+derep_maps.py, and collapse_taxonomic_contents_df, are timed in this
+process, after their inputs have been set up.
+
+Each result has the step's wall time (the best of -r repeats), how many
+records it went through (reads, map lines, samples...) and the size of
+its input files. Pass an earlier report with --baseline to compare
+against it: steps that got slower by more than --tolerance are listed,
+and the exit status is 1 if there are any.
+
+Synthetic data is kept in work_dir/scaleN and reused on later runs with
+the same scale and seed.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import synthetic_data
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def path_size(path):
+    """Total size of a file, or of all files under a directory, in bytes."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(path) for f in files)
+
+
+def run_script(script, *args):
+    """Return a function that runs one of these scripts with args."""
+    argv = [sys.executable, os.path.join(SCRIPT_DIR, script)] + list(args)
+
+    def run():
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(argv, stdout=devnull)
+    return run
+
+
+## Benchmarks. Each takes (data_dir, manifest, tmp_dir) and returns
+## (run, records, inputs): a function to time, the number of records it
+## processes, and its input files.
+
+def bench_relabel_raw_trimmed(data_dir, manifest, tmp_dir):
+    trimmed_dir = os.path.join(data_dir, manifest['files']['raw_trimmed_dir'])
+    run = run_script('relabel_raw_trimmed.py', trimmed_dir, '-o', os.path.join(tmp_dir, 'all_raw_trimmed.fasta'))
+    return run, manifest['records']['reads'], [trimmed_dir]
+
+
+def bench_update_concated_derep_fasta(data_dir, manifest, tmp_dir):
+    files = [os.path.join(data_dir, manifest['files'][f]) for f in ('master_map', 'master_fasta')]
+    run = run_script('update_concated_derep_fasta.py', files[0], files[1], os.path.join(tmp_dir, 'sorted.fasta'))
+    return run, manifest['records']['master_map_lines'], files
+
+
+def bench_cluster_otus(data_dir, manifest, tmp_dir):
+    """Cluster the merged fasta (in its file order, rather than by size)."""
+    fasta = os.path.join(data_dir, manifest['files']['master_fasta'])
+    run = run_script('cluster_otus.py', fasta, os.path.join(tmp_dir, 'otu_seqs.fasta'),
+                     os.path.join(tmp_dir, 'clustering_results.tab'))
+    return run, manifest['records']['master_map_lines'], [fasta]
+
+
+def bench_manipulate_metadata_files(data_dir, manifest, tmp_dir):
+    metadata_dir = os.path.join(data_dir, manifest['files']['metadata_dir'])
+    run = run_script('manipulate_metadata_files.py', metadata_dir + '/', tmp_dir + '/', 'all_metadata.txt')
+    return run, manifest['records']['samples'], [metadata_dir]
+
+
+def bench_parse_clustering_results(data_dir, manifest, tmp_dir):
+    import reprovenance_all_files
+    fname = os.path.join(data_dir, manifest['files']['clustering_results'])
+    return (lambda: reprovenance_all_files.parse_clustering_results(fname),
+            manifest['records']['master_map_lines'], [fname])
+
+
+def bench_parse_master_derep_map(data_dir, manifest, tmp_dir):
+    import reprovenance_all_files
+    fname = os.path.join(data_dir, manifest['files']['master_map'])
+    return (lambda: reprovenance_all_files.parse_master_derep_map(fname),
+            manifest['records']['master_map_lines'], [fname])
+
+
+def bench_update_derep_dict(data_dir, manifest, tmp_dir):
+    import reprovenance_all_files as rp
+    files = [os.path.join(data_dir, manifest['files'][f]) for f in ('clustering_results', 'master_map')]
+    otudict = rp.parse_clustering_results(files[0])
+    derepdict = rp.parse_master_derep_map(files[1])
+    return lambda: rp.update_derep_dict(otudict, derepdict), manifest['records']['master_map_lines'], files
+
+
+def bench_read_dataset_derep_maps(data_dir, manifest, tmp_dir):
+    import reprovenance_all_files
+    derep_dir = os.path.join(data_dir, manifest['files']['derep_dir'])
+    maps = [os.path.join(derep_dir, f) for f in os.listdir(derep_dir) if f.endswith('.map')]
+    return (lambda: reprovenance_all_files.read_dataset_derep_maps(derep_dir),
+            manifest['records']['dataset_map_lines'], maps)
+
+
+def bench_collapse_derep_map(data_dir, manifest, tmp_dir):
+    """Collapse every OTU in every dataset, as the original __main__ did."""
+    import reprovenance_all_files as rp
+    files = [os.path.join(data_dir, manifest['files'][f]) for f in ('clustering_results', 'master_map')]
+    derepOTUdict = rp.update_derep_dict(rp.parse_clustering_results(files[0]),
+                                        rp.parse_master_derep_map(files[1]))
+    dataset_maps = rp.read_dataset_derep_maps(os.path.join(data_dir, manifest['files']['derep_dir']))
+
+    def run():
+        finaldict = {}
+        for otu in derepOTUdict:
+            finaldict[otu] = {}
+            for dataset in derepOTUdict[otu]:
+                finaldict[otu].update(rp.collapse_derep_map(dataset, derepOTUdict[otu][dataset],
+                                                            dataset_maps[dataset]))
+        return finaldict
+    return run, manifest['records']['dataset_map_lines'], []
+
+
+def bench_derep_maps_parse_clustering_results(data_dir, manifest, tmp_dir):
+    import derep_maps
+    fname = os.path.join(data_dir, manifest['files']['clustering_results'])
+    return (lambda: derep_maps.parse_clustering_results(fname, derep_maps.SymbolTable()),
+            manifest['records']['master_map_lines'], [fname])
+
+
+def bench_derep_maps_parse_master_derep_map(data_dir, manifest, tmp_dir):
+    import derep_maps
+    fname = os.path.join(data_dir, manifest['files']['master_map'])
+    return (lambda: derep_maps.parse_master_derep_map(fname, derep_maps.SymbolTable()),
+            manifest['records']['master_map_lines'], [fname])
+
+
+def bench_derep_maps_collapse_dataset_maps(data_dir, manifest, tmp_dir):
+    """Read, collapse and tabulate all dataset maps, as reprovenance_all_files.py does now."""
+    import derep_maps
+    from otu_table import SparseTableBuilder
+    derep_dir = os.path.join(data_dir, manifest['files']['derep_dir'])
+    files = [os.path.join(data_dir, manifest['files'][f]) for f in ('clustering_results', 'master_map')]
+
+    def run():
+        symbols = derep_maps.SymbolTable()
+        clusters = derep_maps.parse_clustering_results(files[0], symbols)
+        master = derep_maps.parse_master_derep_map(files[1], symbols)
+        builder = SparseTableBuilder()
+        for collapsed in derep_maps.collapse_dataset_maps(derep_dir, clusters, master, symbols):
+            derep_maps.add_to_table(builder, collapsed, symbols)
+        return builder.tocsr()
+    return run, manifest['records']['dataset_map_lines'], [derep_dir] + files
+
+
+def bench_collapse_taxonomic_contents_df(data_dir, manifest, tmp_dir):
+    """Collapse all datasets' relative abundance OTU tables to genus level."""
+    import feather
+    import make_bigdata
+    clean_dir = os.path.join(data_dir, manifest['files']['clean_dir'])
+    dfs = []
+    for dataset in manifest['datasets']:
+        df = feather.read_dataframe(os.path.join(clean_dir, dataset + '.otu_table.clean.feather'))
+        df.index = df.iloc[:, 0]
+        df = df.iloc[:, 1:]
+        dfs.append(df.divide(df.sum(axis=1), axis=0))
+    return (lambda: [make_bigdata.collapse_taxonomic_contents_df(df, 'genus') for df in dfs],
+            manifest['records']['samples'], [clean_dir])
+
+
+def bench_rarefy(data_dir, manifest, tmp_dir):
+    """Rarefy all datasets' OTU tables to half the reads per sample, 10 times."""
+    import feather
+    import normalize
+    clean_dir = os.path.join(data_dir, manifest['files']['clean_dir'])
+    tables = []
+    for dataset in manifest['datasets']:
+        df = feather.read_dataframe(os.path.join(clean_dir, dataset + '.otu_table.clean.feather'))
+        tables.append(df.iloc[:, 1:].values)
+    depth = int(manifest['params']['reads']) // 2
+    return (lambda: [normalize.rarefy(t, depth, 10, normalize.dataset_rng(0, 'bench')) for t in tables],
+            manifest['records']['samples'], [clean_dir])
+
+
+BENCHMARKS = [
+    ('relabel_raw_trimmed.py', bench_relabel_raw_trimmed),
+    ('update_concated_derep_fasta.py', bench_update_concated_derep_fasta),
+    ('cluster_otus.py', bench_cluster_otus),
+    ('manipulate_metadata_files.py', bench_manipulate_metadata_files),
+    ('reprovenance_all_files.parse_clustering_results', bench_parse_clustering_results),
+    ('reprovenance_all_files.parse_master_derep_map', bench_parse_master_derep_map),
+    ('reprovenance_all_files.update_derep_dict', bench_update_derep_dict),
+    ('reprovenance_all_files.read_dataset_derep_maps', bench_read_dataset_derep_maps),
+    ('reprovenance_all_files.collapse_derep_map', bench_collapse_derep_map),
+    ('derep_maps.parse_clustering_results', bench_derep_maps_parse_clustering_results),
+    ('derep_maps.parse_master_derep_map', bench_derep_maps_parse_master_derep_map),
+    ('derep_maps.collapse_dataset_maps', bench_derep_maps_collapse_dataset_maps),
+    ('make_bigdata.collapse_taxonomic_contents_df', bench_collapse_taxonomic_contents_df),
+    ('normalize.rarefy', bench_rarefy),
+]
+
+
+def prepare_data(work_dir, scale, seed=0, regenerate=False):
+    """
+    Return (data_dir, manifest) for synthetic data at this scale,
+    generating it unless it's already there.
+    """
+    data_dir = os.path.join(work_dir, 'scale{}'.format(scale))
+    manifest_file = os.path.join(data_dir, 'manifest.json')
+    if not regenerate and os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+        if manifest['seed'] == seed and manifest['params'] == synthetic_data.DEFAULTS:
+            return data_dir, manifest
+    if os.path.isdir(data_dir):
+        shutil.rmtree(data_dir)
+    print('Generating synthetic data at scale {}'.format(scale))
+    return data_dir, synthetic_data.generate(data_dir, scale, seed)
+
+
+def time_benchmark(bench, data_dir, manifest, repeat=1):
+    """
+    Run one benchmark repeat times in a fresh temporary directory.
+
+    Returns
+    -------
+    result : dict
+        seconds (best time), times (all of them), records,
+        records_per_second and input_bytes, or error if it failed
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='bench.')
+    try:
+        run, records, inputs = bench(data_dir, manifest, tmp_dir)
+        times = []
+        for _ in range(repeat):
+            start = time.time()
+            run()
+            times.append(time.time() - start)
+    except Exception as e:
+        return {'error': '{}: {}'.format(type(e).__name__, e)}
+    finally:
+        shutil.rmtree(tmp_dir)
+    seconds = min(times)
+    return {'seconds': seconds, 'times': times, 'records': records,
+            'records_per_second': records / seconds if seconds > 0 else None,
+            'input_bytes': sum(path_size(f) for f in inputs)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=SCRIPT_DIR,
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(work_dir, scales, names=None, repeat=1, seed=0, regenerate=False):
+    """
+    Run the benchmarks (all of them, or those in names) at each scale.
+
+    Returns
+    -------
+    report : dict
+        environment info, and a list of results with benchmark and scale
+    """
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'repeat': repeat, 'seed': seed, 'results': []}
+    for scale in scales:
+        data_dir, manifest = prepare_data(work_dir, scale, seed, regenerate)
+        for name, bench in BENCHMARKS:
+            if names and name not in names:
+                continue
+            result = time_benchmark(bench, data_dir, manifest, repeat)
+            result.update({'benchmark': name, 'scale': scale})
+            report['results'].append(result)
+            if 'error' in result:
+                print('{:<50} {:>5}x  failed: {}'.format(name, scale, result['error']))
+            else:
+                print('{:<50} {:>5}x  {:>9.3f} s  {:>12.0f} records/s'.format(
+                    name, scale, result['seconds'], result['records_per_second'] or 0))
+    return report
+
+
+def compare(report, baseline, tolerance=0.2):
+    """
+    Return a list of (benchmark, scale, old seconds, new seconds) for
+    results more than tolerance (as a fraction) slower than in baseline.
+    """
+    old = {(r['benchmark'], r['scale']): r['seconds'] for r in baseline['results'] if 'seconds' in r}
+    slower = []
+    for r in report['results']:
+        key = (r['benchmark'], r['scale'])
+        if key in old and 'seconds' in r and r['seconds'] > old[key] * (1 + tolerance):
+            slower.append((r['benchmark'], r['scale'], old[key], r['seconds']))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('work_dir', help='directory to keep the synthetic data in')
+    parser.add_argument('-o', help='file to write the JSON report to (default: work_dir/report.json)', default=None)
+    parser.add_argument('-s', help='scales to run at (default: 1 10 100)', type=int, nargs='+',
+                        default=[1, 10, 100])
+    parser.add_argument('-b', help='only run these benchmarks (default: all)', nargs='+', default=None)
+    parser.add_argument('-r', help='number of times to run each benchmark (default: 1)', type=int, default=1)
+    parser.add_argument('--seed', help='random seed for the synthetic data (default: 0)', type=int, default=0)
+    parser.add_argument('--regenerate', help='regenerate the synthetic data even if it exists',
+                        action='store_true', default=False)
+    parser.add_argument('--baseline', help='earlier report to compare against', default=None)
+    parser.add_argument('--tolerance', help='fraction slower than baseline to report as a regression '
+                        + '(default: 0.2)', type=float, default=0.2)
+    parser.add_argument('--list', help='list the benchmarks and exit', action='store_true', default=False)
+    args = parser.parse_args()
+
+    if args.list:
+        for name, _ in BENCHMARKS:
+            print(name)
+        sys.exit(0)
+
+    unknown = set(args.b or []) - set(name for name, _ in BENCHMARKS)
+    if unknown:
+        sys.exit('Unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+
+    report = run_benchmarks(args.work_dir, args.s, args.b, args.r, args.seed, args.regenerate)
+    out = args.o or os.path.join(args.work_dir, 'report.json')
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print('Wrote {}'.format(out))
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            slower = compare(report, json.load(f), args.tolerance)
+        for name, scale, old, new in slower:
+            print('SLOWER: {} at {}x: {:.3f} s -> {:.3f} s'.format(name, scale, old, new))
+        if slower:
+            sys.exit(1)
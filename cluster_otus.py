@@ -0,0 +1,345 @@
+"""
+Greedy OTU clustering of a size-sorted fasta, in place of
+usearch8 -cluster_otus.
+
+Sequences are taken in file order (update_concated_derep_fasta.py writes
+them largest first). Each one joins the most similar OTU centroid seen so
+far if it's at least --id identical to it, and otherwise becomes a new
+centroid. Identity is 1 - edit distance / length of the longer sequence,
+and ties go to the earlier (larger) centroid.
+
+Candidate centroids are found with a k-mer index: a centroid within the
+allowed number of edits d must share all but at most k*d of the query's
+distinct k-mers, so only centroids that pass that count are aligned, with
+a banded edit distance (band d) that gives up as soon as d is exceeded.
+
+With -p, each batch of queries is searched against the centroids found
+before the batch by worker processes, each with its own copy of the
+index, and the master only checks the few centroids created within the
+batch. The result is the same as a single process run.
+
+Outputs are the OTU centroid fasta and the usearch -uparseout style table
+that reprovenance_all_files.py reads:
+
+    seqID;size=N;    otu      *      *    *
+    seqID;size=N;    match    98.7   *    centroid_seqID
+
+This is OTU picking only: there is no chimera filtering.
+"""
+import math
+import argparse
+import multiprocessing
+from array import array
+
+import numpy as np
+
+import instrument
+from fasta_io import iter_fasta, open_fasta
+from fasta_index import record_id
+
+
+def banded_edit_distance(a, b, max_edits):
+    """
+    Edit distance between a and b, or None if it's more than max_edits.
+    Only cells within max_edits of the diagonal are filled in.
+    """
+    la, lb = len(a), len(b)
+    if abs(la - lb) > max_edits:
+        return None
+    if a == b:
+        return 0
+    too_many = max_edits + 1
+    prev = [j if j <= max_edits else too_many for j in range(lb + 1)]
+    for i in range(1, la + 1):
+        lo = max(1, i - max_edits)
+        hi = min(lb, i + max_edits)
+        cur = [too_many] * (lb + 1)
+        cur[0] = i if i <= max_edits else too_many
+        ai = a[i - 1]
+        best = cur[0] if lo == 1 else too_many
+        for j in range(lo, hi + 1):
+            d = prev[j - 1] + (ai != b[j - 1])
+            if prev[j] + 1 < d:
+                d = prev[j] + 1
+            if cur[j - 1] + 1 < d:
+                d = cur[j - 1] + 1
+            cur[j] = d
+            if d < best:
+                best = d
+        if best > max_edits:
+            return None
+        prev = cur
+    return prev[lb] if prev[lb] <= max_edits else None
+
+
+def max_edits(identity, length):
+    """Most edits a pair whose longer sequence has this length can have at identity."""
+    # Small tolerance so that e.g. 0.97 * 100 isn't rounded down to 2 edits
+    return int(math.floor((1 - identity) * length + 1e-9))
+
+
+class CentroidIndex(object):
+    """
+    OTU centroids with a k-mer index for finding the best one for a query.
+
+    Parameters
+    ----------
+    identity : float
+        minimum identity to join a centroid
+    k : int
+        k-mer length
+    """
+
+    def __init__(self, identity=0.97, k=8):
+        self.identity = identity
+        self.k = k
+        self.seqs = []
+        self.ids = []
+        self._postings = {}
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def kmers(self, seq):
+        k = self.k
+        return set([seq[i:i + k] for i in range(len(seq) - k + 1)])
+
+    def add(self, seq, seqnum):
+        """Add seq (input sequence number seqnum) as a centroid."""
+        n = len(self.seqs)
+        self.seqs.append(seq)
+        self.ids.append(seqnum)
+        for kmer in self.kmers(seq):
+            try:
+                self._postings[kmer].append(n)
+            except KeyError:
+                self._postings[kmer] = array('i', [n])
+
+    def candidates(self, seq):
+        """Centroids that share enough k-mers with seq to be within reach of identity."""
+        qkmers = self.kmers(seq)
+        # The longest centroid seq could match is len(seq) / identity
+        need = len(qkmers) - self.k * max_edits(self.identity, len(seq) / self.identity)
+        if need <= 0:
+            return range(len(self.seqs))
+        postings = [np.frombuffer(self._postings[kmer], dtype=np.int32)
+                    for kmer in qkmers if kmer in self._postings]
+        if not postings:
+            return []
+        counts = np.bincount(np.concatenate(postings), minlength=len(self.seqs))
+        hits = np.flatnonzero(counts >= need)
+        # Most shared k-mers first, so a good match is found early
+        return hits[np.argsort(-counts[hits], kind='stable')].tolist()
+
+    def search(self, seq):
+        """
+        Return (seqnum, identity) of the most similar centroid with at
+        least self.identity, or None. Ties go to the earliest centroid.
+        """
+        best = None
+        best_identity = self.identity
+        for c in self.candidates(seq):
+            centroid = self.seqs[c]
+            length = max(len(seq), len(centroid))
+            edits = banded_edit_distance(seq, centroid, max_edits(best_identity, length))
+            if edits is None:
+                continue
+            ident = 1.0 - float(edits) / length
+            if best is None or ident > best_identity or (ident == best_identity and c < best):
+                best, best_identity = c, ident
+                if edits == 0:
+                    break
+        if best is None:
+            return None
+        return self.ids[best], best_identity
+
+
+def _better(a, b):
+    """The better of two (seqnum, identity) hits (either may be None)."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if b[1] > a[1] or (b[1] == a[1] and b[0] < a[0]):
+        return b
+    return a
+
+
+def _search_worker(identity, k, tasks, results):
+    """
+    Keep a copy of the centroid index, adding ('add', [(seqnum, seq)])
+    centroids and answering ('search', [(seqnum, seq)]) batches until a
+    None task.
+    """
+    index = CentroidIndex(identity, k)
+    try:
+        for kind, items in iter(tasks.get, None):
+            if kind == 'add':
+                for seqnum, seq in items:
+                    index.add(seq, seqnum)
+            else:
+                results.put([(seqnum, index.search(seq)) for seqnum, seq in items])
+    except Exception as e:
+        results.put(Exception('{}: {}'.format(type(e).__name__, e)))
+
+
+def _batches(seqs, batch_size):
+    batch = []
+    for item in enumerate(seqs):
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def cluster(seqs, identity=0.97, k=8, processes=1, batch_size=2000, centroids=()):
+    """
+    Greedily cluster seqs, in order, optionally adding to existing OTUs.
+
+    Parameters
+    ----------
+    seqs : iterable of str
+    identity : float
+        minimum identity to join an OTU
+    k : int
+        k-mer length for the prefilter
+    processes : int
+        number of worker processes searching for centroids
+    batch_size : int
+        queries handed to the workers at a time (with processes > 1)
+    centroids : list of str
+        centroids of existing OTUs, which are numbered -len(centroids)
+        to -1 (so they come before, and win ties with, new ones)
+
+    Yields
+    ------
+    (seqnum, centroid_seqnum, identity) for each sequence, in order.
+    Centroids are their own centroid, with identity 1.
+    """
+    existing = [(i - len(centroids), seq) for i, seq in enumerate(centroids)]
+    if processes <= 1:
+        index = CentroidIndex(identity, k)
+        for seqnum, seq in existing:
+            index.add(seq, seqnum)
+        for seqnum, seq in enumerate(seqs):
+            hit = index.search(seq)
+            if hit is None:
+                index.add(seq, seqnum)
+                hit = (seqnum, 1.0)
+            yield (seqnum,) + hit
+        return
+
+    results = multiprocessing.Queue()
+    task_queues = [multiprocessing.Queue() for _ in range(processes)]
+    workers = [multiprocessing.Process(target=_search_worker, args=(identity, k, q, results))
+               for q in task_queues]
+    for w in workers:
+        w.start()
+
+    try:
+        if existing:
+            for q in task_queues:
+                q.put(('add', existing))
+        for batch in _batches(seqs, batch_size):
+            # Workers search the centroids from before this batch...
+            chunk = -(-len(batch) // processes)
+            nchunks = 0
+            for i, q in enumerate(task_queues):
+                if batch[i * chunk:(i + 1) * chunk]:
+                    q.put(('search', batch[i * chunk:(i + 1) * chunk]))
+                    nchunks += 1
+            before = {}
+            for _ in range(nchunks):
+                found = results.get()
+                if isinstance(found, Exception):
+                    raise found
+                before.update(found)
+
+            # ...and the master checks the ones made during it
+            new = CentroidIndex(identity, k)
+            for seqnum, seq in batch:
+                hit = _better(before[seqnum], new.search(seq))
+                if hit is None:
+                    new.add(seq, seqnum)
+                    hit = (seqnum, 1.0)
+                yield (seqnum,) + hit
+
+            added = list(zip(new.ids, new.seqs))
+            if added:
+                for q in task_queues:
+                    q.put(('add', added))
+    finally:
+        for q in task_queues:
+            q.put(None)
+        for w in workers:
+            w.join(timeout=1)
+            if w.is_alive():
+                w.terminate()
+                w.join()
+
+
+def cluster_fasta(fasta_in, otus_out, table_out, identity=0.97, k=8, processes=1, batch_size=2000):
+    """
+    Cluster the sequences in fasta_in, writing centroids to otus_out
+    and the uparse-style table to table_out.
+
+    Returns
+    -------
+    nseqs, notus : int
+    """
+    # Sequences waiting for their result, and the IDs of the centroids
+    pending = {}
+    centroid_ids = {}
+
+    def seqs():
+        for seqnum, (sid, seq) in enumerate(iter_fasta(fasta_in)):
+            pending[seqnum] = (sid[1:], seq)
+            yield seq.upper()
+
+    nseqs = 0
+    with open(table_out, 'w', buffering=1 << 20) as table, \
+            open_fasta(otus_out, 'w') as otus:
+        for seqnum, centroid, ident in cluster(seqs(), identity, k, processes, batch_size):
+            header, seq = pending.pop(seqnum)
+            nseqs += 1
+            if centroid == seqnum:
+                centroid_ids[seqnum] = record_id(header)
+                table.write(header + '\totu\t*\t*\t*\n')
+                otus.write('>' + header + '\n' + seq + '\n')
+            else:
+                table.write('{}\tmatch\t{:.1f}\t*\t{}\n'.format(header, 100 * ident,
+                                                               centroid_ids[centroid]))
+    return nseqs, len(centroid_ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fasta_in', help='dereplicated fasta, sorted by decreasing size '
+                        + '(see update_concated_derep_fasta.py)')
+    parser.add_argument('otus_out', help='fasta file to write OTU centroid sequences to')
+    parser.add_argument('table_out', help='file to write the otu/match table to '
+                        + '(like usearch -uparseout)')
+    parser.add_argument('--id', help='minimum identity to join an OTU [default: %(default)s]',
+                        type=float, default=0.97)
+    parser.add_argument('-k', help='k-mer length for the candidate prefilter [default: %(default)s]',
+                        type=int, default=8)
+    parser.add_argument('-p', '--processes', help='number of processes [default: %(default)s]',
+                        type=int, default=1)
+    parser.add_argument('--batch_size', help='sequences searched in parallel at a time '
+                        + '[default: %(default)s]', type=int, default=2000)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure_from_args(args)
+
+    if not 0 < args.id <= 1:
+        parser.error('--id must be between 0 and 1')
+
+    with instrument.stage('cluster_otus', inputs=[args.fasta_in],
+                          outputs=[args.otus_out, args.table_out], identity=args.id,
+                          processes=args.processes) as s:
+        s.records, notus = cluster_fasta(args.fasta_in, args.otus_out, args.table_out,
+                                         args.id, args.k, args.processes, args.batch_size)
+        s.extra['otus'] = notus
+    print('{} sequences in {} OTUs'.format(s.records, notus))
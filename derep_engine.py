@@ -0,0 +1,236 @@
+"""
+Dereplicate a fasta file into a dereplication map and a raw_dereplicated
+fasta, i.e. the same outputs as ~/scripts/3.dereplicate.py:
+
+    map:    seqID    sample1:count sample2:count
+    fasta:  >seqID;size=total_count
+            SEQUENCE
+
+Sample IDs come from the sequence headers: everything before the last
+separator (-s), with any other separators removed, so >crc_baxter--S_62_1
+is a read from sample crcbaxter--S62. For the relabeled raw_dereplicated
+fastas (>444--crc-baxter;size=132_1) this makes the "sample" the original
+dataset's sequence, as in the master map.
+
+The fasta is read once. Each unique sequence is keyed by its 2-bit packed
+form (see seqpack.py). For inputs too big to dereplicate in memory (e.g.
+the concatenated dataset), use -k to hash-partition reads into k temporary
+files on the first pass and dereplicate one partition at a time, so that
+peak memory is roughly 1/k of the in-memory case.
+
+Within a partition, sequences are written in descending size. Sequences
+seen fewer than -M times in total are dropped.
+
+The input fasta may be gzip or zstandard compressed (see fasta_io.py).
+"""
+import os
+import shutil
+import argparse
+import tempfile
+
+import seqpack
+import instrument
+from derep_maps import SymbolTable
+from fasta_io import iter_fasta
+
+
+def sample_id(header, sep):
+    """
+    Return the sample ID for a fasta header like >sample_N
+    """
+    parts = header[1:].split()[0].split(sep)
+    if len(parts) == 1:
+        return parts[0]
+    return ''.join(parts[:-1])
+
+
+def iter_samples(records, sep):
+    """
+    Turn (header, seq) fasta records into (sample, seq) tuples.
+    """
+    for header, seq in records:
+        yield sample_id(header, sep), seq
+
+
+def count_reads(reads, symbols):
+    """
+    Count each unique sequence's reads in each sample.
+
+    Parameters
+    ----------
+    reads : iterable
+        (sample, seq) tuples, e.g. from iter_samples
+    symbols : SymbolTable
+        sample IDs are interned into this table
+
+    Returns
+    -------
+    counts : dict
+        {packed_seq: {sample_code: count}}
+    nreads : int
+        total number of reads
+    """
+    intern = symbols.intern
+    pack = seqpack.pack
+    counts = {}
+    nreads = 0
+    for sample, seq in reads:
+        nreads += 1
+        sample = intern(sample)
+        key = pack(seq)
+        try:
+            samples = counts[key]
+        except KeyError:
+            counts[key] = {sample: 1}
+            continue
+        samples[sample] = samples.get(sample, 0) + 1
+    return counts, nreads
+
+
+def write_counts(counts, symbols, map_out, fasta_out, min_count, next_id=1):
+    """
+    Write sequences with at least min_count reads to the map and fasta
+    files, largest first, numbering them from next_id.
+
+    Returns
+    -------
+    next_id : int
+        the next unused sequence ID
+    nkept : int
+        number of reads in the sequences that were written
+    """
+    totals = [(sum(samples.values()), key) for key, samples in counts.items()]
+    totals = [t for t in totals if t[0] >= min_count]
+    totals.sort(key=lambda t: t[0], reverse=True)
+
+    names = symbols.names
+    nkept = 0
+    for total, key in totals:
+        samples = counts[key]
+        map_out.write(str(next_id) + '\t'
+                      + ' '.join([names[s] + ':' + str(c) for s, c in samples.items()]) + '\n')
+        fasta_out.write('>' + str(next_id) + ';size=' + str(total) + '\n'
+                        + seqpack.unpack(key) + '\n')
+        next_id += 1
+        nkept += total
+    return next_id, nkept
+
+
+def _partition(reads, partitions, tmp_dir, bufsize=1 << 20):
+    """
+    Spill (sample, seq) lines to partition files by sequence hash.
+    Returns the partition file names and the number of reads.
+    """
+    fnames = [os.path.join(tmp_dir, 'part{}.txt'.format(i)) for i in range(partitions)]
+    files = [open(fn, 'w', buffering=bufsize) for fn in fnames]
+    nreads = 0
+    try:
+        for sample, seq in reads:
+            nreads += 1
+            files[hash(seq) % partitions].write(sample + '\t' + seq + '\n')
+    finally:
+        for f in files:
+            f.close()
+    return fnames, nreads
+
+
+def _iter_partition(fname):
+    with open(fname, 'r') as f:
+        for line in f:
+            sample, seq = line.rstrip('\n').split('\t')
+            yield sample, seq
+
+
+def dereplicate(fasta_in, map_file, derep_fasta, sep='_', min_count=10, partitions=1, tmp_dir=None):
+    """
+    Dereplicate fasta_in into map_file and derep_fasta.
+
+    Parameters
+    ----------
+    fasta_in : str
+        fasta with headers like >sample_N
+    map_file, derep_fasta : str
+        output dereplication map and raw_dereplicated fasta
+    sep : str
+        sample ID separator in headers
+    min_count : int
+        minimum total reads for a sequence to be kept
+    partitions : int
+        number of hash partitions to spill reads into before counting.
+        1 dereplicates everything in memory.
+    tmp_dir : str
+        where to put partition files (default: next to map_file)
+
+    Returns
+    -------
+    stats : dict
+        read and sequence counts, for the proc summary file
+    """
+    symbols = SymbolTable()
+    stats = {'reads': 0, 'unique_seqs': 0, 'kept_seqs': 0, 'kept_reads': 0}
+    next_id = 1
+
+    with open(map_file, 'w', buffering=1 << 20) as map_out, \
+            open(derep_fasta, 'w', buffering=1 << 20) as fasta_out:
+        if partitions <= 1:
+            with instrument.stage('count_reads', inputs=[fasta_in], fasta=fasta_in) as s:
+                counts, stats['reads'] = count_reads(iter_samples(iter_fasta(fasta_in), sep), symbols)
+                s.records = stats['reads']
+            stats['unique_seqs'] = len(counts)
+            with instrument.stage('write_counts', records=len(counts), fasta=fasta_in):
+                next_id, stats['kept_reads'] = write_counts(counts, symbols, map_out, fasta_out, min_count)
+        else:
+            tmp = tempfile.mkdtemp(dir=tmp_dir or os.path.dirname(os.path.abspath(map_file)),
+                                   prefix='.derep_tmp.')
+            try:
+                with instrument.stage('partition', inputs=[fasta_in], fasta=fasta_in) as s:
+                    fnames, stats['reads'] = _partition(iter_samples(iter_fasta(fasta_in), sep),
+                                                        partitions, tmp)
+                    s.records = stats['reads']
+                for i, fname in enumerate(fnames):
+                    with instrument.stage('count_and_write_partition', inputs=[fname],
+                                          fasta=fasta_in, partition=i) as s:
+                        counts, s.records = count_reads(_iter_partition(fname), symbols)
+                        stats['unique_seqs'] += len(counts)
+                        next_id, nkept = write_counts(counts, symbols, map_out, fasta_out,
+                                                      min_count, next_id)
+                    stats['kept_reads'] += nkept
+                    del counts
+                    os.remove(fname)
+            finally:
+                shutil.rmtree(tmp)
+
+    stats['kept_seqs'] = next_id - 1
+    return stats
+
+
+def write_summary(fname, fasta_in, stats, min_count):
+    with open(fname, 'w') as f:
+        f.write('Input fasta\t{}\n'.format(fasta_in))
+        f.write('Min count\t{}\n'.format(min_count))
+        f.write('Total reads\t{}\n'.format(stats['reads']))
+        f.write('Unique sequences\t{}\n'.format(stats['unique_seqs']))
+        f.write('Sequences with at least min count reads\t{}\n'.format(stats['kept_seqs']))
+        f.write('Reads in those sequences\t{}\n'.format(stats['kept_reads']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', help='input fasta (e.g. raw_trimmed.fasta)', required=True)
+    parser.add_argument('-s', help='separator between sample ID and read number in headers', default='_')
+    parser.add_argument('-o', help='output dereplication map', required=True)
+    parser.add_argument('-d', help='output raw_dereplicated fasta', required=True)
+    parser.add_argument('-P', help='output processing summary file', default=None)
+    parser.add_argument('-M', help='minimum total count to keep a sequence (default: 10)', type=int, default=10)
+    parser.add_argument('-k', help='number of on-disk partitions, for files too big to dereplicate in memory (default: 1)',
+                        type=int, default=1)
+    parser.add_argument('--tmp_dir', help='directory for partition files', default=None)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure_from_args(args)
+
+    print('Dereplicating {}'.format(args.f))
+    stats = dereplicate(args.f, args.o, args.d, sep=args.s, min_count=args.M,
+                        partitions=args.k, tmp_dir=args.tmp_dir)
+    if args.P is not None:
+        write_summary(args.P, args.f, stats, args.M)
@@ -0,0 +1,550 @@
+"""
+Array-backed parsers for usearch clustering results and dereplication maps.
+
+These stream through each file one line at a time and intern every
+seqID, sample name and dataset name into a shared SymbolTable, so
+that the parsed results are flat numpy arrays of integer codes (and
+counts) rather than nested dicts of strings.
+
+The parsed structures are:
+
+    ClusterAssignments(seqs, otus)
+        one entry per line of the uparse clustering results, mapping
+        each sequence code to its OTU (centroid) code
+    MasterMap(seqs, datasets, origs)
+        one entry per origID--datasetID token in the concatenated
+        dataset's dereplication map
+    DerepMap(seqs, samples, counts)
+        one entry per sample:count token in a dataset's dereplication map
+    Collapsed(dataset, otus, samples, rows, counts)
+        a dataset's total counts per (OTU, sample), with the dataset's
+        sample names listed in samples and indexed by rows
+
+Dataset maps are independent of each other, so load_dataset_derep_maps
+and collapse_dataset_maps can parse (and collapse) them in parallel
+worker processes. Given a cache_dir, parsed maps are also cached on
+disk and memory-mapped on later runs (see parse_local).
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+from array import array
+from collections import namedtuple
+
+import numpy as np
+
+import file_keys
+from sample_keys import sample_label
+
+ClusterAssignments = namedtuple('ClusterAssignments', ['seqs', 'otus'])
+MasterMap = namedtuple('MasterMap', ['seqs', 'datasets', 'origs'])
+DerepMap = namedtuple('DerepMap', ['seqs', 'samples', 'counts'])
+Collapsed = namedtuple('Collapsed', ['dataset', 'otus', 'samples', 'rows', 'counts'])
+
+CODE_DTYPE = np.int32
+
+
+class SymbolTable(object):
+    """
+    Two-way mapping between string IDs and compact integer codes.
+
+    Codes are assigned in the order strings are first interned.
+    """
+
+    def __init__(self, names=None):
+        self.codes = {}
+        self.names = []
+        if names is not None:
+            for name in names:
+                self.intern(name)
+
+    def intern(self, name):
+        """Return the code for name, assigning a new one if needed."""
+        try:
+            return self.codes[name]
+        except KeyError:
+            code = self.codes[name] = len(self.names)
+            self.names.append(name)
+            return code
+
+    def lookup(self, names):
+        """Return an array of codes for names, interning any new ones."""
+        return np.array([self.intern(n) for n in names], dtype=CODE_DTYPE)
+
+    def __getitem__(self, code):
+        return self.names[code]
+
+    def __contains__(self, name):
+        return name in self.codes
+
+    def __len__(self):
+        return len(self.names)
+
+
+def _codes(buf):
+    return np.frombuffer(buf, dtype=np.int32) if len(buf) else np.zeros(0, dtype=CODE_DTYPE)
+
+
+def _counts(buf):
+    return np.frombuffer(buf, dtype=np.int64) if len(buf) else np.zeros(0, dtype=np.int64)
+
+
+def parse_clustering_results(cluster_file, symbols):
+    """
+    Stream a usearch clustering_results file into a ClusterAssignments.
+
+    Parameters
+    ----------
+    cluster_file : str
+        file path for clustering results. File should have
+        five columns:
+            seqID    otu    *    *    *
+            seqID    match  99.3 *    match_seqID
+    symbols : SymbolTable
+        seqIDs are interned into this table
+
+    Returns
+    -------
+    clusters : ClusterAssignments
+        seqs[i] is assigned to OTU otus[i]. OTU centroids are assigned
+        to themselves.
+    """
+    intern = symbols.intern
+    seqs = array('i')
+    otus = array('i')
+
+    with open(cluster_file, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n').split('\t')
+            seqid = intern(line[0].split(';')[0])
+            if line[1] == 'otu':
+                otuid = seqid
+            elif line[1] == 'match':
+                otuid = intern(line[4].split(';')[0])
+            else:
+                continue
+            seqs.append(seqid)
+            otus.append(otuid)
+
+    return ClusterAssignments(_codes(seqs), _codes(otus))
+
+
+def parse_master_derep_map(derep_map, symbols):
+    """
+    Stream the dereplication map of the concatenated dataset-wise
+    dereplicated reads into a MasterMap.
+
+    Parameters
+    ----------
+    derep_map : str
+        file with format:
+        seqID    origID--datasetID;size=123:1 origID--datasetID;size=142:1
+    symbols : SymbolTable
+        seqIDs, origIDs and datasetIDs are interned into this table.
+        Dashes in datasetIDs are replaced with underscores, so that they
+        match the dataset.map file names.
+
+    Returns
+    -------
+    master : MasterMap
+        origs[i] in datasets[i] was dereplicated into seqs[i]
+    """
+    intern = symbols.intern
+    # Dataset tokens repeat on every line, so cache their conversion
+    dataset_codes = {}
+    seqs = array('i')
+    datasets = array('i')
+    origs = array('i')
+
+    with open(derep_map, 'r') as f:
+        for line in f:
+            seqid, members = line.rstrip('\n').split('\t')
+            seqid = intern(seqid)
+            for s in members.split(' '):
+                orig, rest = s.split('--', 1)
+                dataset = rest.split(';', 1)[0]
+                try:
+                    dcode = dataset_codes[dataset]
+                except KeyError:
+                    dcode = dataset_codes[dataset] = intern('_'.join(dataset.split('-')))
+                seqs.append(seqid)
+                datasets.append(dcode)
+                origs.append(intern(orig))
+
+    return MasterMap(_codes(seqs), _codes(datasets), _codes(origs))
+
+
+def parse_one_map_file(map_file, symbols):
+    """
+    Stream one dataset's dereplication map into a DerepMap.
+
+    Parameters
+    ----------
+    map_file : str
+        file with format:
+        seqID    s1:counts s2:counts s4:counts
+    symbols : SymbolTable
+        seqIDs and sample IDs are interned into this table
+
+    Returns
+    -------
+    derep : DerepMap
+        seqs[i] was seen counts[i] times in samples[i]
+    """
+    intern = symbols.intern
+    seqs = array('i')
+    samples = array('i')
+    counts = array('q')
+
+    with open(map_file, 'r') as f:
+        for line in f:
+            seqid, members = line.rstrip('\n').split('\t')
+            seqid = intern(seqid)
+            for s in members.split(' '):
+                sample, count = s.rsplit(':', 1)
+                seqs.append(seqid)
+                samples.append(intern(sample))
+                counts.append(int(count))
+
+    return DerepMap(_codes(seqs), _codes(samples), _counts(counts))
+
+
+def derep_map_files(derep_dir):
+    """
+    Return {dataset: path} for all the dataset.map files in derep_dir,
+    skipping the dereped_datasets_concated.map master map.
+    """
+    map_files = [i for i in os.listdir(derep_dir) if i.endswith('.map')]
+    map_files = [i for i in map_files if not i.startswith('dereped')]
+    return {i.split('.')[0]: os.path.join(derep_dir, i) for i in map_files}
+
+
+def read_dataset_derep_maps(derep_dir, symbols):
+    """
+    Parse all datasetID.map files in derep_dir.
+
+    Returns
+    -------
+    dataset_maps : dict
+        {dataset: DerepMap}
+    """
+    return {dataset: parse_one_map_file(fname, symbols)
+            for dataset, fname in derep_map_files(derep_dir).items()}
+
+
+def otu_lookup(clusters, n):
+    """
+    Return an array of length n mapping each sequence code to its OTU
+    code, with -1 for codes that weren't in the clustering results.
+    """
+    lookup = np.full(n, -1, dtype=CODE_DTYPE)
+    lookup[clusters.seqs] = clusters.otus
+    return lookup
+
+
+def orig_otu_lookup(master, seq_to_otu, dataset_code):
+    """
+    Map the original sequence codes of one dataset to OTU codes.
+
+    Parameters
+    ----------
+    master : MasterMap
+    seq_to_otu : numpy array
+        output of otu_lookup
+    dataset_code : int
+        symbol code of the dataset
+
+    Returns
+    -------
+    lookup : numpy array
+        same length as seq_to_otu, with the OTU code of each of the
+        dataset's original sequences and -1 everywhere else
+    """
+    mask = master.datasets == dataset_code
+    lookup = np.full(len(seq_to_otu), -1, dtype=CODE_DTYPE)
+    lookup[master.origs[mask]] = seq_to_otu[master.seqs[mask]]
+    return lookup
+
+
+def collapse_derep_map(derep, orig_to_otu):
+    """
+    Sum a dataset's sample counts over all the original sequences in
+    each OTU.
+
+    Parameters
+    ----------
+    derep : DerepMap
+        the dataset's dereplication map
+    orig_to_otu : numpy array
+        output of orig_otu_lookup for this dataset. It must be indexable
+        by every code in derep.seqs.
+
+    Returns
+    -------
+    otus, samples, counts : numpy arrays
+        total counts of each (OTU, sample) pair. Sequences that were not
+        assigned to an OTU are dropped.
+    """
+    otus = orig_to_otu[derep.seqs]
+    keep = otus >= 0
+    otus = otus[keep].astype(np.int64)
+    samples = derep.samples[keep].astype(np.int64)
+    counts = derep.counts[keep]
+    if len(otus) == 0:
+        return otus, samples, counts
+
+    # Sum duplicate (OTU, sample) pairs
+    nsamples = int(samples.max()) + 1
+    keys, inverse = np.unique(otus * nsamples + samples, return_inverse=True)
+    summed = np.bincount(inverse, weights=counts).astype(np.int64)
+    return keys // nsamples, keys % nsamples, summed
+
+
+def compact_samples(dataset, otus, samples, counts, symbols):
+    """
+    Package the output of collapse_derep_map as a Collapsed tuple, with
+    sample codes replaced by the dataset's own list of sample names so
+    that it doesn't depend on the symbol table it was parsed with.
+    """
+    uniq, rows = np.unique(samples, return_inverse=True)
+    return Collapsed(dataset, otus, [symbols[s] for s in uniq], rows, counts)
+
+
+def add_to_table(builder, collapsed, symbols):
+    """
+    Add a Collapsed dataset to a SparseTableBuilder, relabeling samples
+    to dataset--sample. OTU codes are looked up in symbols.
+    """
+    if len(collapsed.counts) == 0:
+        return
+    uniq_otus, cols = np.unique(collapsed.otus, return_inverse=True)
+    builder.add_block([sample_label(collapsed.dataset, s) for s in collapsed.samples], collapsed.rows,
+                      [symbols[o] for o in uniq_otus], cols,
+                      collapsed.counts)
+
+
+## On-disk cache
+# Parsed maps are cached as one .npy file per field plus the list of
+# names their codes index into, so that later runs can memory-map the
+# arrays instead of re-parsing the text. Each cache entry records the
+# source file's key (see file_keys.py), and is rebuilt when it changes.
+
+def _cache_entry(fname, parser, cache_dir):
+    """Directory holding the cached parser(fname) output."""
+    path = os.path.abspath(fname)
+    tag = hashlib.sha1(path.encode('utf-8')).hexdigest()[:10]
+    return os.path.join(cache_dir, '{}.{}.{}'.format(os.path.basename(path), parser.__name__, tag))
+
+
+def _cache_is_valid(fname, entry):
+    """Check a cache entry against its source file."""
+    return file_keys.is_current(fname, os.path.join(entry, 'key.json'))
+
+
+def _write_cache(fname, entry, parsed, names):
+    """Write a cache entry atomically, replacing any stale one."""
+    key = file_keys.file_key(fname)
+    key['fields'] = list(parsed._fields)
+
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix='.tmp.')
+    for field, values in zip(parsed._fields, parsed):
+        np.save(os.path.join(tmp, field + '.npy'), values)
+    with open(os.path.join(tmp, 'names.txt'), 'w') as f:
+        f.write(_pack_names(names))
+    file_keys.write_key(os.path.join(tmp, 'key.json'), key)
+
+    if os.path.exists(entry):
+        shutil.rmtree(entry)
+    os.rename(tmp, entry)
+
+
+def _read_cache(entry, parser_type):
+    parsed = parser_type(*[np.load(os.path.join(entry, field + '.npy'), mmap_mode='r')
+                           for field in parser_type._fields])
+    with open(os.path.join(entry, 'names.txt'), 'r') as f:
+        names = _unpack_names(f.read())
+    return parsed, names
+
+
+_PARSED_TYPES = {'parse_clustering_results': ClusterAssignments,
+                 'parse_master_derep_map': MasterMap,
+                 'parse_one_map_file': DerepMap}
+
+
+def parse_local(fname, parser, cache_dir=None):
+    """
+    Parse fname with parser into a fresh symbol table, going through
+    the on-disk cache if cache_dir is given.
+
+    Parameters
+    ----------
+    fname : str
+        file to parse
+    parser : function
+        parse_clustering_results, parse_master_derep_map or
+        parse_one_map_file
+    cache_dir : str or None
+        directory with cached parsed files. Stale entries are replaced.
+
+    Returns
+    -------
+    parsed : namedtuple
+        parser output. When read from the cache, its arrays are read-only
+        memory maps.
+    names : list
+        names that the codes in parsed index into
+    """
+    if cache_dir is None:
+        local = SymbolTable()
+        return parser(fname, local), local.names
+
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Another worker may have just made it
+            pass
+    entry = _cache_entry(fname, parser, cache_dir)
+    if _cache_is_valid(fname, entry):
+        return _read_cache(entry, _PARSED_TYPES[parser.__name__])
+
+    local = SymbolTable()
+    parsed = parser(fname, local)
+    _write_cache(fname, entry, parsed, local)
+    return parsed, local.names
+
+
+def remap_codes(parsed, names, symbols):
+    """
+    Re-intern the names behind a locally parsed namedtuple into symbols
+    and return a copy whose code arrays use the shared codes. Counts are
+    passed through unchanged.
+    """
+    remap = symbols.lookup(names)
+    return type(parsed)(*[values if field == 'counts' else remap[values]
+                          for field, values in zip(parsed._fields, parsed)])
+
+
+def cached_parse(fname, parser, symbols, cache_dir=None):
+    """
+    Same as parser(fname, symbols), but read from (or written to) the
+    on-disk cache in cache_dir.
+    """
+    parsed, names = parse_local(fname, parser, cache_dir)
+    return remap_codes(parsed, names, symbols)
+
+
+## Parallel loading
+# Each worker parses a map file into its own SymbolTable and returns
+# numpy arrays plus the (newline-joined) list of names it interned, which
+# are cheap to pickle. The parent re-interns those names into the shared
+# table and remaps the codes.
+
+def _pack_names(symbols):
+    return '\n'.join(symbols.names)
+
+
+def _unpack_names(packed):
+    return packed.split('\n') if packed else []
+
+
+def _parse_worker(job):
+    dataset, map_file, cache_dir = job
+    derep, names = parse_local(map_file, parse_one_map_file, cache_dir)
+    # Memory-mapped arrays can't be pickled back to the parent
+    derep = DerepMap(*[np.asarray(a).copy() for a in derep])
+    return dataset, derep, '\n'.join(names)
+
+
+def _collapse_worker(job):
+    dataset, map_file, orig_names, orig_otus, cache_dir = job
+    derep, names = parse_local(map_file, parse_one_map_file, cache_dir)
+    local = SymbolTable(names)
+    orig_codes = local.lookup(_unpack_names(orig_names))
+
+    orig_to_otu = np.full(len(local), -1, dtype=CODE_DTYPE)
+    orig_to_otu[orig_codes] = orig_otus
+    otus, samples, counts = collapse_derep_map(derep, orig_to_otu)
+    return compact_samples(dataset, otus, samples, counts, local)
+
+
+def _largest_first(map_files):
+    """Order (dataset, path) jobs so the biggest files start first."""
+    return sorted(map_files.items(), key=lambda kv: os.path.getsize(kv[1]), reverse=True)
+
+
+def _imap(fun, jobs, processes):
+    """
+    Run fun over jobs in a pool of processes, yielding results in job
+    order (so outputs are deterministic). With processes=1, run serially
+    in this process.
+    """
+    if processes == 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield fun(job)
+        return
+    pool = multiprocessing.Pool(min(processes, len(jobs)))
+    try:
+        for result in pool.imap(fun, jobs):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_dataset_derep_maps(derep_dir, symbols, processes=1, cache_dir=None):
+    """
+    Parse all datasetID.map files in derep_dir using a pool of worker
+    processes, and the on-disk cache if cache_dir is given. Equivalent
+    to read_dataset_derep_maps.
+
+    Returns
+    -------
+    dataset_maps : dict
+        {dataset: DerepMap}, with codes from symbols
+    """
+    dataset_maps = {}
+    jobs = [(dataset, map_file, cache_dir)
+            for dataset, map_file in _largest_first(derep_map_files(derep_dir))]
+    for dataset, derep, names in _imap(_parse_worker, jobs, processes):
+        dataset_maps[dataset] = remap_codes(derep, _unpack_names(names), symbols)
+    return dataset_maps
+
+
+def collapse_dataset_maps(derep_dir, clusters, master, symbols, processes=1, cache_dir=None):
+    """
+    Parse and collapse each dataset's dereplication map to OTUs, with each
+    dataset handled by its own worker process.
+
+    Parameters
+    ----------
+    derep_dir : str
+        directory with datasetID.map files
+    clusters : ClusterAssignments
+    master : MasterMap
+    symbols : SymbolTable
+        table used to parse clusters and master
+    processes : int
+        number of worker processes
+    cache_dir : str or None
+        directory with cached parsed map files
+
+    Yields
+    ------
+    collapsed : Collapsed
+        one per dataset, largest map file first. OTU codes are from symbols.
+    """
+    seq_to_otu = otu_lookup(clusters, len(symbols))
+    jobs = []
+    for dataset, map_file in _largest_first(derep_map_files(derep_dir)):
+        if dataset in symbols:
+            mask = master.datasets == symbols.codes[dataset]
+        else:
+            mask = np.zeros(len(master.datasets), dtype=bool)
+        orig_names = '\n'.join([symbols[c] for c in master.origs[mask]])
+        jobs.append((dataset, map_file, orig_names, seq_to_otu[master.seqs[mask]], cache_dir))
+
+    for collapsed in _imap(_collapse_worker, jobs, processes):
+        yield collapsed
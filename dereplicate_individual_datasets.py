@@ -1,83 +1,174 @@
 """
 This script
-1. dereplicates each dataset's raw_trimmed.fasta 
+1. dereplicates each dataset's raw_trimmed.fasta (with derep_engine.py, or
+   ~/scripts/3.dereplicate.py with -e)
 1. relabels the dereplicated seqIDs to track the original dataset/seqID combination
 ...
 
+Relabeling streams each file in large blocks, with one worker process
+per file (-n at a time).
+
+With --metrics, each step's time, throughput and memory use (and those
+of each derep_engine.py run) are logged as JSON lines (see instrument.py).
 """
 
 import os
-import subprocess
+import re
+import sys
 import argparse
+import multiprocessing
+
+import job_runner
+import instrument
+from fasta_io import iter_blocks
+
+# seqID    s1:counts s2:counts
+MAP_ID = re.compile(r'^([^\t\n]*)\t', re.M)
+# >seqID;size=132
+DEREP_HEADER = re.compile(r'^(>[^;\n]*);(size=[^;\n]*?)[ \t\r]*(?:;[^\n]*)?$', re.M)
+
+
+def dataset_label(fname):
+    """
+    Dataset ID for relabeling, with dashes instead of underscores
+    (e.g. data/derep_datasets/crc_baxter.map --> crc-baxter)
+    """
+    return '-'.join(os.path.basename(fname).split('.')[0].split('_'))
+
+
+def relabel_map_blocks(fname, dataset):
+    """
+    Relabel the first column of a dereplication map.
+    Current sequences are labeled seqID, turn them into seqID--dataset
+    """
+    replacement = r'\1--' + dataset + '\t'
+    for block in iter_blocks(fname):
+        yield MAP_ID.sub(replacement, block)
+
+
+def relabel_derep_blocks(fname, dataset):
+    """
+    Relabel the sequence headers of a raw_dereplicated fasta.
+    Change >seqID;size=132 to >seqID--dataset-id;size=132_1
+
+    You need to have (1) no underscores in the dataset ID and
+    (2) an underscore after seqID-dataset, so that downstream
+    dereplication sees the sequence handle as the "sample ID"
+    """
+    replacement = r'\1--' + dataset + r';\2_1'
+    for block in iter_blocks(fname):
+        relabeled, n = DEREP_HEADER.subn(replacement, block)
+        if n != block.startswith('>') + block.count('\n>'):
+            # Left as is, it would clash with other datasets' sequence IDs
+            bad = next(l for l in block.split('\n') if l.startswith('>') and not DEREP_HEADER.match(l))
+            raise ValueError('{}: header without ;size=: {}'.format(fname, bad))
+        yield relabeled
+
+
+def _relabel_file(job):
+    relabel_fun, fname, out_fname = job
+    print(fname)
+    with open(out_fname, 'w', buffering=1 << 20) as fnew:
+        for block in relabel_fun(fname, dataset_label(fname)):
+            fnew.write(block)
+
 
-### Arguments
-parser = argparse.ArgumentParser()
-parser.add_argument('in_dir', help='directory with raw_trimmed fasta files')
-parser.add_argument('out_dir', help='out directory (where to write resulting files)')
-parser.add_argument('-d', help='dereplicate reads', action='store_true', default=False)
-parser.add_argument('-l', help='relabel map files and raw_dereplicated fastas', action='store_true', default=False)
+def relabel_files(jobs, processes=None):
+    """
+    Run (relabel_fun, fname, out_fname) jobs, one worker per file.
+    """
+    if processes == 1 or len(jobs) <= 1:
+        for job in jobs:
+            _relabel_file(job)
+        return
+    pool = multiprocessing.Pool(min(processes or job_runner.default_procs(), len(jobs)))
+    try:
+        pool.map(_relabel_file, jobs)
+    finally:
+        pool.close()
+        pool.join()
 
-args = parser.parse_args()
 
-### Get all the raw_trimmed fasta files
-files = os.listdir(args.in_dir)
-trimmed_fastas = [i for i in files if i.endswith('.raw_trimmed.fasta')]
+def derep_outputs(out_dir, f):
+    """
+    (map, raw_dereplicated fasta, summary) file names for raw_trimmed fasta f
+    (e.g. crc_baxter.raw_trimmed.fasta --> out_dir/crc_baxter.map, ...)
+    """
+    dataset = f.replace('.raw_trimmed.fasta', '')
+    return (os.path.join(out_dir, dataset + '.map'),
+            os.path.join(out_dir, dataset + '.raw_dereplicated.fasta'),
+            os.path.join(out_dir, dataset + '.proc_summary.txt'))
 
-### Dereplicate them
-if args.d:
+
+def derep_command(in_dir, out_dir, f, external=False):
+    """
+    Command to dereplicate raw_trimmed fasta f in in_dir.
+    Uses the built-in engine unless asked for the pipeline's script.
+    """
+    if external:
+        derep_script = os.path.expanduser('~/scripts/3.dereplicate.py')
+    else:
+        derep_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'derep_engine.py')
+    map_file, derep_fasta, summary = derep_outputs(out_dir, f)
+    return ['python', derep_script, '-f', os.path.join(in_dir, f), '-s', '_',
+            '-o', map_file, '-d', derep_fasta, '-P', summary]
+
+
+def dereplicate(in_dir, out_dir, trimmed_fastas, external=False, max_procs=None):
     print('Dereplicating reads')
-    # Prepare commands
-    fnamefun = lambda f: (os.path.join(args.in_dir, f),
-                          os.path.join(args.out_dir, f.replace('.raw_trimmed.fasta', '') + '.map'),
-                          os.path.join(args.out_dir, f.replace('.raw_trimmed.fasta', '') + '.raw_dereplicated.fasta'),
-                          os.path.join(args.out_dir, f.replace('.raw_trimmed.fasta', '') + '.proc_summary.txt'))
-    cmdfun = lambda f: "python ~/scripts/3.dereplicate.py -f {} -s _ -o {} -d {} -P {}".format(*fnamefun(f))
-    commands = [cmdfun(f) for f in trimmed_fastas]
-
-    # Run in parallel
-    processes = [subprocess.Popen(cmd, shell=True) for cmd in commands]
-    # Make sure they've all finished
-    for p in processes:
-        p.wait()
-
-if args.l:
+    # Start the biggest files first, so they don't end up running alone at the end
+    trimmed_fastas = sorted(trimmed_fastas, key=lambda f: os.path.getsize(os.path.join(in_dir, f)),
+                            reverse=True)
+    jobs = [(f, derep_command(in_dir, out_dir, f, external)) for f in trimmed_fastas]
+
+    # Run in parallel, at most max_procs at a time, and stop if any of them fail
+    try:
+        with instrument.stage('dereplicate', inputs=[os.path.join(in_dir, f) for f in trimmed_fastas],
+                              records=len(jobs)):
+            job_runner.run_jobs(jobs, max_procs=max_procs)
+    except job_runner.JobFailed as e:
+        sys.exit('Dereplication failed: {}'.format(e))
+
+
+def relabel(out_dir, max_procs=None):
     print('Relabeling output files from dereplication')
     ### Relabel sequences with dataset ID
     # Note: dataset ID shouldn't have underscores in them!
-    ## This needs to happen in the first column of the provenance map (*.map)
-    # Current sequences are labeled seqID
-    # Turn them into seqID-dataset;size=whatever
-    files = os.listdir(args.out_dir)
-    mapfiles = [os.path.join(args.out_dir, i) for i in files if i.endswith('.map')]
-    derepfiles = [os.path.join(args.out_dir, i) for i in files if i.endswith('.raw_dereplicated.fasta')]
-    
-    for fname in mapfiles:
-        print(fname)
-        dataset = '-'.join(fname.split('/')[-1].split('.')[0].split('_'))
-        with open(fname, 'r') as f:
-            lines = f.readlines()
-            lines = [l.strip().split('\t') for l in lines]
-            lines = [l[0] + '--' + dataset + '\t' +  l[1] for l in lines]
-            with open(fname + '.relabled', 'w') as fnew:
-                fnew.write('\n'.join(lines))
-                fnew.write('\n')
-
-    ## And in the sequence headers of the raw_dereplicated fasta
-    # Current sequences are labeled >seqID;size
-    # Turn them into >seqID-dataset_1
-    # You need to have (1) no underscores in the dataset ID and
-    # (2) an underscore after seqID-dataset, so that downstream
-    # dereplication sees the sequence handle as the "sample ID"
-    for fname in derepfiles:
-        print(fname)
-        dataset = '-'.join(fname.split('/')[-1].split('.')[0].split('_'))
-        lines = []
-        with open(fname, 'r') as f:
-            for line in f.readlines():
-                if line.startswith('>'):
-                    # Change >seqID;size=132 to >seqID--dataset-id;size=132_1
-                    line = line.split(';')[0] + '--' + dataset + ';' + line.split(';')[1].strip() + '_1'
-                lines.append(line.strip())
-        with open(fname + '.relabeled', 'w') as f:
-            f.write('\n'.join(lines))
-            f.write('\n')
+    files = os.listdir(out_dir)
+    mapfiles = [os.path.join(out_dir, i) for i in files if i.endswith('.map')]
+    derepfiles = [os.path.join(out_dir, i) for i in files if i.endswith('.raw_dereplicated.fasta')]
+
+    ## This needs to happen in the first column of the provenance map (*.map),
+    ## and in the sequence headers of the raw_dereplicated fasta
+    jobs = [(relabel_map_blocks, fname, fname + '.relabled') for fname in mapfiles]
+    jobs += [(relabel_derep_blocks, fname, fname + '.relabeled') for fname in derepfiles]
+    with instrument.stage('relabel', inputs=mapfiles + derepfiles, outputs=[j[2] for j in jobs],
+                          records=len(jobs)):
+        relabel_files(jobs, max_procs)
+
+if __name__ == "__main__":
+    ### Arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('in_dir', help='directory with raw_trimmed fasta files')
+    parser.add_argument('out_dir', help='out directory (where to write resulting files)')
+    parser.add_argument('-d', help='dereplicate reads', action='store_true', default=False)
+    parser.add_argument('-n', help='maximum number of datasets to process at once (default: number of CPUs)',
+                        type=int, default=None)
+    parser.add_argument('-e', help='dereplicate with ~/scripts/3.dereplicate.py instead of derep_engine.py',
+                        action='store_true', default=False)
+    parser.add_argument('-l', help='relabel map files and raw_dereplicated fastas', action='store_true', default=False)
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+    instrument.configure_from_args(args)
+
+    ### Get all the raw_trimmed fasta files
+    files = os.listdir(args.in_dir)
+    trimmed_fastas = [i for i in files if i.endswith('.raw_trimmed.fasta')]
+
+    ### Dereplicate them
+    if args.d:
+        dereplicate(args.in_dir, args.out_dir, trimmed_fastas, external=args.e, max_procs=args.n)
+
+    if args.l:
+        relabel(args.out_dir, max_procs=args.n)
@@ -53,32 +53,9 @@ done
 ## For each given S3 bucket, download and process the dataset to raw_trimmed fastas
 if [ "$download" != 'False' ]; then
     echo -e "Downloading all datasets in ${download} from S3"
-    while read bucket;
-    do
-    	# Download data from S3
-    	aws s3 cp s3://mbit.storage.bucket1/${bucket} tmp_data/ --recursive --quiet
-
-    	# Download summary file from almlab S3
-    	aws s3 cp s3://almlab.bucket/duvallet/summary_files/${bucket}.summary_file.txt tmp_data/summary_file.txt
-
-    	# Call python script to edit summary file
-    	python update_summary_file.py tmp_data/summary_file.txt
-    	dataset=$(cut -f 2 tmp_data/summary_file.txt | head -n 1)
-	
-    	# Run Master.py
-    	python ~/scripts/Master.py -i ~/users/duvallet/concat_datasets/tmp_data/
-
-    	# Move raw_trimmed.fasta and summary file somewhere safe
-    	mv ~/proc/${dataset}_proc_16S/${dataset}.raw_trimmed.fasta data/raw_trimmed/
-
-    	# Also grab the metadata file, put it here too
-    	aws s3 cp s3://almlab.bucket/duvallet/metadata_files/${dataset}.metadata.txt data/metadata/
-
-    	# Delete the data, proc, and processing_results folders
-    	rm -r ~/proc/${dataset}_proc_16S
-    	rm -r ~/processing_results/${dataset}_results
-    	rm -r tmp_data/*
-    done < $download
+    # Each dataset is downloaded and run through Master.py in its own
+    # workspace in tmp_data/, several at once (see ingest.py for the options)
+    python ingest.py $download
 fi
 
 
@@ -87,7 +64,7 @@ fi
 # If there are duplicate IDs, this code just prints that to screen and keeps going...
 # TODO: rename samples in metadata to match what they are in big OTU table (dataset--sampleID)
 echo -e "Concatenating metadata files..."
-python manipulate_metadata_files.py data/metadata/ data/for_pipeline/ all_metadata.txt
+python manipulate_metadata_files.py data/metadata/ data/for_pipeline/ all_metadata.txt --compact
 
 ## Dereplicate each dataset individually
 # TODO: add flag in dereplicate...py for min_count (i.e. min reads in one dataset)
@@ -99,20 +76,16 @@ if [ "$derepall" != 'False' ]; then
 fi
 
 if [ "$derep_proc" == 'True' ]; then
-    ## Concatenate all the relabeled raw_dereplicated files
-    echo -e "Concatenating individual raw_dereplicate fasta files..."
-    concat_dir=data/derep_concat
-    concat_trimmed=${concat_dir}/dereped_datasets_concated.raw_trimmed.fasta
-    cat $(find ${derep_dir}/*.raw_dereplicated.fasta.relabeled) > $concat_trimmed
-
-    ## Dereplicate the concatenated dereplicated files
+    ## Merge the individually dereplicated datasets into one dereplication map and fasta
+    # This gives the same map as concatenating the *.raw_dereplicated.fasta.relabeled
+    # files and re-dereplicating them with min_count = 1, without writing the concatenated file.
+    # Each dataset's sorted run is kept in runs/ and only rebuilt if that dataset changed.
     # TODO: add flag or variable to change min_count here (i.e. min # of datasets)
-    echo -e "Dereplicating the concatenated dereplicated files..."
-    raw_trimmed=${concat_dir}/dereped_datasets_concated.raw_trimmed.fasta
+    echo -e "Merging the individually dereplicated datasets..."
+    concat_dir=data/derep_concat
     derep_map=${concat_dir}/dereped_datasets_concated.map
     derep_fasta=${concat_dir}/dereped_datasets_concated.raw_dereplicated.fasta
-    proc_summary=${concat_dir}/dereped_datasets_concated.proc_summary.txt
-    python ~/scripts/3.dereplicate.py -f $raw_trimmed -s _ -o $derep_map -d $derep_fasta -P $proc_summary -M 1
+    python merge_derep.py $derep_dir ${concat_dir}/runs $derep_map $derep_fasta
 
     # Update the re-dereplicated concatenated file with total sequence size
     # And write in descending size order (bc that's what usearch wants)
@@ -136,13 +109,10 @@ fi
 
 if [ "$pipeline_proc" == 'True' ]; then
     ## Relabel sample IDs in the raw_trimmed files to be datasetID--sampleID_N
-    echo -e "Relabeling raw_trimmed.fasta files"
+    ## and concatenate them all into one raw_trimmed.fasta file (without writing relabeled copies)
+    echo -e "Relabeling and concatenating raw_trimmed.fasta files"
     trimmed_dir=data/raw_trimmed
-    python relabel_raw_trimmed.py $trimmed_dir
-
-    ## Concatenate all of the raw_trimmed.fasta files
-    echo -e "Concatenating all of the *raw_trimmed.fasta.relabeled files"
-    cat data/raw_trimmed/*.raw_trimmed.fasta.relabeled > data/for_pipeline/all_raw_trimmed.fasta
+    python relabel_raw_trimmed.py $trimmed_dir -o data/for_pipeline/all_raw_trimmed.fasta -p 4
 
     ## Dereplicate that huge raw_trimmed.fasta file
     echo -e "Running the concatenated raw_trimmed file through pipeline"
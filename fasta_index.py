@@ -0,0 +1,225 @@
+"""
+Random access to the sequences in a fasta file by sequence ID, through
+an offset index, like samtools faidx.
+
+The index is built with one pass over the file and kept next to it as
+fasta.fai, in the samtools format (one line per record):
+
+    NAME    LENGTH    OFFSET    LINEBASES    LINEWIDTH
+
+NAME is the header up to the first whitespace, OFFSET is where the
+sequence starts, and multi-line records must have all their lines (but
+the last) the same length. A key of the fasta (see file_keys.py) is kept
+in fasta.fai.key.json, and the index is rebuilt if the fasta changes.
+
+Sequences are looked up by ID: the name up to the first ';', so the
+record >444;size=8 has ID 444. They're read from the memory-mapped
+fasta, so only the pages that are used get read, and raw() returns a
+view of the file rather than a copy.
+
+Only plain (uncompressed) fasta files can be indexed.
+
+From the command line, print the records with the given IDs, e.g. to
+pull OTU representative sequences out of an otu_seqs fasta:
+
+    python fasta_index.py otu_seqs.fasta 12 46 -i more_ids.txt
+"""
+import os
+import sys
+import mmap
+import argparse
+
+import numpy as np
+
+import file_keys
+
+
+def record_id(name):
+    """Sequence ID for a fasta header name, e.g. 444;size=8 --> 444"""
+    return name.split(';')[0]
+
+
+def build_index(fasta):
+    """
+    Scan fasta and return (names, table), where table is an int64 array
+    with (length, offset, linebases, linewidth) for each record.
+    """
+    names = []
+    rows = []
+    with open(fasta, 'rb') as f:
+        offset = 0
+        record = None
+        for line in f:
+            n = len(line)
+            if line.startswith(b'>'):
+                if record is not None:
+                    rows.append(record[:4])
+                names.append(line[1:].split()[0].decode('ascii'))
+                # length, offset, linebases, linewidth, last line was short
+                record = [0, offset + n, 0, 0, False]
+            elif record is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if bases == 0:
+                    pass
+                elif record[2] == 0:
+                    record[2], record[3] = bases, n
+                elif record[4] or bases > record[2]:
+                    # Only the last line of a record can be shorter than the others
+                    raise ValueError('{}: lines of record {} have different lengths'.format(
+                        fasta, names[-1]))
+                if 0 < bases < record[2] or (bases == record[2] and n != record[3]):
+                    record[4] = True
+                record[0] += bases
+            offset += n
+        if record is not None:
+            rows.append(record[:4])
+    return names, np.array(rows, dtype=np.int64).reshape(-1, 4)
+
+
+def write_index(fai, names, table):
+    tmp = fai + '.tmp'
+    with open(tmp, 'w') as f:
+        for name, row in zip(names, table.tolist()):
+            f.write('{}\t{}\t{}\t{}\t{}\n'.format(name, *row))
+    os.rename(tmp, fai)
+
+
+def read_index(fai):
+    names = []
+    rows = []
+    with open(fai, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n').split('\t')
+            names.append(line[0])
+            rows.append([int(i) for i in line[1:5]])
+    return names, np.array(rows, dtype=np.int64).reshape(-1, 4)
+
+
+def load_index(fasta):
+    """
+    Return (names, table) for fasta, from its .fai if that's up to date,
+    otherwise building (and saving) it.
+    """
+    fai = fasta + '.fai'
+    key_file = fai + '.key.json'
+    if os.path.exists(fai) and file_keys.is_current(fasta, key_file):
+        return read_index(fai)
+    key = file_keys.file_key(fasta)
+    names, table = build_index(fasta)
+    write_index(fai, names, table)
+    file_keys.write_key(key_file, key)
+    return names, table
+
+
+class FastaIndex(object):
+    """
+    Memory-mapped fasta file with lookups by sequence ID.
+
+    Parameters
+    ----------
+    fasta : str
+        plain fasta file. Its index is loaded, or built if needed.
+
+    Attributes
+    ----------
+    names : list
+        full header names (without '>'), in file order
+    ids : dict
+        {sequence ID: record number}
+    """
+
+    def __init__(self, fasta):
+        self.fasta = fasta
+        self.names, self._table = load_index(fasta)
+        self.ids = {record_id(name): i for i, name in enumerate(self.names)}
+        if len(self.ids) != len(self.names):
+            raise ValueError('{} has duplicate sequence IDs'.format(fasta))
+        self._file = open(fasta, 'rb')
+        if os.path.getsize(fasta) > 0:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mm = b''
+        self._view = memoryview(self._mm)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, seqid):
+        return seqid in self.ids
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self._view.release()
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._file.close()
+
+    def lengths(self):
+        """Sequence lengths, in file order."""
+        return self._table[:, 0]
+
+    def raw(self, i):
+        """
+        Record number i's sequence as it is in the file (including line
+        breaks, for multi-line records), as a memoryview of the mapped file.
+        """
+        length, offset, linebases, linewidth = self._table[i].tolist()
+        if linebases == 0:
+            return self._view[offset:offset]
+        nlines = -(-length // linebases)
+        end = offset + (nlines - 1) * linewidth + (length - (nlines - 1) * linebases)
+        return self._view[offset:end]
+
+    def record(self, i):
+        """Record number i's sequence, as bytes without line breaks."""
+        length, offset, linebases, linewidth = self._table[i].tolist()
+        seq = self.raw(i)
+        if linewidth == 0 or length <= linebases:
+            return seq.tobytes()
+        return b''.join(seq.tobytes().split())
+
+    def fetch(self, seqid):
+        """Sequence with ID seqid, as a string."""
+        return self.record(self.ids[seqid]).decode('ascii')
+
+    def write_record(self, i, f, header=None):
+        """
+        Write record number i to binary file f, with header (a str
+        without '>') or its original header. Single-line sequences are
+        written straight from the mapped file.
+        """
+        header = self.names[i] if header is None else header
+        f.write(b'>' + header.encode('ascii') + b'\n')
+        length, _, linebases, _ = self._table[i].tolist()
+        if length <= linebases:
+            f.write(self.raw(i))
+        else:
+            f.write(self.record(i))
+        f.write(b'\n')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fasta', help='fasta file (indexed the first time)')
+    parser.add_argument('ids', help='sequence IDs to print', nargs='*')
+    parser.add_argument('-i', help='file with more sequence IDs, one per line', default=None)
+    args = parser.parse_args()
+
+    ids = list(args.ids)
+    if args.i is not None:
+        with open(args.i, 'r') as f:
+            ids += [l.strip() for l in f if l.strip()]
+
+    out = sys.stdout.buffer if hasattr(sys.stdout, 'buffer') else sys.stdout
+    with FastaIndex(args.fasta) as index:
+        missing = [i for i in ids if i not in index]
+        if missing:
+            sys.exit('Not in {}: {}'.format(args.fasta, ', '.join(missing)))
+        for seqid in ids:
+            index.write_record(index.ids[seqid], out)
@@ -0,0 +1,176 @@
+"""
+Opening and reading fasta files that may be compressed.
+
+Files ending in .gz are read and written with gzip, and files ending in
+.zst with zstandard (which needs the zstandard package). Anything else
+is treated as plain text.
+
+iter_blocks and iter_blocks_parallel are for streaming transforms that
+work on large blocks of whole lines rather than record by record.
+"""
+import io
+import gzip
+import queue
+import multiprocessing
+
+COMPRESSED_SUFFIXES = ('.gz', '.zst')
+
+
+def strip_compression(fname):
+    """Return fname without a .gz or .zst suffix."""
+    for suffix in COMPRESSED_SUFFIXES:
+        if fname.endswith(suffix):
+            return fname[:-len(suffix)]
+    return fname
+
+
+def open_fasta(fname, mode='r', bufsize=1 << 20):
+    """
+    Open a (possibly compressed) fasta file as text.
+
+    Parameters
+    ----------
+    fname : str
+        file name. .gz and .zst files are (de)compressed on the fly.
+    mode : str
+        'r', 'w' or 'a' (appending to a compressed file adds a new
+        gzip member or zstandard frame, which readers continue into)
+    bufsize : int
+        buffer size, in bytes
+    """
+    if fname.endswith('.gz'):
+        if mode == 'r':
+            return io.TextIOWrapper(io.BufferedReader(gzip.open(fname, 'rb'), bufsize))
+        return io.TextIOWrapper(io.BufferedWriter(gzip.open(fname, mode[0] + 'b', compresslevel=6), bufsize))
+    if fname.endswith('.zst'):
+        import zstandard
+        if mode == 'r':
+            raw = zstandard.ZstdDecompressor().stream_reader(open(fname, 'rb'), closefd=True)
+            return io.TextIOWrapper(io.BufferedReader(raw, bufsize))
+        raw = zstandard.ZstdCompressor().stream_writer(open(fname, mode[0] + 'b'), closefd=True)
+        return io.TextIOWrapper(io.BufferedWriter(raw, bufsize))
+    return open(fname, mode, buffering=bufsize)
+
+
+def iter_fasta(fname):
+    """
+    Yield (sid, seq) tuples from a (possibly compressed) fasta file,
+    like util.iter_fst: sid includes the '>' and multi-line sequences
+    are joined.
+    """
+    sid = None
+    seq = []
+    with open_fasta(fname, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('>'):
+                if sid is not None:
+                    yield sid, ''.join(seq)
+                sid = line
+                seq = []
+            elif line:
+                seq.append(line)
+    if sid is not None:
+        yield sid, ''.join(seq)
+
+
+def iter_blocks(fname, chunksize=4 << 20):
+    """
+    Yield blocks of about chunksize characters of whole lines from a
+    (possibly compressed) file. Every block ends with a newline.
+    """
+    with open_fasta(fname, 'r') as f:
+        while True:
+            lines = f.readlines(chunksize)
+            if not lines:
+                break
+            block = ''.join(lines)
+            if not block.endswith('\n'):
+                block += '\n'
+            yield block
+
+
+def _block_worker(block_fun, tasks, blocks):
+    """
+    Run block_fun on each task until a None task, putting the blocks it
+    yields on the blocks queue. Puts None when done, or an Exception
+    if something went wrong.
+    """
+    try:
+        for task in iter(tasks.get, None):
+            for block in block_fun(*task):
+                blocks.put(block)
+    except Exception as e:
+        blocks.put(Exception('{}: {}'.format(type(e).__name__, e)))
+    blocks.put(None)
+
+
+def iter_blocks_parallel(block_fun, tasks, processes=1, poll=5.0):
+    """
+    Yield the blocks from block_fun(*task) for every task, running the
+    tasks in worker processes.
+
+    Blocks from different tasks are interleaved in the order they're
+    ready. Only a few blocks per worker are held at once, so memory
+    doesn't depend on file size. With processes=1, tasks run in this
+    process, in order.
+
+    Parameters
+    ----------
+    block_fun : function
+        module-level generator function
+    tasks : list of tuples
+        arguments for block_fun
+    processes : int
+        number of worker processes
+    poll : float
+        seconds between checks that the workers are still alive. A worker
+        that dies without finishing (e.g. killed for running out of
+        memory) raises a RuntimeError rather than hanging.
+    """
+    if processes <= 1:
+        for task in tasks:
+            for block in block_fun(*task):
+                yield block
+        return
+
+    task_queue = multiprocessing.Queue()
+    blocks = multiprocessing.Queue(maxsize=4 * processes)
+    workers = [multiprocessing.Process(target=_block_worker, args=(block_fun, task_queue, blocks))
+               for _ in range(processes)]
+    for task in tasks:
+        task_queue.put(task)
+    for _ in workers:
+        task_queue.put(None)
+    for w in workers:
+        w.start()
+
+    try:
+        finished = 0
+        missing = False
+        while finished < len(workers):
+            try:
+                block = blocks.get(timeout=poll)
+            except queue.Empty:
+                crashed = [w.exitcode for w in workers if w.exitcode]
+                if crashed:
+                    raise RuntimeError('worker exited with code {}'.format(crashed[0]))
+                # A worker that exited normally has sent its None, so if it
+                # still hasn't arrived after another poll it never will
+                exited = sum(1 for w in workers if w.exitcode is not None)
+                if exited > finished and missing:
+                    raise RuntimeError('worker exited without finishing')
+                missing = exited > finished
+                continue
+            missing = False
+            if block is None:
+                finished += 1
+            elif isinstance(block, Exception):
+                raise block
+            else:
+                yield block
+    finally:
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+            w.join()
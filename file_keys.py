@@ -0,0 +1,78 @@
+"""
+Content keys for deciding whether something derived from a file is
+still up to date.
+
+A key records a file's size, mtime and sha1. Checking a key compares
+size and mtime first, and only hashes the file if the mtime changed
+(e.g. the file was copied or touched but not modified), so checking an
+unchanged file is just a stat.
+"""
+import os
+import json
+import hashlib
+
+
+def sha1sum(fname, blocksize=1 << 20):
+    """Hex sha1 digest of a file's contents."""
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_key(fname):
+    """
+    Return {'source', 'size', 'mtime', 'sha1'} for fname.
+    """
+    st = os.stat(fname)
+    return {'source': os.path.abspath(fname), 'size': st.st_size,
+            'mtime': st.st_mtime, 'sha1': sha1sum(fname)}
+
+
+def read_key(key_file):
+    """Read a key written by write_key, or return None if there isn't a valid one."""
+    try:
+        with open(key_file, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_key(key_file, key):
+    with open(key_file, 'w') as f:
+        json.dump(key, f)
+
+
+def matches(fname, key):
+    """
+    Check whether fname still has the contents recorded in key. If only
+    its mtime changed, key['mtime'] is updated in place.
+    """
+    if key is None or not os.path.exists(fname):
+        return False
+    st = os.stat(fname)
+    if st.st_size != key['size']:
+        return False
+    if st.st_mtime == key['mtime']:
+        return True
+    if sha1sum(fname) != key['sha1']:
+        return False
+    key['mtime'] = st.st_mtime
+    return True
+
+
+def is_current(fname, key_file):
+    """
+    Check fname against the key stored in key_file, refreshing the
+    stored mtime if the contents are unchanged.
+    """
+    key = read_key(key_file)
+    if key is None:
+        return False
+    mtime = key['mtime']
+    if not matches(fname, key):
+        return False
+    if key['mtime'] != mtime:
+        write_key(key_file, key)
+    return True
@@ -0,0 +1,334 @@
+"""
+Download and process datasets to raw_trimmed fastas, several at a time.
+
+This does what the -f loop in download_and_process_datasets.sh did, one
+dataset after another, for every dataset in the S3 file at once (-n at a
+time). Each dataset gets its own workspace in the scratch directory
+instead of sharing tmp_data/:
+
+1. download the dataset's directory from the data store, and its summary
+   file from the summary store, into scratch/bucket/
+1. update the summary file with update_summary_file.py
+1. run Master.py on scratch/bucket/
+1. move proc_dir/dataset_proc_16S/dataset.raw_trimmed.fasta to
+   data/raw_trimmed/ and get the dataset's metadata into data/metadata/
+1. delete the workspace and Master.py's proc and results folders
+
+Master.py already writes to per-dataset folders (~/proc/dataset_proc_16S
+and ~/processing_results/dataset_results), so runs don't collide there.
+
+Concurrency is limited by
+    -n           datasets in progress at once
+    --cpus       CPUs for Master.py runs, each taking --cpus_per_dataset
+    --downloads  downloads at once (they share disk and network)
+    --min_free_gb  free space to leave on the scratch disk: a download
+                 waits for other datasets to finish (and clean up) until
+                 there's this much, and fails if none are left to wait on
+
+Stores are given as s3://bucket/prefix (fetched with the aws cli) or as a
+local directory laid out the same way, e.g. to test without S3:
+
+    python ingest.py S3_V4_datasets.txt --data_store test/data \\
+        --summary_store test/summary_files --metadata_store test/metadata_files \\
+        --trimmed_dir test/raw_trimmed --metadata_dir test/metadata
+
+Each dataset's output goes to logs/bucket.log in the scratch directory.
+A failed dataset doesn't stop the others; they're listed at the end.
+"""
+import os
+import sys
+import time
+import shlex
+import shutil
+import argparse
+import threading
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import job_runner
+import instrument
+
+DATA_STORE = 's3://mbit.storage.bucket1'
+SUMMARY_STORE = 's3://almlab.bucket/duvallet/summary_files'
+METADATA_STORE = 's3://almlab.bucket/duvallet/metadata_files'
+SCRATCH_DIR = 'tmp_data'
+TRIMMED_DIR = 'data/raw_trimmed'
+METADATA_DIR = 'data/metadata'
+UPDATE_SUMMARY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'update_summary_file.py')
+
+
+def _run(argv, log):
+    """Run argv with its output going to log, raising JobFailed if it fails."""
+    log.write('$ {}\n'.format(' '.join(argv)))
+    log.flush()
+    returncode = subprocess.call(argv, stdout=log, stderr=subprocess.STDOUT)
+    if returncode != 0:
+        raise job_runner.JobFailed(' '.join(argv[:2]), returncode)
+
+
+class S3Store(object):
+    """Objects under an s3://bucket/prefix URL, fetched with the aws cli."""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def fetch_dir(self, prefix, dest, log):
+        """Copy everything under prefix into directory dest."""
+        _run(['aws', 's3', 'cp', self.url + '/' + prefix, dest, '--recursive', '--quiet'], log)
+
+    def fetch_file(self, key, dest, log):
+        """Copy object key to file (or directory) dest."""
+        _run(['aws', 's3', 'cp', self.url + '/' + key, dest, '--quiet'], log)
+
+
+class LocalStore(object):
+    """Objects in a local directory, laid out like the S3 store."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def fetch_dir(self, prefix, dest, log):
+        src = os.path.join(self.root, prefix)
+        if not os.path.isdir(src):
+            raise IOError('{} does not exist'.format(src))
+        for dirpath, _, fnames in os.walk(src):
+            out_dir = os.path.join(dest, os.path.relpath(dirpath, src))
+            if not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+            for f in fnames:
+                shutil.copy(os.path.join(dirpath, f), out_dir)
+
+    def fetch_file(self, key, dest, log):
+        shutil.copy(os.path.join(self.root, key), dest)
+
+
+def open_store(location):
+    """S3Store for s3:// URLs, LocalStore for anything else."""
+    if location.startswith('s3://'):
+        return S3Store(location)
+    return LocalStore(location)
+
+
+class Budget(object):
+    """A number of slots (e.g. CPUs) that jobs take some of while they run."""
+
+    def __init__(self, total):
+        self.total = max(1, total)
+        self.used = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def take(self, n=1):
+        n = min(n, self.total)
+        with self._cond:
+            while self.used + n > self.total:
+                self._cond.wait()
+            self.used += n
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.used -= n
+                self._cond.notify_all()
+
+
+def summary_dataset(summary_file):
+    """Dataset ID from a summary file (the second field of its first line)."""
+    with open(summary_file, 'r') as f:
+        return f.readline().rstrip('\n').split('\t')[1].strip()
+
+
+class Ingest(object):
+    """
+    Downloads and processes datasets, several at a time.
+
+    Parameters
+    ----------
+    data_store, summary_store, metadata_store : S3Store or LocalStore
+    scratch_dir : str
+        where each dataset's workspace (and log) goes
+    trimmed_dir, metadata_dir : str
+        where raw_trimmed fastas and metadata files end up
+    master : list
+        command to run Master.py, without the -i argument
+    proc_dir, results_dir : str
+        where Master.py writes dataset_proc_16S/ and dataset_results/
+    cpus, cpus_per_dataset, downloads, min_free_gb
+        budgets (see the module docstring)
+    """
+
+    def __init__(self, data_store, summary_store, metadata_store, scratch_dir=SCRATCH_DIR,
+                 trimmed_dir=TRIMMED_DIR, metadata_dir=METADATA_DIR, master=None,
+                 proc_dir='~/proc', results_dir='~/processing_results', cpus=None,
+                 cpus_per_dataset=1, downloads=2, min_free_gb=0):
+        self.data_store = data_store
+        self.summary_store = summary_store
+        self.metadata_store = metadata_store
+        self.scratch_dir = scratch_dir
+        self.trimmed_dir = trimmed_dir
+        self.metadata_dir = metadata_dir
+        self.master = master or ['python', os.path.expanduser('~/scripts/Master.py')]
+        self.proc_dir = os.path.expanduser(proc_dir)
+        self.results_dir = os.path.expanduser(results_dir)
+        self.cpus = Budget(cpus or job_runner.default_procs())
+        self.cpus_per_dataset = cpus_per_dataset
+        self.downloads = Budget(downloads)
+        self.min_free = min_free_gb * (1 << 30)
+        # Datasets that have fetched their data and not cleaned it up yet
+        self._holding = 0
+        self._lock = threading.Lock()
+
+    def _wait_for_space(self, log):
+        """
+        Wait until scratch_dir has min_free_gb free. Fails if no other
+        dataset holds data that would free space when it's done.
+        """
+        while shutil.disk_usage(self.scratch_dir).free < self.min_free:
+            with self._lock:
+                holding = self._holding
+            if holding == 0:
+                raise IOError('less than {:.1f} GB free in {}'.format(self.min_free / float(1 << 30),
+                                                                       self.scratch_dir))
+            log.write('Waiting for disk space\n')
+            log.flush()
+            time.sleep(10)
+
+    def dataset(self, bucket):
+        """
+        Download and process one dataset. Returns its dataset ID.
+        Raises an exception if any step fails.
+        """
+        workspace = os.path.join(self.scratch_dir, bucket)
+        log_dir = os.path.join(self.scratch_dir, 'logs')
+        if os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        os.makedirs(workspace)
+        holding = False
+        try:
+            with open(os.path.join(log_dir, bucket + '.log'), 'w') as log:
+                with self.downloads.take():
+                    self._wait_for_space(log)
+                    with instrument.stage('fetch', outputs=[workspace], bucket=bucket):
+                        self.data_store.fetch_dir(bucket, workspace, log)
+                        summary = os.path.join(workspace, 'summary_file.txt')
+                        self.summary_store.fetch_file(bucket + '.summary_file.txt', summary, log)
+                    with self._lock:
+                        self._holding += 1
+                    holding = True
+
+                _run(['python', UPDATE_SUMMARY, summary], log)
+                dataset = summary_dataset(summary)
+
+                with self.cpus.take(self.cpus_per_dataset):
+                    with instrument.stage('master', inputs=[workspace], dataset=dataset):
+                        _run(self.master + ['-i', os.path.abspath(workspace) + '/'], log)
+
+                proc = os.path.join(self.proc_dir, dataset + '_proc_16S')
+                with instrument.stage('collect', dataset=dataset):
+                    shutil.move(os.path.join(proc, dataset + '.raw_trimmed.fasta'),
+                                os.path.join(self.trimmed_dir, dataset + '.raw_trimmed.fasta'))
+                    self.metadata_store.fetch_file(dataset + '.metadata.txt', self.metadata_dir, log)
+                shutil.rmtree(proc)
+                results = os.path.join(self.results_dir, dataset + '_results')
+                if os.path.exists(results):
+                    shutil.rmtree(results)
+            return dataset
+        finally:
+            shutil.rmtree(workspace, ignore_errors=True)
+            if holding:
+                with self._lock:
+                    self._holding -= 1
+
+    def run(self, buckets, max_datasets=None, log=sys.stdout):
+        """
+        Ingest buckets, at most max_datasets at a time.
+
+        Returns
+        -------
+        failed : list
+            (bucket, error) for the datasets that failed
+        """
+        for d in (self.scratch_dir, os.path.join(self.scratch_dir, 'logs'),
+                  self.trimmed_dir, self.metadata_dir):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        max_datasets = max_datasets or len(buckets) or 1
+        failed = []
+        starts = {}
+        with ThreadPoolExecutor(max_workers=max_datasets) as pool:
+            futures = {}
+            for bucket in buckets:
+                futures[pool.submit(self._timed, bucket, starts, log)] = bucket
+            for future in as_completed(futures):
+                bucket = futures[future]
+                try:
+                    dataset = future.result()
+                    log.write('Finished {} ({}) in {:.1f} s\n'.format(bucket, dataset,
+                                                                   time.time() - starts[bucket]))
+                except Exception as e:
+                    failed.append((bucket, e))
+                    log.write('Failed {}: {}: {}\n'.format(bucket, type(e).__name__, e))
+                log.flush()
+        return failed
+
+    def _timed(self, bucket, starts, log):
+        starts[bucket] = time.time()
+        log.write('Starting {}\n'.format(bucket))
+        log.flush()
+        return self.dataset(bucket)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bucket_file', help='file with one data store directory (dataset) per line, '
+                        + 'e.g. S3_V4_datasets.txt')
+    parser.add_argument('-n', help='maximum number of datasets to ingest at once (default: all of them)',
+                        type=int, default=None)
+    parser.add_argument('--cpus', help='CPUs to share between Master.py runs (default: number of CPUs)',
+                        type=int, default=None)
+    parser.add_argument('--cpus_per_dataset', help='CPUs each Master.py run uses (default: 1)',
+                        type=int, default=1)
+    parser.add_argument('--downloads', help='maximum number of downloads at once (default: 2)',
+                        type=int, default=2)
+    parser.add_argument('--min_free_gb', help='free space to keep on the scratch disk (default: 0)',
+                        type=float, default=0)
+    parser.add_argument('--data_store', help='where dataset directories are (default: {})'.format(DATA_STORE),
+                        default=DATA_STORE)
+    parser.add_argument('--summary_store', help='where summary files are (default: {})'.format(SUMMARY_STORE),
+                        default=SUMMARY_STORE)
+    parser.add_argument('--metadata_store', help='where metadata files are '
+                        + '(default: {})'.format(METADATA_STORE), default=METADATA_STORE)
+    parser.add_argument('--scratch_dir', help='directory for per-dataset workspaces and logs '
+                        + '(default: {})'.format(SCRATCH_DIR), default=SCRATCH_DIR)
+    parser.add_argument('--trimmed_dir', help='where raw_trimmed fastas are put '
+                        + '(default: {})'.format(TRIMMED_DIR), default=TRIMMED_DIR)
+    parser.add_argument('--metadata_dir', help='where metadata files are put '
+                        + '(default: {})'.format(METADATA_DIR), default=METADATA_DIR)
+    parser.add_argument('--master', help='command to run Master.py (default: python ~/scripts/Master.py)',
+                        default=None)
+    parser.add_argument('--proc_dir', help='where Master.py writes dataset_proc_16S/ (default: ~/proc)',
+                        default='~/proc')
+    parser.add_argument('--results_dir', help='where Master.py writes dataset_results/ '
+                        + '(default: ~/processing_results)', default='~/processing_results')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure_from_args(args)
+
+    with open(args.bucket_file, 'r') as f:
+        buckets = [l.strip() for l in f if l.strip()]
+
+    ingest = Ingest(open_store(args.data_store), open_store(args.summary_store),
+                    open_store(args.metadata_store), scratch_dir=args.scratch_dir,
+                    trimmed_dir=args.trimmed_dir, metadata_dir=args.metadata_dir,
+                    master=shlex.split(args.master) if args.master else None,
+                    proc_dir=args.proc_dir, results_dir=args.results_dir, cpus=args.cpus,
+                    cpus_per_dataset=args.cpus_per_dataset, downloads=args.downloads,
+                    min_free_gb=args.min_free_gb)
+    start = time.time()
+    with instrument.stage('ingest', records=len(buckets)):
+        failed = ingest.run(buckets, args.n)
+    print('Ingested {} of {} datasets in {:.1f} s'.format(len(buckets) - len(failed), len(buckets),
+                                                          time.time() - start))
+    if failed:
+        sys.exit('Failed: {}'.format(', '.join(b for b, _ in failed)))
@@ -0,0 +1,174 @@
+"""
+Per-stage timing, throughput and memory logging for the processing scripts.
+
+Wrap each stage of a script in a stage() block:
+
+    with instrument.stage('parse_clustering_results', inputs=[cluster_file]) as s:
+        clusters = parse_clustering_results(cluster_file)
+        s.records = len(clusters)
+
+When the block exits, one JSON line is appended to the metrics file:
+
+    script, stage, pid, start (unix time), seconds,
+    records, records_per_second (if the stage set records),
+    input_bytes, output_bytes (sizes of the declared input and output files),
+    read_bytes, write_bytes (I/O done by this process during the stage,
+        from /proc/self/io, where available),
+    max_rss_mb (peak resident memory of this process so far),
+    children_max_rss_mb (largest peak of any finished child process),
+    error (if the stage raised an exception),
+    and any extra fields given to stage()
+
+With a profile directory set, each stage is also run under cProfile and
+its stats are written to profile_dir/script.stage.pid.N.prof (look at them
+with python -m pstats, or snakeviz). Only this process is profiled, not
+pool workers or subprocesses. For a sampling profile of a whole run, run
+the script under py-spy instead.
+
+Nothing is logged unless a metrics file is set, either with --metrics
+(see add_arguments) or the PIPELINE_METRICS environment variable, and
+likewise for --profile / PIPELINE_PROFILE. configure() exports both, so
+scripts started by another script (e.g. derep_engine.py from
+dereplicate_individual_datasets.py) log to the same file.
+"""
+import os
+import sys
+import json
+import time
+import resource
+import itertools
+
+METRICS_ENV = 'PIPELINE_METRICS'
+PROFILE_ENV = 'PIPELINE_PROFILE'
+
+_config = {'metrics': os.environ.get(METRICS_ENV) or None,
+           'profile': os.environ.get(PROFILE_ENV) or None}
+# Numbers profile files, since a process can run the same stage more than once
+_profile_count = itertools.count()
+
+
+def configure(metrics=None, profile=None):
+    """
+    Set the metrics file and profile directory (None leaves them as they
+    are), and export them to child processes.
+    """
+    if metrics is not None:
+        _config['metrics'] = metrics
+        os.environ[METRICS_ENV] = metrics
+    if profile is not None:
+        _config['profile'] = profile
+        os.environ[PROFILE_ENV] = profile
+        if not os.path.isdir(profile):
+            os.makedirs(profile)
+
+
+def add_arguments(parser):
+    """Add --metrics and --profile options to an argparse parser."""
+    parser.add_argument('--metrics', help='append per-stage timings and memory use to this file, '
+                        + 'as JSON lines', default=None)
+    parser.add_argument('--profile', help='write a cProfile of each stage to this directory', default=None)
+
+
+def configure_from_args(args):
+    configure(args.metrics, args.profile)
+
+
+def _io_counters():
+    """(read_bytes, write_bytes) for this process, or None if unavailable."""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            fields = dict(line.split(':') for line in f)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def _max_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def _files_size(fnames):
+    return sum(os.path.getsize(f) for f in fnames if os.path.isfile(f))
+
+
+def _script_name():
+    return os.path.basename(sys.argv[0]) or 'python'
+
+
+class stage(object):
+    """
+    Context manager that times a stage and logs its metrics on exit.
+
+    Parameters
+    ----------
+    name : str
+        stage name
+    inputs, outputs : list of str
+        files the stage reads and writes; their sizes are logged
+    records : int
+        number of records processed, if known up front. Can also be set
+        on the stage object inside the block.
+    extra
+        other fields to log with the stage (e.g. dataset='crc_baxter')
+    """
+
+    def __init__(self, name, inputs=(), outputs=(), records=None, **extra):
+        self.name = name
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.records = records
+        self.extra = extra
+        self.seconds = None
+        self._profiler = None
+
+    def __enter__(self):
+        self._io = _io_counters()
+        if _config['profile'] is not None:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.time() - self._start
+        if self._profiler is not None:
+            self._profiler.disable()
+            fname = '{}.{}.{}.{}.prof'.format(_script_name(), self.name.replace(os.sep, '_'),
+                                              os.getpid(), next(_profile_count))
+            self._profiler.dump_stats(os.path.join(_config['profile'], fname))
+        if _config['metrics'] is not None:
+            log(self.metrics(exc_value))
+        return False
+
+    def metrics(self, error=None):
+        """The stage's metrics, as a dict."""
+        m = {'script': _script_name(), 'stage': self.name, 'pid': os.getpid(),
+             'start': self._start, 'seconds': self.seconds, 'records': self.records,
+             'records_per_second': (self.records / self.seconds
+                                    if self.records is not None and self.seconds > 0 else None),
+             'input_bytes': _files_size(self.inputs), 'output_bytes': _files_size(self.outputs),
+             'read_bytes': None, 'write_bytes': None,
+             'max_rss_mb': _max_rss_mb(resource.RUSAGE_SELF),
+             'children_max_rss_mb': _max_rss_mb(resource.RUSAGE_CHILDREN)}
+        m.update(self.extra)
+        io = _io_counters()
+        if io is not None and self._io is not None:
+            m['read_bytes'] = io[0] - self._io[0]
+            m['write_bytes'] = io[1] - self._io[1]
+        if error is not None:
+            m['error'] = '{}: {}'.format(type(error).__name__, error)
+        return m
+
+
+def log(record):
+    """Append one JSON line to the metrics file."""
+    # One write per line, so lines from concurrent processes don't interleave
+    line = json.dumps(record, sort_keys=True) + '\n'
+    fd = os.open(_config['metrics'], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
@@ -0,0 +1,94 @@
+"""
+Runs external commands with a bounded number of concurrent processes.
+
+Jobs are started in the order given (callers order them largest input
+first, so the long jobs don't end up running alone at the end), at most
+max_procs at a time. Each job's wall time and exit status is printed
+when it finishes, and by default the first non-zero exit terminates
+the remaining jobs and raises JobFailed.
+"""
+import os
+import sys
+import time
+import subprocess
+
+
+class JobFailed(Exception):
+    """Raised when a job exits with a non-zero status."""
+
+    def __init__(self, name, returncode):
+        Exception.__init__(self, '{} exited with status {}'.format(name, returncode))
+        self.name = name
+        self.returncode = returncode
+
+
+def default_procs():
+    """Number of CPUs available to this process."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def run_jobs(jobs, max_procs=None, fail_fast=True, poll_interval=0.5, log=sys.stdout):
+    """
+    Run jobs with at most max_procs running at once.
+
+    Parameters
+    ----------
+    jobs : list of (name, argv) tuples
+        argv is passed to subprocess.Popen without a shell
+    max_procs : int
+        maximum number of concurrent processes. Defaults to the number
+        of available CPUs.
+    fail_fast : bool
+        if True, terminate all running jobs and raise JobFailed as soon
+        as one exits with a non-zero status
+    poll_interval : float
+        seconds between checks on running jobs
+
+    Returns
+    -------
+    results : list of (name, returncode, seconds) tuples
+        in the order jobs finished
+    """
+    if max_procs is None:
+        max_procs = default_procs()
+    max_procs = max(1, max_procs)
+
+    pending = list(jobs)
+    running = []
+    results = []
+
+    try:
+        while pending or running:
+            while pending and len(running) < max_procs:
+                name, argv = pending.pop(0)
+                log.write('Starting {}\n'.format(name))
+                log.flush()
+                running.append((name, subprocess.Popen(argv), time.time()))
+
+            still_running = []
+            for name, proc, start in running:
+                returncode = proc.poll()
+                if returncode is None:
+                    still_running.append((name, proc, start))
+                    continue
+                seconds = time.time() - start
+                results.append((name, returncode, seconds))
+                log.write('Finished {} in {:.1f} s (exit status {})\n'.format(name, seconds, returncode))
+                log.flush()
+                if returncode != 0 and fail_fast:
+                    raise JobFailed(name, returncode)
+            running = still_running
+
+            if running:
+                time.sleep(poll_interval)
+    finally:
+        # Only non-empty if we're bailing out early
+        for name, proc, start in running:
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+
+    return results
@@ -2,13 +2,109 @@
 This script reads in all the OTU tables and metadata files from a folder
 with the clean tables, converts to relative abundance, collapses to genus
 level, relabels sample IDs, and concatenates into bigmeta and bigdf files.
+
+Instead of relative abundance, --normalize can rarefy each sample to
+--depth reads (averaged over --iterations seeded rarefactions), apply
+cumulative sum scaling, or take the centered log-ratio of the genus
+counts (see normalize.py).
+
+Datasets can be read in parallel (-p). The bigdf is concatenated as a
+sparse matrix aligned on a global genus index, and can also be written
+as feather and sparse npz alongside the TSVs.
+
+With --metrics, each step's time, throughput and memory use are
+logged as JSON lines (see instrument.py).
 """
 import feather
+import pyarrow as pa
 import pandas as pd
+import numpy as np
+import scipy.sparse as sp
 import os
 import argparse
+import multiprocessing
+
+import instrument
+import normalize
+from sample_keys import bigdata_label
+from otu_table import write_npz_table, write_tsv_table
+
+TAXONOMIC_LEVELS = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+
+def parse_taxonomy(OTU_IDs):
+    """
+    Splits each OTU ID once and assigns every OTU an integer taxon code
+    at each taxonomic level.
+
+    Parameters
+    ----------
+    OTU_IDs : list
+        Semicolon-delimited taxonomy strings, starting with kingdom level.
+        Unannotated taxonomic levels should end with '__'.
+
+    Returns
+    -------
+    codes : numpy array
+        len(TAXONOMIC_LEVELS) x len(OTU_IDs). codes[i, j] indexes OTU j's
+        taxon at level i into taxa[i], or is -1 if that taxon is unannotated.
+    taxa : list of lists
+        taxa[i] has the taxon names at level i, in order of first appearance
+    """
+    nlevels = len(TAXONOMIC_LEVELS)
+    codes = np.full((nlevels, len(OTU_IDs)), -1, dtype=np.int64)
+    taxa = [[] for _ in range(nlevels)]
+    indices = [{} for _ in range(nlevels)]
 
-import copy
+    for j, OTU_ID in enumerate(OTU_IDs):
+        levels = OTU_ID.split(';')
+        for i in range(nlevels):
+            taxon = ';'.join(levels[:i+1])
+            # Unannotated taxa are discarded
+            if taxon.endswith('__'):
+                continue
+            try:
+                codes[i, j] = indices[i][taxon]
+            except KeyError:
+                codes[i, j] = indices[i][taxon] = len(taxa[i])
+                taxa[i].append(taxon)
+
+    return codes, taxa
+
+def _collapse_codes(OTU_table, codes, taxa):
+    """
+    Sums the columns of OTU_table into taxa with one sparse indicator-matrix
+    multiply. codes and taxa are one level of parse_taxonomy's output.
+    """
+    keep = np.where(codes >= 0)[0]
+    indicator = sp.csr_matrix((np.ones(len(keep)), (keep, codes[keep])),
+                              shape=(len(codes), len(taxa)))
+    # Missing values are skipped, as in DataFrame.sum
+    values = np.nan_to_num(np.asarray(OTU_table.values, dtype=float), nan=0.0)
+    collapsed = np.asarray(indicator.T.dot(values.T).T)
+    return pd.DataFrame(index=OTU_table.index, columns=taxa, data=collapsed)
+
+def collapse_taxonomic_levels(OTU_table, taxonomic_levels=TAXONOMIC_LEVELS):
+    """
+    Collapses OTU table to several taxonomic levels, parsing the OTU
+    taxonomy strings only once.
+
+    Parameters
+    ----------
+    OTU_table : pandas dataframe
+        OTUs in columns, samples in rows, as in collapse_taxonomic_contents_df
+    taxonomic_levels : list
+        levels to collapse to, from TAXONOMIC_LEVELS. Defaults to all of them.
+
+    Returns
+    -------
+    collapsed : dict
+        {taxonomic_level: collapsed dataframe}
+    """
+    codes, taxa = parse_taxonomy(list(OTU_table.columns))
+    return {level: _collapse_codes(OTU_table,
+                                   codes[TAXONOMIC_LEVELS.index(level)],
+                                   taxa[TAXONOMIC_LEVELS.index(level)])
+            for level in taxonomic_levels}
 
 def collapse_taxonomic_contents_df(OTU_table, taxonomic_level):
     """
@@ -35,88 +131,242 @@ def collapse_taxonomic_contents_df(OTU_table, taxonomic_level):
         Matching values (for annotated taxa) are summed for each sample.
         Values corresponding to unannotated taxa are discarded.
     """
+    return collapse_taxonomic_levels(OTU_table, [taxonomic_level])[taxonomic_level]
+
+def normalize_counts(df, method='relative', depth=None, iterations=1, rng=None):
+    """
+    Normalizes an OTU count table (samples in rows).
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        counts, OTUs in columns, samples in rows
+    method : str
+        relative: divide each sample by its total
+        rarefy: subsample each sample to depth reads, iterations times,
+            and average. Samples with fewer reads are dropped.
+        css: cumulative sum scaling
+        clr: nothing here, the centered log-ratio is taken after
+            collapsing and concatenating all datasets, since log-ratios
+            can't be summed into genera and need the same genera in
+            every sample
+    rng : numpy.random.Generator
+        for rarefying
+
+    Returns
+    -------
+    df : pandas dataframe
+    """
+    if method == 'relative':
+        return df.divide(df.sum(axis=1), axis=0)
+    if method == 'clr':
+        return df
+    counts = sp.csr_matrix(np.nan_to_num(np.asarray(df.values, dtype=float), nan=0.0))
+    index = df.index
+    if method == 'rarefy':
+        rarefied, kept = normalize.rarefy(counts, depth, iterations, rng)
+        counts = sum(rarefied[1:], rarefied[0].astype(float)) / float(iterations)
+        index = df.index[kept]
+    elif method == 'css':
+        counts = normalize.css(counts)
+    else:
+        raise ValueError('Unknown normalization: {}'.format(method))
+    return pd.DataFrame(index=index, columns=df.columns, data=counts.toarray())
 
-    OTU_IDs = list(OTU_table.columns)
-
-    # Collapse to the right level
-    if(taxonomic_level == "kingdom"):
-        OTU_taxa = [OTU_ID.split(';')[0] for OTU_ID in OTU_IDs]
-    if(taxonomic_level == "phylum"):
-        OTU_taxa = [';'.join(OTU_ID.split(';')[:2]) for OTU_ID in OTU_IDs]
-    if(taxonomic_level == "class"):
-        OTU_taxa = [';'.join(OTU_ID.split(';')[:3]) for OTU_ID in OTU_IDs]
-    if(taxonomic_level == "order"):
-        OTU_taxa = [';'.join(OTU_ID.split(';')[:4]) for OTU_ID in OTU_IDs]
-    if(taxonomic_level == "family"):
-        OTU_taxa = [';'.join(OTU_ID.split(';')[:5]) for OTU_ID in OTU_IDs]
-    if(taxonomic_level == "genus"):
-        OTU_taxa = [';'.join(OTU_ID.split(';')[:6]) for OTU_ID in OTU_IDs]
-    if(taxonomic_level == "species"):
-        OTU_taxa = [';'.join(OTU_ID.split(';')[:7]) for OTU_ID in OTU_IDs]
-
-    # Get indices of each unique taxon
-    taxa_indices = {}
-    for i in range(len(OTU_taxa)):
-        if (OTU_taxa[i] not in taxa_indices) and (OTU_taxa[i][(len(OTU_taxa[i])-2):] != "__"):
-            taxa_indices[OTU_taxa[i]] = []
-        if (OTU_taxa[i][(len(OTU_taxa[i])-2):] != "__"):
-            taxa_indices[OTU_taxa[i]].append(i)
-    # Make new empty df with the same samples as original df and taxa in taxa_indices.keys()
-    newdf = pd.DataFrame(index=OTU_table.index, columns=taxa_indices.keys(), data=0)
-
-    # Get sample contents for each taxa of the chosen level and put into newdf
-    for key in taxa_indices:
-        indices = taxa_indices[key]
-        newcol = OTU_table.iloc[:, indices].sum(axis=1)
-        newdf[key] = copy.copy(newcol)
-
-    return newdf
-
-p = argparse.ArgumentParser()
-p.add_argument('clean_dir', help='path to directory with clean '
-    + 'OTU and metadata tables in feather format. Files should be labeled '
-    + ' dataset.otu_table.clean.feather or dataset.metadata.clean.feather.')
-p.add_argument('otu_out', help='file name of output OTU table')
-p.add_argument('meta_out', help='file name of output metadata file')
-args = p.parse_args()
-
-files = os.listdir(args.clean_dir)
-# Files must have feather suffix
-files = [i for i in files if i.endswith('.feather')]
-datasets = list(set([i.split('.')[0] for i in files]))
-
-alldfs = []
-allmetas = []
-
-for d in datasets:
-    print(d)
+def read_clean_dataset(clean_dir, d, method='relative', depth=None, iterations=1, seed=0):
+    """
+    Reads one dataset's clean OTU table and metadata, converts the OTU
+    table to relative abundance (or normalizes it with method, see
+    normalize_counts), collapses it to genus level, and relabels sample
+    IDs to sample/dataset. With method='clr', the genus counts are
+    returned as they are, for taking the CLR of all datasets together.
+
+    Parameters
+    ----------
+    clean_dir : str
+        directory with dataset.otu_table.clean.feather and
+        dataset.metadata.clean.feather
+    d : str
+        dataset ID
+    method, depth, iterations : str, int, int
+        normalization, as in normalize_counts
+    seed : int
+        seed for rarefying, combined with the dataset ID
+
+    Returns
+    -------
+    df, meta : pandas dataframes
+        samples in rows
+    """
     fnotu = d + '.otu_table.clean.feather'
     fnmeta = d + '.metadata.clean.feather'
 
-    df = feather.read_dataframe(os.path.join(args.clean_dir, fnotu))
+    df = feather.read_dataframe(os.path.join(clean_dir, fnotu))
     # Feather format does not support index names, first column has index
     df.index = df.iloc[:,0]
     df = df.iloc[:, 1:]
 
-    meta = feather.read_dataframe(os.path.join(args.clean_dir, fnmeta))
+    meta = feather.read_dataframe(os.path.join(clean_dir, fnmeta))
     meta.index = meta.iloc[:, 0]
     meta = meta.iloc[:, 1:]
 
-    # Convert to relative abundance
-    df = df.divide(df.sum(axis=1), axis=0)
+    # Convert to relative abundance (or normalize otherwise)
+    with instrument.stage('normalize', records=df.shape[0], dataset=d, method=method):
+        df = normalize_counts(df, method, depth, iterations, normalize.dataset_rng(seed, d))
     df = collapse_taxonomic_contents_df(df, 'genus')
 
     # Relabel sample IDs
-    df.index = [str(i) + '/' + d for i in df.index]
-    meta.index = [str(i) + '/' + d for i in meta.index]
+    df.index = [bigdata_label(d, i) for i in df.index]
+    meta.index = [bigdata_label(d, i) for i in meta.index]
+
+    return df, meta
+
+def _read_clean_dataset(job):
+    print(job[1])
+    with instrument.stage('read_clean_dataset', dataset=job[1]) as s:
+        df, meta = read_clean_dataset(*job)
+        s.records = df.shape[0]
+    return df, meta
+
+def read_clean_datasets(clean_dir, datasets, processes=1, method='relative', depth=None,
+                        iterations=1, seed=0):
+    """
+    Reads all datasets with read_clean_dataset, using a pool of
+    processes if processes > 1. Each dataset is normalized with method
+    (see normalize_counts) in the process that reads it.
+
+    Returns
+    -------
+    results : list
+        (df, meta) tuples, in the same order as datasets
+    """
+    jobs = [(clean_dir, d, method, depth, iterations, seed) for d in datasets]
+    if processes == 1 or len(jobs) <= 1:
+        return [_read_clean_dataset(job) for job in jobs]
+    pool = multiprocessing.Pool(min(processes, len(jobs)))
+    try:
+        return pool.map(_read_clean_dataset, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+def concat_sparse(dfs):
+    """
+    Stacks dataframes with different columns into one sparse matrix.
+    Columns are aligned through a global index of all columns (in order of
+    first appearance, as in pd.concat), and missing values are left as
+    implicit zeros instead of being filled in a dense copy.
+
+    Returns
+    -------
+    table : scipy.sparse.csr_matrix
+        rows of all dfs, stacked in order
+    index : list
+        row labels
+    columns : list
+        column labels
+    """
+    columns = {}
+    for df in dfs:
+        for c in df.columns:
+            columns.setdefault(c, len(columns))
+
+    rows, cols, data = [], [], []
+    index = []
+    for df in dfs:
+        values = np.nan_to_num(np.asarray(df.values, dtype=float), nan=0.0)
+        block = sp.coo_matrix(values)
+        colmap = np.array([columns[c] for c in df.columns], dtype=np.int64)
+        rows.append(block.row + len(index))
+        cols.append(colmap[block.col] if len(block.col) else block.col)
+        data.append(block.data)
+        index.extend(df.index)
+
+    table = sp.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                          shape=(len(index), len(columns)))
+    return table, index, list(columns)
+
+def write_feather(df, fname):
+    """
+    Writes df to feather, with the index in the first column (which is
+    how the rest of these scripts read feather files back in).
+    """
+    df = df.reset_index()
+    # Feather needs a single type per column
+    for c in df.columns[df.dtypes == object]:
+        df[c] = df[c].where(df[c].isnull(), df[c].astype(str))
+    feather.write_dataframe(df, fname)
+
+def write_sparse_feather(table, index, columns, fname, chunksize=4096):
+    """
+    Writes a sparse table to feather like write_feather, chunksize rows at
+    a time, so only that many rows are ever dense in memory.
+    """
+    table = sp.csr_matrix(table)
+    schema = pa.schema([('index', pa.string())] + [(str(c), pa.float64()) for c in columns])
+    with pa.OSFile(fname, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+        for start in range(0, table.shape[0], chunksize):
+            block = table[start:start + chunksize].toarray()
+            arrays = [pa.array([str(i) for i in index[start:start + chunksize]], pa.string())]
+            arrays.extend(pa.array(block[:, j]) for j in range(block.shape[1]))
+            writer.write_batch(pa.record_batch(arrays, schema=schema))
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument('clean_dir', help='path to directory with clean '
+        + 'OTU and metadata tables in feather format. Files should be labeled '
+        + ' dataset.otu_table.clean.feather or dataset.metadata.clean.feather.')
+    p.add_argument('otu_out', help='file name of output OTU table')
+    p.add_argument('meta_out', help='file name of output metadata file')
+    p.add_argument('-p', help='number of datasets to read in parallel (default: 1)', type=int, default=1)
+    p.add_argument('--feather', help='also write otu_out.feather and meta_out.feather',
+        action='store_true', default=False)
+    p.add_argument('--npz', help='also write the OTU table in sparse npz format to this file', default=None)
+    p.add_argument('--normalize', help='normalization before collapsing to genus: relative abundance, '
+        + 'rarefy (to --depth), css (cumulative sum scaling) or clr (centered log-ratio, of the genus '
+        + 'counts) (default: relative)', choices=normalize.METHODS, default='relative')
+    p.add_argument('--depth', help='reads per sample to rarefy to (samples with fewer are dropped)',
+        type=int, default=None)
+    p.add_argument('--iterations', help='number of rarefactions to average (default: 1)', type=int, default=1)
+    p.add_argument('--seed', help='random seed for rarefying (default: 0)', type=int, default=0)
+    instrument.add_arguments(p)
+    args = p.parse_args()
+    instrument.configure_from_args(args)
+    if args.normalize == 'rarefy' and args.depth is None:
+        p.error('--normalize rarefy needs --depth')
+
+    files = os.listdir(args.clean_dir)
+    # Files must have feather suffix
+    files = [i for i in files if i.endswith('.feather')]
+    datasets = sorted(set([i.split('.')[0] for i in files]))
+
+    with instrument.stage('read_clean_datasets', inputs=[os.path.join(args.clean_dir, f) for f in files],
+                          records=len(datasets)):
+        results = read_clean_datasets(args.clean_dir, datasets, processes=args.p, method=args.normalize,
+                                      depth=args.depth, iterations=args.iterations, seed=args.seed)
+    alldfs = [r[0] for r in results]
+    allmetas = [r[1] for r in results]
 
-    alldfs.append(df)
-    allmetas.append(meta)
+    with instrument.stage('concat') as s:
+        bigdf, samples, genera = concat_sparse(alldfs)
+        bigmeta = pd.concat(allmetas, axis=0)
+        s.records = len(samples)
 
-bigdf = pd.concat(alldfs, axis=0)
-bigmeta = pd.concat(allmetas, axis=0)
+    if args.normalize == 'clr':
+        # Over the global genus index, so genera a dataset doesn't have
+        # count as zero reads (then get the pseudocount) like any other
+        with instrument.stage('clr', records=len(samples)):
+            bigdf = sp.csr_matrix(normalize.clr(bigdf))
 
-bigdf = bigdf.fillna(0.0)
+    with instrument.stage('write_tables', outputs=[args.otu_out, args.meta_out], records=len(samples)):
+        write_tsv_table(args.otu_out, bigdf, samples, genera)
+        bigmeta.to_csv(args.meta_out, sep='\t')
 
-bigdf.to_csv(args.otu_out, sep='\t')
-bigmeta.to_csv(args.meta_out, sep='\t')
+    if args.npz is not None:
+        with instrument.stage('write_npz', outputs=[args.npz], records=bigdf.nnz):
+            write_npz_table(args.npz, bigdf, samples, genera)
+    if args.feather:
+        with instrument.stage('write_feather', outputs=[args.otu_out + '.feather', args.meta_out + '.feather'],
+                              records=len(samples)):
+            write_sparse_feather(bigdf, samples, genera, args.otu_out + '.feather')
+            write_feather(bigmeta, args.meta_out + '.feather')
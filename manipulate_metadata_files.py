@@ -5,44 +5,146 @@ Check that there are no duplicate samples across all studies.
     Print error if there is (but don't fix it... TBD how to do that)
 Concatenate all metadata files into one large metadata file.
 Write that file.
+
+With --compact, also write a feather copy of the concatenated metadata
+with low-cardinality text columns stored as categoricals, which loads
+much faster than re-parsing the (mostly empty) TSV.
 """
 
 import pandas as pd
 import os
 import argparse
 
-parser = argparse.ArgumentParser()
-parser.add_argument('in_dir', help='directory with all metadata files to be read')
-parser.add_argument('out_dir', help='directory to write big metadata file to')
-parser.add_argument('out_file', help='output file name')
-args = parser.parse_args()
-
-files = os.listdir(args.in_dir)
-
-all_metas = []
-all_samples = {}
-for f in files:
-    df = pd.read_csv(os.path.join(args.in_dir, f), sep='\t', index_col=0)
-    # metadata files are named dataset_id.metadata.txt
-    dataset = f.split('.')[0]
-    df['dataset_id'] = dataset
-    df.index = [dataset + '--' + str(i) for i in df.index]
-    all_samples[f.split('.')[0]] = list(df.index)
-    all_metas.append(df)
-
-# Check if any two datasets overlap samples
-datasets = all_samples.keys()
-for d1 in datasets:
-    for d2 in datasets[datasets.index(d1)+1:]:
-        common_samples = [i for i in all_samples[d1] if i in all_samples[d2]]
-        if len(common_samples) > 0:
-            print('WARNING: {} and {} have {} overlapping sample IDs'.format(d1, d2, len(common_samples)))
-
-# Concatenate all metadata and write to file
-all_metas_df = pd.concat(all_metas)
-
-# Rename the index to match what will be in the pipeline OTU table
-all_metas_df.index = [''.join(i.split('_')) for i in all_metas_df.index]
-
-# Write metadata file
-all_metas_df.to_csv(os.path.join(args.out_dir, args.out_file), sep='\t')
+import feather
+
+from sample_keys import sample_label, metadata_label
+
+def read_metadata(fname):
+    """
+    Reads a tab-separated metadata file. Some files aren't UTF-8
+    (e.g. crc_zeller), so fall back to latin-1 for those.
+    """
+    try:
+        return pd.read_csv(fname, sep='\t', index_col=0, low_memory=False)
+    except UnicodeDecodeError:
+        return pd.read_csv(fname, sep='\t', index_col=0, low_memory=False, encoding='latin-1')
+
+def find_duplicates(all_samples):
+    """
+    Finds sample IDs that appear more than once, in one pass over all
+    samples.
+
+    Parameters
+    ----------
+    all_samples : dict
+        {dataset: list of sample IDs}
+
+    Returns
+    -------
+    duplicates : dict
+        {sample ID: list of datasets it's in}, for every sample ID that is
+        in more than one dataset (or more than once in the same dataset)
+    """
+    seen = {}
+    for dataset in all_samples:
+        for sample in all_samples[dataset]:
+            seen.setdefault(sample, []).append(dataset)
+    return {s: seen[s] for s in seen if len(seen[s]) > 1}
+
+def report_duplicates(duplicates, what='sample IDs'):
+    """
+    Prints a warning for each pair of datasets that share sample IDs.
+    """
+    pairs = {}
+    for sample in duplicates:
+        datasets = sorted(duplicates[sample])
+        for i in range(len(datasets)):
+            for d2 in datasets[i+1:]:
+                pairs[(datasets[i], d2)] = pairs.get((datasets[i], d2), 0) + 1
+    for (d1, d2) in sorted(pairs):
+        if d1 == d2:
+            print('WARNING: {} has {} duplicated {}'.format(d1, pairs[(d1, d2)], what))
+        else:
+            print('WARNING: {} and {} have {} overlapping {}'.format(d1, d2, pairs[(d1, d2)], what))
+
+def compact_metadata(df, max_category_fraction=0.5):
+    """
+    Converts text columns with few distinct values to categoricals.
+
+    Parameters
+    ----------
+    df : pandas dataframe
+    max_category_fraction : float
+        text columns whose number of distinct values is at most this
+        fraction of their non-empty values are made categorical
+
+    Returns
+    -------
+    df : pandas dataframe
+        copy of df with categorical columns. Columns with mixed types are
+        converted to strings (empty values stay missing) first, since
+        columnar formats need one type per column.
+    """
+    df = df.copy()
+    text_columns = df.select_dtypes(exclude=['number', 'bool', 'category', 'datetime']).columns
+    for c in text_columns:
+        col = df[c]
+        notnull = col.notnull()
+        col = col.where(~notnull, col.astype(str))
+        nvalues = notnull.sum()
+        if nvalues == 0 or col.nunique() <= max_category_fraction * nvalues:
+            col = col.astype('category')
+        df[c] = col
+    return df
+
+def write_compact(df, fname):
+    """
+    Writes a compact_metadata copy of df to feather, with the sample IDs
+    in the first column. Mostly-empty columns cost little in feather, since
+    missing values are stored as a bitmap and columns are compressed.
+    """
+    df = compact_metadata(df)
+    df.index.name = 'index'
+    feather.write_dataframe(df.reset_index(), fname, compression='zstd')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('in_dir', help='directory with all metadata files to be read')
+    parser.add_argument('out_dir', help='directory to write big metadata file to')
+    parser.add_argument('out_file', help='output file name')
+    parser.add_argument('--compact', help='also write a compact feather copy to out_file.feather',
+                        action='store_true', default=False)
+    args = parser.parse_args()
+
+    files = sorted(os.listdir(args.in_dir))
+
+    all_metas = []
+    all_samples = {}
+    orig_samples = {}
+    for f in files:
+        df = read_metadata(os.path.join(args.in_dir, f))
+        # metadata files are named dataset_id.metadata.txt
+        dataset = f.split('.')[0]
+        df['dataset_id'] = dataset
+        orig_samples[dataset] = [str(i) for i in df.index]
+        df.index = [sample_label(dataset, i) for i in df.index]
+        all_samples[dataset] = list(df.index)
+        all_metas.append(df)
+
+    # Check if any two datasets overlap samples
+    report_duplicates(find_duplicates(orig_samples))
+
+    # Concatenate all metadata and write to file
+    all_metas_df = pd.concat(all_metas)
+
+    # Rename the index to match what will be in the pipeline OTU table
+    all_metas_df.index = [metadata_label(i) for i in all_metas_df.index]
+
+    # Removing underscores can make two samples' IDs identical
+    renamed = {d: [metadata_label(i) for i in all_samples[d]] for d in all_samples}
+    report_duplicates(find_duplicates(renamed), 'sample IDs after removing underscores')
+
+    # Write metadata file
+    all_metas_df.to_csv(os.path.join(args.out_dir, args.out_file), sep='\t')
+    if args.compact:
+        write_compact(all_metas_df, os.path.join(args.out_dir, args.out_file + '.feather'))
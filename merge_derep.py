@@ -0,0 +1,140 @@
+"""
+Merge each dataset's dereplicated reads into the master dereplication
+map and fasta, without concatenating and re-dereplicating them.
+
+Each dataset's raw_dereplicated.fasta is first written out as a "run":
+its sequences sorted, one per line as
+
+    sequence    origID    size
+
+Runs are kept in runs_dir next to a key of the fasta they came from
+(see file_keys.py), so when a dataset is added or reprocessed only that
+dataset's run is rebuilt. The runs are then merged in one streaming
+pass (a k-way merge on sequence), which writes
+
+    master map:   seqID    origID--dataset-id;size=N:1 origID--dataset-id;size=M:1
+    master fasta: >seqID;size=N+M
+                  SEQUENCE
+
+i.e. the same files that dereplicating the concatenated *.relabeled
+fastas with -M 1 would give (in sequence order rather than size order;
+update_concated_derep_fasta.py does the sorting for usearch).
+"""
+import os
+import heapq
+import argparse
+import itertools
+
+import file_keys
+from fasta_io import iter_fasta
+
+
+def dataset_label(dataset):
+    """Datasets are labeled with dashes in the master map, e.g. crc-baxter"""
+    return '-'.join(dataset.split('_'))
+
+
+def write_run(fasta, run_file):
+    """
+    Write a dataset's dereplicated sequences, sorted by sequence, to run_file.
+    """
+    records = []
+    for sid, seq in iter_fasta(fasta):
+        # sid is something like >444;size=8
+        orig, size = sid[1:].split(';size=')
+        records.append((seq, orig, size.rstrip(';')))
+    records.sort()
+
+    tmp = run_file + '.tmp'
+    with open(tmp, 'w', buffering=1 << 20) as f:
+        for seq, orig, size in records:
+            f.write(seq + '\t' + orig + '\t' + size + '\n')
+    os.rename(tmp, run_file)
+
+
+def update_run(fasta, dataset, runs_dir):
+    """
+    Return the run file for a dataset's fasta, rebuilding it only if
+    the fasta changed since it was last written.
+    """
+    run_file = os.path.join(runs_dir, dataset + '.run')
+    key_file = run_file + '.key.json'
+    if os.path.exists(run_file) and file_keys.is_current(fasta, key_file):
+        return run_file
+
+    print('Sorting {}'.format(fasta))
+    key = file_keys.file_key(fasta)
+    write_run(fasta, run_file)
+    file_keys.write_key(key_file, key)
+    return run_file
+
+
+def iter_run(run_file, label):
+    """Yield (seq, label, origID, size) from a run file."""
+    with open(run_file, 'r') as f:
+        for line in f:
+            seq, orig, size = line.rstrip('\n').split('\t')
+            yield seq, label, orig, size
+
+
+def merge_runs(runs, map_file, fasta_file):
+    """
+    K-way merge sorted runs into the master map and fasta.
+
+    Parameters
+    ----------
+    runs : dict
+        {dataset: run_file}
+    map_file, fasta_file : str
+        output master dereplication map and size-summed fasta
+
+    Returns
+    -------
+    nseqs : int
+        number of unique sequences across all datasets
+    """
+    iters = [iter_run(runs[d], dataset_label(d)) for d in sorted(runs)]
+    merged = heapq.merge(*iters, key=lambda r: r[0])
+
+    seqid = 0
+    with open(map_file, 'w', buffering=1 << 20) as map_out, \
+            open(fasta_file, 'w', buffering=1 << 20) as fasta_out:
+        for seq, group in itertools.groupby(merged, key=lambda r: r[0]):
+            seqid += 1
+            members = []
+            total = 0
+            for _, label, orig, size in group:
+                members.append(orig + '--' + label + ';size=' + size + ':1')
+                total += int(size)
+            map_out.write(str(seqid) + '\t' + ' '.join(members) + '\n')
+            fasta_out.write('>' + str(seqid) + ';size=' + str(total) + '\n' + seq + '\n')
+    return seqid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('derep_dir', help='directory with dataset.raw_dereplicated.fasta files')
+    parser.add_argument('runs_dir', help='directory to keep each dataset\'s sorted run in')
+    parser.add_argument('map_out', help='output master dereplication map')
+    parser.add_argument('fasta_out', help='output master raw_dereplicated fasta')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.runs_dir):
+        os.makedirs(args.runs_dir)
+
+    fastas = [i for i in os.listdir(args.derep_dir) if i.endswith('.raw_dereplicated.fasta')]
+    runs = {}
+    for fasta in fastas:
+        dataset = fasta.split('.')[0]
+        runs[dataset] = update_run(os.path.join(args.derep_dir, fasta), dataset, args.runs_dir)
+
+    # Drop runs for datasets that are gone
+    for fname in os.listdir(args.runs_dir):
+        if fname.endswith('.run') and fname[:-len('.run')] not in runs:
+            os.remove(os.path.join(args.runs_dir, fname))
+            if os.path.exists(os.path.join(args.runs_dir, fname + '.key.json')):
+                os.remove(os.path.join(args.runs_dir, fname + '.key.json'))
+
+    print('Merging {} datasets'.format(len(runs)))
+    nseqs = merge_runs(runs, args.map_out, args.fasta_out)
+    print('{} unique sequences'.format(nseqs))
@@ -0,0 +1,170 @@
+"""
+Normalization of OTU count tables (samples in rows, OTUs in columns),
+on whole sparse count matrices at once rather than sample by sample.
+
+    relative_abundance(table)
+        divide each sample by its total
+    rarefy(table, depth, iterations, rng)
+        subsample each sample to depth reads without replacement,
+        any number of times
+    css(table, quantile, scale)
+        cumulative sum scaling, as in metagenomeSeq
+    clr(table, pseudocount)
+        centered log-ratio transform
+
+Rarefaction draws each sample's reads from a multivariate hypergeometric
+distribution, one OTU at a time: the k-th OTU of every sample (and every
+iteration) gets a hypergeometric draw of the reads still to be taken,
+from the reads of that OTU and the ones left after it. Each step is one
+vectorized draw over all samples and iterations, so the number of Python
+steps is the largest number of OTUs in a sample, not samples x iterations.
+"""
+import zlib
+
+import numpy as np
+import scipy.sparse as sp
+
+METHODS = ['relative', 'rarefy', 'css', 'clr']
+
+
+def dataset_rng(seed, dataset):
+    """
+    Random generator for one dataset, seeded from seed and the dataset
+    ID, so results don't depend on which process reads which dataset.
+    """
+    return np.random.default_rng([seed, zlib.crc32(dataset.encode('utf-8'))])
+
+
+def _counts(table):
+    """table as a CSR matrix of whole-number counts, with no explicit zeros."""
+    table = sp.csr_matrix(table, dtype=np.float64)
+    table.sum_duplicates()
+    table.eliminate_zeros()
+    if not np.all(np.mod(table.data, 1) == 0):
+        raise ValueError('table has fractional counts')
+    return sp.csr_matrix((table.data.astype(np.int64), table.indices, table.indptr), shape=table.shape)
+
+
+def relative_abundance(table):
+    """Each sample divided by its total (samples with no reads stay zero)."""
+    table = sp.csr_matrix(table, dtype=np.float64)
+    totals = np.asarray(table.sum(axis=1)).ravel()
+    scale = np.divide(1.0, totals, out=np.zeros_like(totals), where=totals > 0)
+    return sp.csr_matrix(sp.diags(scale).dot(table))
+
+
+def rarefy(table, depth, iterations=1, rng=None):
+    """
+    Subsample every sample to depth reads, without replacement.
+
+    Parameters
+    ----------
+    table : scipy.sparse matrix or numpy array
+        counts, samples in rows
+    depth : int
+        reads to keep per sample. Samples with fewer reads are dropped.
+    iterations : int
+        number of independent rarefactions
+    rng : numpy.random.Generator
+        source of randomness (e.g. from dataset_rng), for reproducible
+        results. A fresh unseeded one is used if None.
+
+    Returns
+    -------
+    rarefied : list of scipy.sparse.csr_matrix
+        one table per iteration, with the kept samples in rows
+    kept : numpy array
+        row numbers (in table) of the kept samples
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    table = _counts(table)
+    totals = np.asarray(table.sum(axis=1)).ravel()
+    kept = np.flatnonzero(totals >= depth)
+    sub = table[kept]
+    reps = sp.vstack([sub] * iterations, format='csr') if iterations > 1 else sub
+    nrows = reps.shape[0]
+
+    data = reps.data
+    nnz = np.diff(reps.indptr)
+    row_of = np.repeat(np.arange(nrows), nnz)
+    # Position of each entry within its row, and entries grouped by position
+    pos = np.arange(len(data)) - reps.indptr[row_of]
+    by_pos = np.argsort(pos, kind='stable')
+    bounds = np.searchsorted(pos[by_pos], np.arange(nnz.max() + 1 if nrows else 1))
+
+    left = np.tile(totals[kept], iterations)
+    to_draw = np.full(nrows, depth, dtype=np.int64)
+    out = np.zeros(len(data), dtype=np.int64)
+    for k in range(len(bounds) - 1):
+        entries = by_pos[bounds[k]:bounds[k + 1]]
+        rows = row_of[entries]
+        good = data[entries]
+        draw = to_draw[rows]
+        active = draw > 0
+        x = np.zeros(len(entries), dtype=np.int64)
+        if active.any():
+            x[active] = rng.hypergeometric(good[active], left[rows[active]] - good[active], draw[active])
+        out[entries] = x
+        to_draw[rows] -= x
+        left[rows] -= good
+
+    rarefied = []
+    per_iteration = len(kept)
+    for i in range(iterations):
+        start, end = reps.indptr[i * per_iteration], reps.indptr[(i + 1) * per_iteration]
+        t = sp.csr_matrix((out[start:end], reps.indices[start:end],
+                           reps.indptr[i * per_iteration:(i + 1) * per_iteration + 1] - start),
+                          shape=(per_iteration, table.shape[1]))
+        t.eliminate_zeros()
+        rarefied.append(t)
+    return rarefied, kept
+
+
+def css(table, quantile=0.5, scale=1000):
+    """
+    Cumulative sum scaling (Paulson et al. 2013): divide each sample by
+    the sum of its counts up to the given quantile of its nonzero counts,
+    and multiply by scale.
+
+    Returns
+    -------
+    normalized : scipy.sparse.csr_matrix
+    """
+    table = _counts(table)
+    nnz = np.diff(table.indptr)
+    row_of = np.repeat(np.arange(table.shape[0]), nnz)
+    # Each row's nonzero counts in increasing order
+    order = np.lexsort((table.data, row_of))
+    values = table.data[order].astype(np.float64)
+
+    # Quantile of each row's nonzero counts, interpolated like np.quantile
+    # (R's default, which metagenomeSeq uses)
+    starts = table.indptr[:-1]
+    has = nnz > 0
+    where = (nnz[has] - 1) * quantile
+    lo = np.floor(where).astype(np.int64)
+    hi = np.minimum(lo + 1, nnz[has] - 1)
+    frac = where - lo
+    q = np.zeros(table.shape[0])
+    q[has] = (values[starts[has] + lo] * (1 - frac) + values[starts[has] + hi] * frac)
+
+    below = table.data <= q[row_of]
+    sums = np.bincount(row_of[below], weights=table.data[below], minlength=table.shape[0])
+    factor = np.divide(scale, sums, out=np.zeros_like(sums), where=sums > 0)
+    return sp.csr_matrix(sp.diags(factor).dot(table.astype(np.float64)))
+
+
+def clr(table, pseudocount=1.0):
+    """
+    Centered log-ratio transform: log(x + pseudocount) minus the mean of
+    the sample's logs over all OTUs. The result is dense.
+
+    Returns
+    -------
+    transformed : numpy array
+    """
+    if sp.issparse(table):
+        table = table.toarray()
+    logs = np.log(np.asarray(table, dtype=np.float64) + pseudocount)
+    return logs - logs.mean(axis=1, keepdims=True)
@@ -0,0 +1,242 @@
+"""
+Sparse OTU table construction and I/O.
+
+The combined OTU table is mostly zeros (most OTUs are only found in
+a handful of datasets), so it is accumulated as (sample, OTU, count)
+triplets and converted to a scipy CSR matrix with samples in rows
+and OTUs in columns, i.e. the same orientation as the TSV that
+reprovenance_all_files.py has always written.
+
+Tables can be written to disk either as a compressed npz file (which
+keeps the sample and OTU labels alongside the CSR arrays) or as a TSV,
+and read back from either. To read parts of a table without loading all
+of it, write it to a table store (see table_store.py).
+"""
+from array import array
+
+import numpy as np
+import scipy.sparse as sp
+
+
+class SparseTableBuilder(object):
+    """
+    Accumulates counts into integer-indexed sample and OTU axes.
+
+    Sample and OTU labels are assigned integer indices in the order
+    they are first seen. Counts are stored as COO triplets, and
+    duplicate (sample, OTU) entries are summed when the table is
+    converted to CSR.
+    """
+
+    def __init__(self):
+        self.sample_index = {}
+        self.sample_ids = []
+        self.otu_index = {}
+        self.otu_ids = []
+
+        # Triplets from scalar adds go into typed buffers, bulk adds
+        # are kept as a list of array chunks
+        self._rows = array('q')
+        self._cols = array('q')
+        self._data = array('d')
+        self._chunks = []
+
+    def _sample(self, sample):
+        try:
+            return self.sample_index[sample]
+        except KeyError:
+            i = self.sample_index[sample] = len(self.sample_ids)
+            self.sample_ids.append(sample)
+            return i
+
+    def _otu(self, otu):
+        try:
+            return self.otu_index[otu]
+        except KeyError:
+            i = self.otu_index[otu] = len(self.otu_ids)
+            self.otu_ids.append(otu)
+            return i
+
+    def add(self, sample, otu, count):
+        """
+        Add count to the (sample, otu) cell.
+        """
+        self._rows.append(self._sample(sample))
+        self._cols.append(self._otu(otu))
+        self._data.append(count)
+
+    def add_counts(self, otu, counts):
+        """
+        Add a {sample: count} dictionary (e.g. the output of
+        collapse_derep_map) to the given OTU's column.
+        """
+        col = self._otu(otu)
+        for sample in counts:
+            self._rows.append(self._sample(sample))
+            self._cols.append(col)
+            self._data.append(counts[sample])
+
+    def add_block(self, samples, rows, otus, cols, counts):
+        """
+        Add a block of triplets that are indexed against local label lists.
+
+        Parameters
+        ----------
+        samples : list
+            sample labels that rows index into
+        rows : array-like of int
+            index into samples for each count
+        otus : list
+            OTU labels that cols index into
+        cols : array-like of int
+            index into otus for each count
+        counts : array-like
+            counts, same length as rows and cols
+        """
+        sample_map = np.array([self._sample(s) for s in samples], dtype=np.int64)
+        otu_map = np.array([self._otu(o) for o in otus], dtype=np.int64)
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        self._chunks.append((sample_map[rows] if len(rows) else rows,
+                             otu_map[cols] if len(cols) else cols,
+                             np.asarray(counts, dtype=np.float64)))
+
+    @property
+    def nnz(self):
+        """Number of triplets accumulated so far (before duplicates are summed)."""
+        return len(self._data) + sum(len(c[2]) for c in self._chunks)
+
+    def tocsr(self):
+        """
+        Convert the accumulated triplets to a CSR matrix.
+
+        Returns
+        -------
+        table : scipy.sparse.csr_matrix
+            samples in rows, OTUs in columns
+        sample_ids : list
+            row labels
+        otu_ids : list
+            column labels
+        """
+        rows = [np.frombuffer(self._rows, dtype=np.int64)] + [c[0] for c in self._chunks]
+        cols = [np.frombuffer(self._cols, dtype=np.int64)] + [c[1] for c in self._chunks]
+        data = [np.frombuffer(self._data, dtype=np.float64)] + [c[2] for c in self._chunks]
+
+        shape = (len(self.sample_ids), len(self.otu_ids))
+        table = sp.coo_matrix((np.concatenate(data),
+                               (np.concatenate(rows), np.concatenate(cols))),
+                              shape=shape).tocsr()
+        table.sum_duplicates()
+        return table, list(self.sample_ids), list(self.otu_ids)
+
+
+def write_npz_table(fname, table, sample_ids, otu_ids):
+    """
+    Write a sparse table and its labels to a compressed npz file.
+
+    Parameters
+    ----------
+    fname : str
+        output file name (numpy appends .npz if it's missing)
+    table : scipy.sparse matrix
+        samples in rows, OTUs in columns
+    sample_ids, otu_ids : list
+        row and column labels
+    """
+    table = sp.csr_matrix(table)
+    np.savez_compressed(fname,
+                        data=table.data,
+                        indices=table.indices,
+                        indptr=table.indptr,
+                        shape=np.array(table.shape),
+                        sample_ids=np.array(sample_ids, dtype=str),
+                        otu_ids=np.array(otu_ids, dtype=str))
+
+
+def read_npz_table(fname):
+    """
+    Read a table written by write_npz_table.
+
+    Returns
+    -------
+    table : scipy.sparse.csr_matrix
+        samples in rows, OTUs in columns
+    sample_ids, otu_ids : list
+        row and column labels
+    """
+    with np.load(fname) as npz:
+        table = sp.csr_matrix((npz['data'], npz['indices'], npz['indptr']),
+                              shape=tuple(npz['shape']))
+        sample_ids = npz['sample_ids'].tolist()
+        otu_ids = npz['otu_ids'].tolist()
+    return table, sample_ids, otu_ids
+
+
+def write_tsv_table(fname, table, sample_ids, otu_ids, chunksize=256):
+    """
+    Write a sparse table as a tab-separated file with samples in rows
+    and OTUs in columns. Missing entries are written as 0.
+
+    Rows are densified chunksize at a time, so memory stays bounded
+    by chunksize * number of OTUs regardless of the number of samples.
+    """
+    table = sp.csr_matrix(table)
+    # Write whole-number counts without the trailing .0
+    integral = np.all(np.mod(table.data, 1) == 0)
+    with open(fname, 'w') as f:
+        f.write('\t'.join([''] + [str(o) for o in otu_ids]) + '\n')
+        for start in range(0, table.shape[0], chunksize):
+            block = table[start:start + chunksize].toarray()
+            if integral:
+                block = block.astype(np.int64)
+            lines = [str(sample_ids[start + i]) + '\t' + '\t'.join(map(str, row))
+                     for i, row in enumerate(block.tolist())]
+            f.write('\n'.join(lines) + '\n')
+
+
+def read_tsv_table(fname, chunksize=256):
+    """
+    Read a table written by write_tsv_table (or the original dense
+    TSV, where empty cells are zeros) into a sparse CSR matrix.
+
+    Rows are parsed chunksize at a time and only their nonzero entries
+    are kept, so the dense table is never held in memory.
+
+    Returns
+    -------
+    table : scipy.sparse.csr_matrix
+        samples in rows, OTUs in columns
+    sample_ids, otu_ids : list
+        row and column labels
+    """
+    sample_ids = []
+    blocks = []
+    with open(fname, 'r') as f:
+        otu_ids = f.readline().rstrip('\n').split('\t')[1:]
+        lines = []
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            sample, _, values = line.partition('\t')
+            sample_ids.append(sample)
+            lines.append(values)
+            if len(lines) == chunksize:
+                blocks.append(_parse_tsv_rows(lines, len(otu_ids)))
+                lines = []
+        if lines:
+            blocks.append(_parse_tsv_rows(lines, len(otu_ids)))
+    if blocks:
+        table = sp.vstack(blocks, format='csr')
+    else:
+        table = sp.csr_matrix((0, len(otu_ids)))
+    return table, sample_ids, otu_ids
+
+
+def _parse_tsv_rows(lines, ncols):
+    # The original tables were written with df.to_csv, which leaves missing counts empty
+    block = np.array([v or '0' for v in '\t'.join(lines).split('\t')], dtype=np.float64)
+    if len(block) != len(lines) * ncols:
+        raise ValueError('TSV rows have {} values, expected {} per row'.format(len(block), ncols))
+    return sp.csr_matrix(block.reshape(len(lines), ncols))
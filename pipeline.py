@@ -0,0 +1,360 @@
+"""
+Incremental driver for the processing steps in download_and_process_datasets.sh
+(everything after downloading).
+
+Each step is a Stage: a command plus the files it reads and writes.
+Stages that read another stage's outputs run after it; everything else
+can run at the same time (e.g. concatenating the metadata runs alongside
+dereplication, and the datasets are dereplicated one stage each).
+
+After a stage succeeds, the keys (size, mtime, sha1; see file_keys.py)
+of its inputs and outputs are saved in a state file. A stage is skipped
+if its command, inputs and outputs all still match what was saved, so:
+  - rerunning after adding or reprocessing one dataset only redoes that
+    dataset's dereplication and the stages downstream of it,
+  - a stage whose inputs were rewritten with the same contents (e.g. a
+    merge that gave the same master map) doesn't make its dependents rerun,
+  - after a failure, the stages that finished are recorded, so rerunning
+    picks up where it left off. Stages that don't depend on the failed
+    one are still run to completion.
+
+Usage mirrors download_and_process_datasets.sh, e.g.
+    python pipeline.py -d -c
+dereplicates each dataset, merges them, clusters and reprovenances.
+Use --dry_run to see which stages are out of date.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from collections import namedtuple
+
+import file_keys
+import job_runner
+from dereplicate_individual_datasets import derep_command, derep_outputs
+
+# name : unique stage name
+# argv : command, passed to subprocess.Popen without a shell
+# inputs, outputs : lists of file names
+Stage = namedtuple('Stage', ['name', 'argv', 'inputs', 'outputs'])
+
+METADATA_DIR = 'data/metadata'
+FOR_PIPELINE_DIR = 'data/for_pipeline'
+TRIMMED_DIR = 'data/raw_trimmed'
+DEREP_DIR = 'data/derep_datasets'
+CONCAT_DIR = 'data/derep_concat'
+STATE_FILE = 'data/pipeline_state.json'
+
+
+def stage_dependencies(stages):
+    """
+    Return {stage name: set of names of the stages that write its inputs}.
+    """
+    producers = {}
+    for stage in stages:
+        for f in stage.outputs:
+            if f in producers:
+                raise ValueError('{} is written by both {} and {}'.format(f, producers[f], stage.name))
+            producers[f] = stage.name
+    return {stage.name: set(producers[f] for f in stage.inputs if f in producers)
+            for stage in stages}
+
+
+def read_state(state_file):
+    """{stage name: record} from state_file, or {} if there isn't one."""
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_state(state_file, state):
+    tmp = state_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.rename(tmp, state_file)
+
+
+def stage_record(stage):
+    """
+    Record of a stage that just finished: its command and the keys of
+    all its inputs and outputs.
+    """
+    return {'argv': stage.argv,
+            'inputs': {f: file_keys.file_key(f) for f in stage.inputs},
+            'outputs': {f: file_keys.file_key(f) for f in stage.outputs}}
+
+
+def is_up_to_date(stage, record):
+    """
+    Check whether stage's command, inputs and outputs all match record.
+    Keys of files that were only touched get their mtime refreshed in
+    record, so they aren't hashed again next time.
+    """
+    if record is None or record['argv'] != stage.argv:
+        return False
+    for files, keys in ((stage.inputs, record['inputs']), (stage.outputs, record['outputs'])):
+        if sorted(files) != sorted(keys):
+            return False
+        if not all(file_keys.matches(f, keys[f]) for f in files):
+            return False
+    return True
+
+
+def out_of_date(stages, state, force=()):
+    """
+    Names of the stages that would run: stages that are forced, not up
+    to date, or downstream of one that would run.
+    """
+    deps = stage_dependencies(stages)
+    stale = set()
+    for stage in stages:
+        if (stage.name in force or deps[stage.name] & stale
+                or not is_up_to_date(stage, state.get(stage.name))):
+            stale.add(stage.name)
+    return stale
+
+
+def run_stages(stages, state_file, max_procs=None, force=(), poll_interval=0.5, log=sys.stdout):
+    """
+    Run the stages that aren't up to date, at most max_procs at a time.
+
+    Parameters
+    ----------
+    stages : list of Stage
+        in an order where each stage comes after the stages writing its inputs
+    state_file : str
+        where the record of finished stages is kept
+    max_procs : int
+        maximum number of stages running at once. Defaults to the number
+        of available CPUs.
+    force : collection of str
+        names of stages to run even if they're up to date
+
+    Returns
+    -------
+    results : list of (name, returncode, seconds) tuples
+        for the stages that were run, in the order they finished
+
+    Raises
+    ------
+    job_runner.JobFailed
+        for the first stage that failed, once everything that didn't
+        depend on it has finished
+    """
+    if max_procs is None:
+        max_procs = job_runner.default_procs()
+    max_procs = max(1, max_procs)
+
+    deps = stage_dependencies(stages)
+    state = read_state(state_file)
+    pending = list(stages)
+    running = []
+    done = set()
+    failed = []
+    blocked = set()
+    results = []
+
+    try:
+        while pending or running:
+            for stage in list(pending):
+                if deps[stage.name] & (set(f for f, _ in failed) | blocked):
+                    pending.remove(stage)
+                    blocked.add(stage.name)
+                    log.write('Skipping {} (an earlier stage failed)\n'.format(stage.name))
+                    continue
+                if not deps[stage.name] <= done or len(running) >= max_procs:
+                    continue
+                pending.remove(stage)
+                # Inputs are only checked now, after the stages writing them have run
+                if stage.name not in force and is_up_to_date(stage, state.get(stage.name)):
+                    log.write('Up to date: {}\n'.format(stage.name))
+                    done.add(stage.name)
+                    write_state(state_file, state)
+                    continue
+                missing = [f for f in stage.inputs if not os.path.exists(f)]
+                if missing:
+                    raise IOError('{} is missing input {}'.format(stage.name, missing[0]))
+                # Forget the old record, so a half-finished run is never taken as up to date
+                state.pop(stage.name, None)
+                write_state(state_file, state)
+                log.write('Starting {}\n'.format(stage.name))
+                log.flush()
+                try:
+                    running.append((stage, subprocess.Popen(stage.argv), time.time()))
+                except OSError as e:
+                    log.write('Could not start {}: {}\n'.format(stage.name, e))
+                    failed.append((stage.name, 127))
+
+            still_running = []
+            for stage, proc, start in running:
+                returncode = proc.poll()
+                if returncode is None:
+                    still_running.append((stage, proc, start))
+                    continue
+                seconds = time.time() - start
+                results.append((stage.name, returncode, seconds))
+                log.write('Finished {} in {:.1f} s (exit status {})\n'.format(stage.name, seconds, returncode))
+                log.flush()
+                missing = [f for f in stage.outputs if not os.path.exists(f)]
+                if returncode == 0 and missing:
+                    log.write('{} did not write {}\n'.format(stage.name, missing[0]))
+                    returncode = 1
+                if returncode != 0:
+                    failed.append((stage.name, returncode))
+                    continue
+                state[stage.name] = stage_record(stage)
+                write_state(state_file, state)
+                done.add(stage.name)
+            running = still_running
+
+            if running:
+                time.sleep(poll_interval)
+            elif pending and not any(deps[s.name] <= done or deps[s.name] & (set(f for f, _ in failed) | blocked)
+                                     for s in pending):
+                raise ValueError('Stages {} depend on each other'.format([s.name for s in pending]))
+    finally:
+        # Only non-empty if we're bailing out early
+        for stage, proc, start in running:
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+
+    if failed:
+        raise job_runner.JobFailed(*failed[0])
+    return results
+
+
+def metadata_stages(compact=True):
+    fnames = sorted(os.listdir(METADATA_DIR))
+    out_file = 'all_metadata.txt'
+    argv = ['python', 'manipulate_metadata_files.py', METADATA_DIR + '/', FOR_PIPELINE_DIR + '/', out_file]
+    outputs = [os.path.join(FOR_PIPELINE_DIR, out_file)]
+    if compact:
+        argv.append('--compact')
+        outputs.append(outputs[0] + '.feather')
+    return [Stage('metadata', argv, [os.path.join(METADATA_DIR, f) for f in fnames], outputs)]
+
+
+def derep_stages(external=False):
+    """One stage per dataset, dereplicating its raw_trimmed fasta."""
+    trimmed_fastas = sorted([i for i in os.listdir(TRIMMED_DIR) if i.endswith('.raw_trimmed.fasta')],
+                            key=lambda f: os.path.getsize(os.path.join(TRIMMED_DIR, f)), reverse=True)
+    return [Stage('derep:' + f.split('.')[0], derep_command(TRIMMED_DIR, DEREP_DIR, f, external),
+                  [os.path.join(TRIMMED_DIR, f)], list(derep_outputs(DEREP_DIR, f)))
+            for f in trimmed_fastas]
+
+
+def concat_stages(derep, processes=1, builtin_cluster=False):
+    """
+    Merge, sort, cluster and reprovenance the dereplicated datasets.
+
+    Parameters
+    ----------
+    derep : list of Stage
+        dataset dereplication stages. If empty, the dereplicated datasets
+        already in DEREP_DIR are used.
+    processes : int
+        worker processes for reprovenancing (and clustering)
+    builtin_cluster : bool
+        cluster with cluster_otus.py instead of usearch8
+    """
+    if derep:
+        derep_fastas = sorted(s.outputs[1] for s in derep)
+        map_files = sorted(s.outputs[0] for s in derep)
+    else:
+        files = sorted(os.listdir(DEREP_DIR))
+        derep_fastas = [os.path.join(DEREP_DIR, i) for i in files if i.endswith('.raw_dereplicated.fasta')]
+        map_files = [os.path.join(DEREP_DIR, i) for i in files if i.endswith('.map')]
+
+    prefix = os.path.join(CONCAT_DIR, 'dereped_datasets_concated')
+    derep_map = prefix + '.map'
+    derep_fasta = prefix + '.raw_dereplicated.fasta'
+    sorted_fasta = derep_fasta + '.relabled_and_sorted'
+    otu_seqs_fasta = prefix + '.otu_seqs.fasta'
+    clustering_results = prefix + '.clustering_results.tab'
+    otu_table = 'v4_datasets.otu_table.txt'
+    if builtin_cluster:
+        cluster = ['python', 'cluster_otus.py', sorted_fasta, otu_seqs_fasta, clustering_results,
+                   '--id', '0.97', '-p', str(processes)]
+    else:
+        cluster = ['usearch8', '-cluster_otus', sorted_fasta, '-otus', otu_seqs_fasta,
+                   '-otu_radius_pct', '0.97', '-sizein', '-uparseout', clustering_results]
+
+    return [
+        Stage('merge', ['python', 'merge_derep.py', DEREP_DIR, os.path.join(CONCAT_DIR, 'runs'),
+                        derep_map, derep_fasta],
+              derep_fastas, [derep_map, derep_fasta]),
+        Stage('sort', ['python', 'update_concated_derep_fasta.py', derep_map, derep_fasta, sorted_fasta],
+              [derep_map, derep_fasta], [sorted_fasta]),
+        Stage('cluster', cluster, [sorted_fasta], [otu_seqs_fasta, clustering_results]),
+        Stage('reprovenance', ['python', 'reprovenance_all_files.py', clustering_results, derep_map,
+                               DEREP_DIR, otu_table, '-p', str(processes),
+                               '--cache_dir', os.path.join(CONCAT_DIR, 'map_cache')],
+              [clustering_results, derep_map] + map_files, [otu_table]),
+    ]
+
+
+def pipeline_stages(processes=1):
+    """Relabel and concatenate the raw_trimmed fastas, and run them through the pipeline."""
+    trimmed = sorted(os.path.join(TRIMMED_DIR, i) for i in os.listdir(TRIMMED_DIR)
+                     if i.endswith('.raw_trimmed.fasta'))
+    all_trimmed = os.path.join(FOR_PIPELINE_DIR, 'all_raw_trimmed.fasta')
+    return [
+        Stage('relabel_trimmed', ['python', 'relabel_raw_trimmed.py', TRIMMED_DIR, '-o', all_trimmed,
+                                  '-p', str(processes)],
+              trimmed, [all_trimmed]),
+        # Master.py writes its results outside of this directory
+        Stage('master', ['python', os.path.expanduser('~/scripts/Master.py'), '-i',
+                         os.path.abspath(FOR_PIPELINE_DIR) + '/'],
+              [all_trimmed, os.path.join(FOR_PIPELINE_DIR, 'summary_file.txt')], []),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', help='dereplicate each individual dataset', action='store_true', default=False)
+    parser.add_argument('-c', help='merge the dereplicated datasets, cluster them and reprovenance the '
+                        + 'original reads to make the OTU table', action='store_true', default=False)
+    parser.add_argument('-p', help='relabel and concatenate the raw_trimmed fastas and run them through '
+                        + 'the pipeline', action='store_true', default=False)
+    parser.add_argument('-e', help='dereplicate with ~/scripts/3.dereplicate.py instead of derep_engine.py',
+                        action='store_true', default=False)
+    parser.add_argument('-b', help='cluster with cluster_otus.py instead of usearch8',
+                        action='store_true', default=False)
+    parser.add_argument('-n', help='maximum number of stages to run at once (default: number of CPUs)',
+                        type=int, default=None)
+    parser.add_argument('--state', help='file to record finished stages in (default: {})'.format(STATE_FILE),
+                        default=STATE_FILE)
+    parser.add_argument('--force', help='run this stage even if it is up to date (can be repeated)',
+                        action='append', default=[])
+    parser.add_argument('--dry_run', help='only list the stages that are out of date',
+                        action='store_true', default=False)
+    args = parser.parse_args()
+
+    processes = args.n or job_runner.default_procs()
+    stages = metadata_stages()
+    derep = derep_stages(args.e) if args.d else []
+    stages += derep
+    if args.c:
+        stages += concat_stages(derep, processes, args.b)
+    if args.p:
+        stages += pipeline_stages(processes)
+
+    unknown = set(args.force) - set(s.name for s in stages)
+    if unknown:
+        sys.exit('Unknown stages: {}'.format(', '.join(sorted(unknown))))
+
+    if args.dry_run:
+        stale = out_of_date(stages, read_state(args.state), args.force)
+        for stage in stages:
+            print('{}\t{}'.format(stage.name, 'out of date' if stage.name in stale else 'up to date'))
+        sys.exit(0)
+
+    try:
+        run_stages(stages, args.state, max_procs=args.n, force=args.force)
+    except job_runner.JobFailed as e:
+        sys.exit('Stopped: {}. Rerun to resume from there.'.format(e))
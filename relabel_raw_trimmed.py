@@ -1,21 +1,80 @@
 """
 Relabel sequences in *.raw_trimmed.fasta to have
 datasetID--sampleID_N
+
+By default each file is relabeled into its own *.relabeled copy.
+With -o, all the relabeled files are instead streamed straight into
+one concatenated fasta, so the relabeled copies are never written.
+Inputs and the -o output can be gzip (.gz) or zstandard (.zst)
+compressed. With -p, several datasets are read at once, each by its
+own worker process; records from different datasets are then
+interleaved in the output (in large blocks of whole records).
 """
 
 import os
 import argparse
-import util
 
-parser = argparse.ArgumentParser()
-parser.add_argument('trimmed_dir', help='directory with *.raw_trimmed.fasta files')
-args = parser.parse_args()
+from fasta_io import open_fasta, strip_compression, iter_blocks, iter_blocks_parallel
+
+SUFFIX = '.raw_trimmed.fasta'
+CHUNKSIZE = 4 << 20
+
+
+def trimmed_files(trimmed_dir):
+    """Return {dataset: path} for *.raw_trimmed.fasta(.gz/.zst) files in trimmed_dir."""
+    files = {}
+    for i in os.listdir(trimmed_dir):
+        if strip_compression(i).endswith(SUFFIX):
+            files[i.split('.')[0]] = os.path.join(trimmed_dir, i)
+    return files
+
+
+def relabel_chunks(fname, dataset, chunksize=CHUNKSIZE):
+    """
+    Yield blocks of whole fasta lines from fname with each header
+    changed from >sampleID_N to >dataset--sampleID_N.
+    """
+    prefix = '>' + dataset + '--'
+    for block in iter_blocks(fname, chunksize):
+        # Every block starts at the beginning of a line
+        if block.startswith('>'):
+            block = prefix + block[1:]
+        yield block.replace('\n>', '\n' + prefix)
+
+
+def iter_relabeled(files, processes=1):
+    """
+    Yield relabeled blocks for all files.
+
+    Parameters
+    ----------
+    files : dict
+        {dataset: path}
+    processes : int
+        number of datasets to read at once
+    """
+    datasets = sorted(files, key=lambda d: os.path.getsize(files[d]), reverse=True)
+    tasks = [(files[d], d) for d in datasets]
+    return iter_blocks_parallel(relabel_chunks, tasks, processes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('trimmed_dir', help='directory with *.raw_trimmed.fasta files')
+    parser.add_argument('-o', help='write all relabeled sequences to this one fasta (.gz or .zst to compress) '
+                        + 'instead of writing a .relabeled copy of each file', default=None)
+    parser.add_argument('-p', help='number of datasets to read at once with -o (default: 1)', type=int, default=1)
+    args = parser.parse_args()
 
-files = [os.path.join(args.trimmed_dir, i) for i in os.listdir(args.trimmed_dir) if i.endswith('.raw_trimmed.fasta')]
+    files = trimmed_files(args.trimmed_dir)
 
-for fname in files:
-    dataset = fname.split('/')[-1].split('.')[0]
-    with open(fname + '.relabeled', 'w') as fnew:
-        for sid, seq in util.iter_fst(fname):
-            sid = '>' + dataset + '--' + sid[1:]
-            fnew.write('\n'.join([sid, seq]) + '\n')
+    if args.o is not None:
+        with open_fasta(args.o, 'w', bufsize=CHUNKSIZE) as fout:
+            for block in iter_relabeled(files, args.p):
+                fout.write(block)
+    else:
+        for dataset in files:
+            fname = files[dataset]
+            with open_fasta(strip_compression(fname) + '.relabeled', 'w') as fnew:
+                for block in relabel_chunks(fname, dataset):
+                    fnew.write(block)
@@ -17,10 +17,23 @@ Finally, it parses each individual dataset's original
 dereplication map and uses the above mappings to make a
 {OTU_ID: {dataset--sample1: counts, dataset--sample2: counts}}
 dictionary for each master OTU.
+
+The functions below work on nested dicts and are handy for poking
+at small maps interactively. The __main__ block uses the streaming,
+integer-interned equivalents in derep_maps.py instead, which keep
+every ID as an integer code in numpy arrays.
+
+With --metrics, each step's time, throughput and memory use are
+logged as JSON lines (see instrument.py).
 """
 import os
 import argparse
-import pandas as pd
+
+import derep_maps
+import instrument
+from otu_table import SparseTableBuilder, write_npz_table, write_tsv_table
+from table_store import write_store
+from sample_keys import sample_label
 
 def parse_clustering_results(cluster_file):
     """
@@ -40,20 +53,18 @@ def parse_clustering_results(cluster_file):
     otudict : dict
         {seqID: OTU_ID}
     """
-    with open(cluster_file, 'r') as f:
-        lines = f.readlines()
-
-    lines = [l.strip().split('\t') for l in lines]
     otudict = {}
 
-    for line in lines:
-        seqid = line[0].split(';')[0]
-        if line[1] == 'otu':
-            otuid = seqid
-            otudict[otuid] = [otuid]
-        elif line[1] == 'match':
-            otuid = line[4]
-            otudict[otuid].append(seqid)
+    with open(cluster_file, 'r') as f:
+        for line in f:
+            line = line.strip().split('\t')
+            seqid = line[0].split(';')[0]
+            if line[1] == 'otu':
+                otuid = seqid
+                otudict[otuid] = [otuid]
+            elif line[1] == 'match':
+                otuid = line[4]
+                otudict[otuid].append(seqid)
 
     return otudict
 
@@ -74,15 +85,13 @@ def parse_master_derep_map(derep_map):
         dictionary with {seqID: {dataset: origID, dataset2: origID}}
     """
 
-    with open(derep_map, 'r') as f:
-        lines = f.read().splitlines()
-
     derep_dict = {}
-    for line in lines:
-        line = line.split('\t')
-        seqid = line[0]
-        datasets = {_split_dataset_derep(s): s.split('--')[0] for s in line[1].split(' ')}
-        derep_dict[seqid] = datasets
+    with open(derep_map, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n').split('\t')
+            seqid = line[0]
+            datasets = {_split_dataset_derep(s): s.split('--')[0] for s in line[1].split(' ')}
+            derep_dict[seqid] = datasets
 
     return derep_dict
 
@@ -145,10 +154,8 @@ def parse_one_map_file(map_file):
     """
 
     with open(map_file, 'r') as f:
-        derepmap = f.readlines()
-    derepmap = [l.strip().split('\t') for l in derepmap]
-
-    return {l[0]:  {i.split(':')[0]: i.split(':')[1] for i in l[1].split(' ')} for l in derepmap}
+        derepmap = (l.strip().split('\t') for l in f)
+        return {l[0]:  {i.split(':')[0]: i.split(':')[1] for i in l[1].split(' ')} for l in derepmap}
 
 
 def read_dataset_derep_maps(derep_dir):
@@ -218,7 +225,7 @@ def collapse_derep_map(dataset, list_of_orig_IDs, dataset_derep_map):
                 collapsed[sample] = float(dataset_derep_map[seq][sample])
     
     # Relabel samples (i.e. keys) in collapsed
-    collapsed = {dataset + '--' + k: collapsed[k] for k in collapsed}
+    collapsed = {sample_label(dataset, k): collapsed[k] for k in collapsed}
     return collapsed
 
 
@@ -228,43 +235,57 @@ if __name__ == "__main__":
     parser.add_argument('derep_map', help='dereplication map, indicating which datasets each of the sequences in cluster_file were found in')
     parser.add_argument('derep_dir', help='directory with dataset-wise dereplication maps, labeled datasetID.map')
     parser.add_argument('table_out', help='file name for output OTU table')
+    parser.add_argument('-p', '--processes', help='number of worker processes for reading dataset maps (default: 1)',
+                        type=int, default=1)
+    parser.add_argument('--cache_dir', help='directory to cache parsed dereplication maps in. Cached '
+                        + 'maps are reused as long as the map files are unchanged.', default=None)
+    parser.add_argument('--npz', help='also write the OTU table in sparse npz format to this file', default=None)
+    parser.add_argument('--store', help='also write the OTU table to this table store directory '
+                        + '(see table_store.py)', default=None)
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.configure_from_args(args)
         
-    ## Parse clustering results to {seqID: OTU_ID}
+    # All seqIDs, sample IDs and dataset IDs are interned to integer codes
+    symbols = derep_maps.SymbolTable()
+
+    ## Parse clustering results to seqID --> OTU_ID codes
     print("Parsing clustering results...")
-    otudict = parse_clustering_results(args.cluster_file)
+    with instrument.stage('parse_clustering_results', inputs=[args.cluster_file]) as s:
+        clusters = derep_maps.parse_clustering_results(args.cluster_file, symbols)
+        s.records = len(clusters.seqs)
 
-    ## Get the OTU_ID --> dataset --> original_seq_IDs map
-    # Parse dereplication map to {seqID: {dataset: orig_ID, dataset: orig_ID}}
+    ## Get the seqID --> (dataset, original_seq_ID) map
     print("Parsing master dereplication map..")
-    derepdict = parse_master_derep_map(args.derep_map)
-
-    # Combine these two dicts to get {OTU_ID: {dataset: [list_of_orig_IDS], dataset: [list_orig_IDs]}}
-    derepOTUdict = update_derep_dict(otudict, derepdict)
-
-    ## Convert that dict into one with {OTU_ID: {dataset: {s1: total_otu_counts, s2: total_otu_counts...}}}
-    
-    ## Read in all of the dataset dereplication maps into a dictionary
-    # dataset_maps is {dataset: {seq: {s1: counts, s2: counts}}}
-    print("Reading all dataset dereplication maps...")
-    dataset_maps = read_dataset_derep_maps(args.derep_dir)
-
-    # Use that dict to map each OTU_ID to sample abundances in each dataset
-    # i.e. return {OTU_ID: {dataset--s1: total_counts, dataset--s2: total_counts}}
-    print("Collapsing..."),
-    finaldict = {}
-    for otu in derepOTUdict:
-        for dataset in derepOTUdict[otu]:
-            try:
-                finaldict[otu].update(collapse_derep_map(dataset, 
-                                                         derepOTUdict[otu][dataset], # [list_of_orig_IDS]
-                                                         dataset_maps[dataset])) # {seq: {s1: counts, s2: counts}}
-            except:
-                finaldict[otu] = (collapse_derep_map(dataset, 
-                                                     derepOTUdict[otu][dataset], # [list_of_orig_IDS]
-                                                     dataset_maps[dataset])) # {seq: {s1: counts, s2: counts}}
-
-    # This takes a long time. Is there a better way to save this final dict??
-    df = pd.DataFrame.from_dict(finaldict)
-    df.to_csv(args.table_out, sep='\t')
-
+    with instrument.stage('parse_master_derep_map', inputs=[args.derep_map]) as s:
+        master = derep_maps.cached_parse(args.derep_map, derep_maps.parse_master_derep_map,
+                                         symbols, cache_dir=args.cache_dir)
+        s.records = len(master.seqs)
+
+    ## Parse each dataset's dereplication map (in parallel worker processes),
+    # map its original seqs to OTU_IDs and sum their counts in each sample,
+    # i.e. accumulate (dataset--s1, OTU_ID, total_counts) triplets in a sparse table
+    print("Reading and collapsing all dataset dereplication maps...")
+    builder = SparseTableBuilder()
+    with instrument.stage('collapse_dataset_maps', inputs=derep_maps.derep_map_files(args.derep_dir).values()) as s:
+        for collapsed in derep_maps.collapse_dataset_maps(args.derep_dir, clusters, master,
+                                                          symbols, processes=args.processes,
+                                                          cache_dir=args.cache_dir):
+            print(collapsed.dataset)
+            derep_maps.add_to_table(builder, collapsed, symbols)
+        s.records = builder.nnz
+
+    # Samples in rows, OTUs in columns
+    with instrument.stage('build_table') as s:
+        table, sample_ids, otu_ids = builder.tocsr()
+        s.records = table.nnz
+    print("Writing OTU table ({} samples x {} OTUs, {} nonzero)...".format(
+        table.shape[0], table.shape[1], table.nnz))
+    with instrument.stage('write_table', outputs=[args.table_out], records=table.shape[0]):
+        write_tsv_table(args.table_out, table, sample_ids, otu_ids)
+    if args.npz is not None:
+        with instrument.stage('write_npz', outputs=[args.npz], records=table.nnz):
+            write_npz_table(args.npz, table, sample_ids, otu_ids)
+    if args.store is not None:
+        with instrument.stage('write_store', outputs=[args.store], records=table.nnz):
+            write_store(args.store, table, sample_ids, otu_ids)
@@ -0,0 +1,434 @@
+"""
+Canonical sample keys, for matching samples between the OTU tables and
+the metadata.
+
+Each script labels samples its own way:
+
+    reprovenance_all_files.py   dataset--sample       (sample_label)
+    manipulate_metadata_files.py  datasetsample--sample without any
+                                underscores             (metadata_label)
+    make_bigdata.py             sample/dataset        (bigdata_label)
+
+and they're all built with the functions here. canonical_key turns any of
+them into the same key, datasetid--sampleid, with the dataset ID in lower
+case and underscores (and dashes in the dataset ID) removed, since the
+metadata labels have lost those.
+
+A SampleIndex lists every canonical key with its label in each source
+(e.g. otu_table, metadata), and is written to a TSV so it can be built
+once and reused: labels it already has are looked up rather than parsed
+again. align() is a hash join of two lists of labels, and
+join_table_metadata uses it to return the rows of an OTU table (dense or
+sparse) and a metadata dataframe for the samples that are in both, in
+the same order, along with a MismatchReport of the samples that aren't.
+Both take an optional SampleIndex to get the keys from.
+
+From the command line, join an OTU table (TSV, npz or table store) and a
+metadata file through the index in -i (built, or brought up to date with
+any new labels, if needed), write the mismatch report, and optionally
+write the aligned tables:
+
+    python sample_keys.py v4_datasets.otu_table.txt data/for_pipeline/all_metadata.txt \\
+        -i sample_index.txt -r mismatches.txt
+"""
+import os
+import argparse
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+DATASET_SEP = '--'
+
+
+def sample_label(dataset, sample):
+    """Sample label in the OTU tables: dataset--sample"""
+    return dataset + DATASET_SEP + str(sample)
+
+
+def metadata_label(label):
+    """Label in the concatenated metadata for an OTU table sample label (no underscores)."""
+    return ''.join(label.split('_'))
+
+
+def bigdata_label(dataset, sample):
+    """Sample label in make_bigdata.py's tables: sample/dataset"""
+    return str(sample) + '/' + dataset
+
+
+def split_label(label):
+    """
+    (dataset, sample) from a label of any of the conventions above.
+    dataset--sample labels are split at the first '--', sample/dataset
+    labels at the last '/'.
+    """
+    if DATASET_SEP in label:
+        dataset, sample = label.split(DATASET_SEP, 1)
+        return dataset, sample
+    if '/' in label:
+        sample, dataset = label.rsplit('/', 1)
+        return dataset, sample
+    raise ValueError('{} has no dataset ID'.format(label))
+
+
+def canonical_key(label):
+    """Canonical key (datasetid--sampleid) for a sample label of any convention."""
+    dataset, sample = split_label(label)
+    return (''.join(dataset.replace('-', '_').split('_')).lower() + DATASET_SEP
+            + ''.join(sample.split('_')))
+
+
+def _key_rows(labels, keys=None):
+    """
+    ({key: first row}, keys, duplicates) for labels, where duplicates
+    lists (label, key) of rows whose key was already taken. keys are
+    the labels' canonical keys, if already known.
+    """
+    if keys is None:
+        keys = [canonical_key(str(label)) for label in labels]
+    rows = {}
+    duplicates = []
+    for i, (label, key) in enumerate(zip(labels, keys)):
+        if key in rows:
+            duplicates.append((label, key))
+        else:
+            rows[key] = i
+    return rows, keys, duplicates
+
+
+class MismatchReport(namedtuple('MismatchReport', ['left', 'right', 'matched', 'only_left', 'only_right',
+                                                   'duplicates_left', 'duplicates_right'])):
+    """
+    Samples that did and didn't match in align().
+
+    Attributes
+    ----------
+    left, right : str
+        names of the two sides (e.g. otu_table, metadata)
+    matched : list
+        canonical keys in both
+    only_left, only_right : list
+        labels with no match on the other side
+    duplicates_left, duplicates_right : list
+        (label, key) of labels whose key was already used by another
+        label on the same side (only the first is joined)
+    """
+
+    def by_dataset(self):
+        """
+        {dataset ID: [matched, only left, only right]}, with dataset IDs
+        as in the canonical keys.
+        """
+        counts = {}
+        for i, labels in enumerate([self.matched, self.only_left, self.only_right]):
+            for label in labels:
+                dataset = canonical_key(str(label)).split(DATASET_SEP, 1)[0]
+                counts.setdefault(dataset, [0, 0, 0])[i] += 1
+        return OrderedDict(sorted(counts.items()))
+
+    def __str__(self):
+        lines = ['{} samples in both {} and {}, {} only in {}, {} only in {}'.format(
+            len(self.matched), self.left, self.right, len(self.only_left), self.left,
+            len(self.only_right), self.right)]
+        for side, dups in ((self.left, self.duplicates_left), (self.right, self.duplicates_right)):
+            if dups:
+                lines.append('{} {} labels have the same key as another label'.format(len(dups), side))
+        return '\n'.join(lines)
+
+    def write(self, fname):
+        """
+        Write a per-dataset summary, then every unmatched or duplicated
+        label, as a TSV.
+        """
+        with open(fname, 'w') as f:
+            f.write('dataset\tboth\tonly_{}\tonly_{}\n'.format(self.left, self.right))
+            for dataset, counts in self.by_dataset().items():
+                f.write('{}\t{}\t{}\t{}\n'.format(dataset, *counts))
+            f.write('\nlabel\tkey\tproblem\n')
+            for label in self.only_left:
+                f.write('{}\t{}\tonly in {}\n'.format(label, canonical_key(str(label)), self.left))
+            for label in self.only_right:
+                f.write('{}\t{}\tonly in {}\n'.format(label, canonical_key(str(label)), self.right))
+            for side, dups in ((self.left, self.duplicates_left), (self.right, self.duplicates_right)):
+                for label, key in dups:
+                    f.write('{}\t{}\tduplicate key in {}\n'.format(label, key, side))
+
+
+def align(left_labels, right_labels, left='left', right='right', index=None):
+    """
+    Hash join two lists of sample labels on their canonical keys.
+
+    Parameters
+    ----------
+    left_labels, right_labels : list
+    left, right : str
+        names of the two sides, for the report and for looking up their
+        labels in index
+    index : SampleIndex
+        if given, keys of labels it has for the source named left (or
+        right) are taken from it instead of being parsed
+
+    Returns
+    -------
+    left_rows, right_rows : numpy arrays
+        row numbers in each list of the matched samples, in left order
+    report : MismatchReport
+    """
+    left_keys = right_keys = None
+    if index is not None:
+        left_keys = index.keys_for(left, left_labels)
+        right_keys = index.keys_for(right, right_labels)
+    right_rows, _, right_dups = _key_rows(right_labels, right_keys)
+    left_index, left_keys, left_dups = _key_rows(left_labels, left_keys)
+
+    lrows = []
+    rrows = []
+    only_left = []
+    for i, key in enumerate(left_keys):
+        if left_index[key] != i:
+            # A duplicate, already reported
+            continue
+        j = right_rows.get(key)
+        if j is None:
+            only_left.append(left_labels[i])
+        else:
+            lrows.append(i)
+            rrows.append(j)
+    matched = set(left_index).intersection(right_rows)
+    only_right = [right_labels[j] for j in sorted(j for key, j in right_rows.items() if key not in matched)]
+
+    report = MismatchReport(left, right, [left_keys[i] for i in lrows], only_left, only_right,
+                            left_dups, right_dups)
+    return np.array(lrows, dtype=np.int64), np.array(rrows, dtype=np.int64), report
+
+
+def join_table_metadata(table, sample_ids, metadata, index=None):
+    """
+    The rows of an OTU table and of a metadata dataframe for the samples
+    in both, aligned.
+
+    Parameters
+    ----------
+    table : scipy.sparse matrix, numpy array or pandas dataframe
+        samples in rows
+    sample_ids : list
+        row labels of table (its index, if None and table is a dataframe)
+    metadata : pandas dataframe
+        samples in rows
+    index : SampleIndex
+        index with otu_table and metadata sources to take keys from
+
+    Returns
+    -------
+    table, metadata
+        the matched rows of each, in the same order (sparse tables stay
+        sparse, as CSR)
+    keys : list
+        canonical keys of the rows
+    report : MismatchReport
+    """
+    if sample_ids is None:
+        sample_ids = list(table.index)
+    rows, meta_rows, report = align(list(sample_ids), list(metadata.index), 'otu_table', 'metadata', index)
+    if sp.issparse(table):
+        table = sp.csr_matrix(table)[rows]
+    elif isinstance(table, pd.DataFrame):
+        table = table.iloc[rows]
+    else:
+        table = np.asarray(table)[rows]
+    return table, metadata.iloc[meta_rows], report.matched, report
+
+
+class SampleIndex(object):
+    """
+    Canonical sample keys with their labels in each source.
+
+    Parameters
+    ----------
+    keys : list
+        canonical keys, in order
+    sources : OrderedDict
+        {source name: list of labels, one per key (None if not in it)}
+    """
+
+    def __init__(self, keys=(), sources=()):
+        self.keys = list(keys)
+        self.sources = OrderedDict((name, list(labels)) for name, labels in OrderedDict(sources).items())
+        self.rows = {key: i for i, key in enumerate(self.keys)}
+        self._label_rows = {name: {l: i for i, l in enumerate(labels) if l is not None}
+                            for name, labels in self.sources.items()}
+
+    @classmethod
+    def build(cls, sources):
+        """
+        Index from {source name: list of labels}. Keys are in order of
+        first appearance; if a source has two labels with the same key,
+        the first is kept.
+        """
+        index = cls()
+        for name, labels in sources.items():
+            index.update(name, labels)
+        return index
+
+    def update(self, source, labels):
+        """
+        Add the labels of source that the index doesn't have yet.
+        Returns how many were added (labels whose key the source
+        already has a label for are only remembered until written).
+        """
+        if source not in self.sources:
+            self.sources[source] = [None] * len(self.keys)
+            self._label_rows[source] = {}
+        column = self.sources[source]
+        label_rows = self._label_rows[source]
+        added = 0
+        for label in labels:
+            label = str(label)
+            if label in label_rows:
+                continue
+            key = canonical_key(label)
+            i = self.rows.get(key)
+            if i is None:
+                i = self.rows[key] = len(self.keys)
+                self.keys.append(key)
+                for c in self.sources.values():
+                    c.append(None)
+            if column[i] is None:
+                column[i] = label
+                added += 1
+            label_rows[label] = i
+        return added
+
+    def keys_for(self, source, labels):
+        """
+        Canonical keys of labels, looked up in source's labels (and
+        parsed for any the index doesn't have).
+        """
+        label_rows = self._label_rows.get(source, {})
+        keys = self.keys
+        out = []
+        for label in labels:
+            i = label_rows.get(str(label))
+            out.append(canonical_key(str(label)) if i is None else keys[i])
+        return out
+
+    def __len__(self):
+        return len(self.keys)
+
+    def dataset(self, i):
+        return self.keys[i].split(DATASET_SEP, 1)[0]
+
+    def in_all(self):
+        """Row numbers of the keys that every source has."""
+        have = np.ones(len(self.keys), dtype=bool)
+        for labels in self.sources.values():
+            have &= np.array([l is not None for l in labels], dtype=bool)
+        return np.flatnonzero(have)
+
+    def labels(self, source, rows=None):
+        """Labels in source for rows (default: all), None where missing."""
+        labels = self.sources[source]
+        return list(labels) if rows is None else [labels[i] for i in rows]
+
+    def write(self, fname):
+        """Write as a TSV: key, dataset, then each source's label (empty if missing)."""
+        tmp = fname + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\t'.join(['key', 'dataset'] + list(self.sources)) + '\n')
+            columns = list(self.sources.values())
+            for i, key in enumerate(self.keys):
+                f.write('\t'.join([key, self.dataset(i)] + [c[i] or '' for c in columns]) + '\n')
+        os.rename(tmp, fname)
+
+    @classmethod
+    def read(cls, fname):
+        with open(fname, 'r') as f:
+            names = f.readline().rstrip('\n').split('\t')[2:]
+            keys = []
+            columns = [[] for _ in names]
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                keys.append(fields[0])
+                for c, label in zip(columns, fields[2:]):
+                    c.append(label or None)
+        return cls(keys, OrderedDict(zip(names, columns)))
+
+
+def read_table_samples(fname):
+    """Sample IDs of an OTU table: a TSV (first column), .npz, or table store directory."""
+    if os.path.isdir(fname):
+        from table_store import TableStore
+        return TableStore(fname).sample_ids
+    if fname.endswith('.npz'):
+        with np.load(fname) as npz:
+            return npz['sample_ids'].tolist()
+    with open(fname, 'r') as f:
+        f.readline()
+        return [line.split('\t', 1)[0] for line in f if line.strip()]
+
+
+def read_metadata_table(fname):
+    """Concatenated metadata, from the TSV or its --compact feather copy."""
+    if fname.endswith('.feather'):
+        import feather
+        df = feather.read_dataframe(fname)
+        df.index = df.iloc[:, 0].astype(str)
+        return df.iloc[:, 1:]
+    # Some datasets' metadata isn't UTF-8, as in manipulate_metadata_files.read_metadata
+    try:
+        df = pd.read_csv(fname, sep='\t', index_col=0, low_memory=False)
+    except UnicodeDecodeError:
+        df = pd.read_csv(fname, sep='\t', index_col=0, low_memory=False, encoding='latin-1')
+    df.index = df.index.astype(str)
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('otu_table', help='OTU table: TSV (samples in rows), .npz, or table store directory')
+    parser.add_argument('metadata', help='concatenated metadata (TSV, or its .feather copy)')
+    parser.add_argument('-i', '--index', help='sample index to join through (built, or updated with any '
+                        + 'new labels, and written back)', default=None)
+    parser.add_argument('-r', '--report', help='write the mismatch report to this file', default=None)
+    parser.add_argument('--table_out', help='write the matched OTU table rows to this TSV', default=None)
+    parser.add_argument('--meta_out', help='write the matched metadata rows to this TSV', default=None)
+    args = parser.parse_args()
+
+    metadata = read_metadata_table(args.metadata)
+    index = None
+    if args.index is not None:
+        index = SampleIndex.read(args.index) if os.path.exists(args.index) else SampleIndex()
+
+    if args.table_out is not None:
+        from otu_table import read_npz_table, read_tsv_table, write_tsv_table
+        if os.path.isdir(args.otu_table):
+            from table_store import TableStore
+            store = TableStore(args.otu_table)
+            table, sample_ids, otu_ids = store.rows(range(store.shape[0])), store.sample_ids, store.otu_ids
+        elif args.otu_table.endswith('.npz'):
+            table, sample_ids, otu_ids = read_npz_table(args.otu_table)
+        else:
+            table, sample_ids, otu_ids = read_tsv_table(args.otu_table)
+    else:
+        sample_ids = read_table_samples(args.otu_table)
+    if index is not None:
+        added = index.update('otu_table', sample_ids) + index.update('metadata', metadata.index)
+        if added:
+            index.write(args.index)
+
+    if args.table_out is not None:
+        table, matched_meta, keys, report = join_table_metadata(table, sample_ids, metadata, index)
+        write_tsv_table(args.table_out, table, keys, otu_ids)
+    else:
+        _, meta_rows, report = align(sample_ids, list(metadata.index), 'otu_table', 'metadata', index)
+        matched_meta = metadata.iloc[meta_rows]
+        keys = report.matched
+
+    print(report)
+    if args.meta_out is not None:
+        matched_meta = matched_meta.copy()
+        matched_meta.index = keys
+        matched_meta.to_csv(args.meta_out, sep='\t')
+    if args.report is not None:
+        report.write(args.report)
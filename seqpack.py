@@ -0,0 +1,282 @@
+"""
+Compact keys for DNA sequences.
+
+pack() turns an ACGT sequence into a Python int holding 2 bits per base
+(behind a sentinel so that leading A's aren't lost). The int is about a
+third the size of the equivalent str and is cheap to hash, which makes
+it a good dict key for dereplication. Sequences with any other character
+(N, ambiguity codes, lowercase) are returned unchanged, so keys of the
+two kinds never collide.
+
+PackedSeq and SeqStore keep sequences 2 bits per base for when many of
+them need to be held at once (e.g. a whole dereplicated fasta). Bases
+are packed four to a byte, first base in the high bits. Any other
+character (N, ambiguity codes, lowercase, gaps) is stored as an A in
+the packed bits, plus an "exception": its position and the original
+characters, kept as runs so a stretch of N's costs one entry. So any
+sequence round-trips exactly, and ACGT-only sequences (nearly all of
+them) cost a quarter byte per base.
+
+update_concated_derep_fasta.py buffers the records of its sort runs in a
+SeqStore.
+"""
+from array import array
+
+import numpy as np
+
+from fasta_io import iter_fasta, open_fasta
+
+_TO_DIGITS = str.maketrans('ACGT', '0123')
+_ACGT = frozenset('ACGT')
+_PAIRS = {'00': 'A', '01': 'C', '10': 'G', '11': 'T'}
+
+
+def pack(seq):
+    """
+    Return a compact hashable key for seq. unpack(pack(seq)) == seq.
+    """
+    if not seq or not _ACGT.issuperset(seq):
+        return seq
+    # Leading '1' is a sentinel base-4 digit that records the length
+    return int('1' + seq.translate(_TO_DIGITS), 4)
+
+
+def unpack(key):
+    """
+    Return the sequence for a key made by pack().
+    """
+    if isinstance(key, str):
+        return key
+    # bin(key) is '0b1' followed by 2 bits per base
+    bits = bin(key)[3:]
+    return ''.join([_PAIRS[bits[i:i + 2]] for i in range(0, len(bits), 2)])
+
+
+## 2-bit packed sequences
+
+_CODES = np.full(256, 4, dtype=np.uint8)
+for _i, _base in enumerate(b'ACGT'):
+    _CODES[_base] = _i
+_SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+# Each hex digit of the packed bytes is two bases
+_HEX_TO_BASES = {ord('{:x}'.format(_i)): 'ACGT'[_i >> 2] + 'ACGT'[_i & 3] for _i in range(16)}
+
+
+def encode(seq):
+    """
+    Pack a sequence string.
+
+    Returns
+    -------
+    data : bytes
+        2 bits per base, four bases per byte, unused low bits zero
+    exceptions : tuple
+        (position, chars) for each run of non-ACGT characters
+    """
+    if _ACGT.issuperset(seq):
+        # Same bits as below, without numpy's per-call overhead
+        nbytes = -(-len(seq) // 4)
+        value = int(seq.translate(_TO_DIGITS), 4) << (2 * (4 * nbytes - len(seq))) if seq else 0
+        return value.to_bytes(nbytes, 'big'), ()
+    codes = _CODES[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+    other = codes == 4
+    exceptions = ()
+    if other.any():
+        codes[other] = 0
+        positions = np.flatnonzero(other)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(positions) != 1) + 1))
+        ends = np.concatenate((starts[1:], [len(positions)]))
+        exceptions = tuple((int(positions[a]), seq[positions[a]:positions[b - 1] + 1])
+                           for a, b in zip(starts, ends))
+    padded = np.zeros(-(-len(codes) // 4) * 4, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    data = np.bitwise_or.reduce(padded.reshape(-1, 4) << _SHIFTS, axis=1).astype(np.uint8)
+    return data.tobytes(), exceptions
+
+
+def decode(data, length, exceptions=()):
+    """Unpack a sequence packed by encode()."""
+    seq = bytes(data).hex().translate(_HEX_TO_BASES)[:length]
+    if exceptions:
+        parts = []
+        last = 0
+        for pos, chars in exceptions:
+            parts.append(seq[last:pos])
+            parts.append(chars)
+            last = pos + len(chars)
+        parts.append(seq[last:])
+        seq = ''.join(parts)
+    return seq
+
+
+def _slice_exceptions(exceptions, start, stop):
+    """Exceptions that fall in [start, stop), shifted to start at 0."""
+    sliced = []
+    for pos, chars in exceptions:
+        a, b = max(pos, start), min(pos + len(chars), stop)
+        if a < b:
+            sliced.append((a - start, chars[a - pos:b - pos]))
+    return tuple(sliced)
+
+
+class PackedSeq(object):
+    """
+    An immutable sequence stored 2 bits per base.
+
+    PackedSeqs hash and compare equal by content, so they can be used as
+    dict keys, and support len(), indexing and slicing (slices are also
+    PackedSeqs). str() gives back the original sequence.
+
+    Parameters
+    ----------
+    seq : str
+    """
+    __slots__ = ('_data', '_length', '_exceptions', '_hash')
+
+    def __init__(self, seq=''):
+        self._data, self._exceptions = encode(seq)
+        self._length = len(seq)
+        self._hash = None
+
+    @classmethod
+    def from_packed(cls, data, length, exceptions=()):
+        """Make a PackedSeq from the outputs of encode()."""
+        self = cls.__new__(cls)
+        self._data = bytes(data)
+        self._length = length
+        self._exceptions = tuple(exceptions)
+        self._hash = None
+        return self
+
+    @property
+    def nbytes(self):
+        """Bytes used by the packed bases."""
+        return len(self._data)
+
+    def __len__(self):
+        return self._length
+
+    def __str__(self):
+        return decode(self._data, self._length, self._exceptions)
+
+    def __repr__(self):
+        return 'PackedSeq({!r})'.format(str(self))
+
+    def __eq__(self, other):
+        if not isinstance(other, PackedSeq):
+            return NotImplemented
+        return (self._length == other._length and self._data == other._data
+                and self._exceptions == other._exceptions)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash((self._length, self._data, self._exceptions))
+        return self._hash
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self._length)
+            if step != 1:
+                return PackedSeq(str(self)[i])
+            stop = max(start, stop)
+            if start % 4:
+                return PackedSeq(str(self)[start:stop])
+            # Whole bytes can be copied as they are; then clear the bits past stop
+            data = bytearray(self._data[start // 4:-(-stop // 4)])
+            if stop % 4:
+                data[-1] &= (0xff << (8 - 2 * (stop % 4))) & 0xff
+            return PackedSeq.from_packed(data, stop - start,
+                                         _slice_exceptions(self._exceptions, start, stop))
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError('PackedSeq index out of range')
+        for pos, chars in self._exceptions:
+            if pos <= i < pos + len(chars):
+                return chars[i - pos]
+        return 'ACGT'[(self._data[i // 4] >> (6 - 2 * (i % 4))) & 3]
+
+
+class SeqStore(object):
+    """
+    Append-only list of sequences, packed 2 bits per base into one
+    buffer. Each sequence costs about a quarter byte per base plus 12
+    bytes of offsets, instead of a Python str each.
+
+    store[i] is sequence i as a str, store.packed(i) as a PackedSeq.
+    """
+
+    def __init__(self, seqs=()):
+        self._data = bytearray()
+        self._offsets = array('q', [0])
+        self._lengths = array('I')
+        self._exceptions = {}
+        for seq in seqs:
+            self.append(seq)
+
+    def append(self, seq):
+        """Add a str or PackedSeq and return its index."""
+        if isinstance(seq, PackedSeq):
+            data, length, exceptions = seq._data, seq._length, seq._exceptions
+        else:
+            data, exceptions = encode(seq)
+            length = len(seq)
+        i = len(self._lengths)
+        self._data += data
+        self._offsets.append(len(self._data))
+        self._lengths.append(length)
+        if exceptions:
+            self._exceptions[i] = exceptions
+        return i
+
+    @property
+    def nbytes(self):
+        """Bytes used by the packed bases and offsets."""
+        return (len(self._data) + self._offsets.itemsize * len(self._offsets)
+                + self._lengths.itemsize * len(self._lengths))
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def _parts(self, i):
+        if i < 0:
+            i += len(self)
+        return (bytes(self._data[self._offsets[i]:self._offsets[i + 1]]),
+                self._lengths[i], self._exceptions.get(i, ()))
+
+    def __getitem__(self, i):
+        return decode(*self._parts(i))
+
+    def packed(self, i):
+        return PackedSeq.from_packed(*self._parts(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def read_fasta(fname):
+    """
+    Read a (possibly compressed) fasta into (headers, SeqStore).
+    Headers are without the '>'.
+    """
+    headers = []
+    store = SeqStore()
+    for sid, seq in iter_fasta(fname):
+        headers.append(sid[1:])
+        store.append(seq)
+    return headers, store
+
+
+def write_fasta(fname, headers, store, order=None):
+    """
+    Write headers and the sequences in store to a (possibly compressed)
+    fasta, in the order of the indices in order (default: as stored).
+    """
+    with open_fasta(fname, 'w') as f:
+        for i in (range(len(store)) if order is None else order):
+            f.write('>' + headers[i] + '\n' + store[i] + '\n')
@@ -0,0 +1,288 @@
+"""
+Generate synthetic inputs for every processing step, so the scripts can
+be run and timed without the real S3 data.
+
+Sequences are random 150 bp reads grouped into OTUs (each OTU is a
+centroid plus a few variants with 1-3 mismatches). Each dataset has its
+own subset of the sequences, and each sample draws its reads from a
+skewed (lognormal) abundance distribution, so the outputs have the long
+tail of rare sequences that real data has.
+
+The files written to out_dir have the same names and formats as in data/:
+
+    raw_trimmed/dataset.raw_trimmed.fasta     >sample_N reads
+    derep_datasets/dataset.map                seqID    sample:count sample:count
+    derep_datasets/dataset.raw_dereplicated.fasta
+    derep_concat/dereped_datasets_concated.map
+                                              seqID    origID--dataset-id;size=N:1 ...
+    derep_concat/dereped_datasets_concated.raw_dereplicated.fasta
+    derep_concat/dereped_datasets_concated.clustering_results.tab
+                                              usearch -uparseout table
+    metadata/dataset.metadata.txt             mostly-empty metadata columns
+    clean/dataset.otu_table.clean.feather     OTUs (with taxonomy) in columns
+    clean/dataset.metadata.clean.feather
+
+The derep files are what derep_engine.py (-M 10) and merge_derep.py give
+for the raw reads. Sizes scale linearly with scale: the number of samples
+and of unique sequences are both multiplied by it. A manifest.json with
+the paths and record counts is written to out_dir.
+"""
+import os
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from make_bigdata import TAXONOMIC_LEVELS, write_feather
+
+# Sizes at scale 1
+DEFAULTS = {'datasets': 4, 'samples': 10, 'reads': 400, 'otus': 100, 'variants': 5,
+            'length': 150, 'min_count': 10, 'metadata_columns': 20}
+
+CLUSTER_PREFIX = 'dereped_datasets_concated'
+
+
+def make_sequences(rng, notus, variants, length):
+    """
+    Return (seqs, seq_otus): a list of sequence strings and the index of
+    each sequence's OTU. The first sequence of each OTU is its centroid.
+    """
+    centroids = rng.randint(0, 4, size=(notus, length)).astype(np.uint8)
+    codes = np.repeat(centroids, variants, axis=0)
+    seq_otus = np.repeat(np.arange(notus), variants)
+    for i in range(len(codes)):
+        if i % variants == 0:
+            continue
+        pos = rng.choice(length, rng.randint(1, 4), replace=False)
+        codes[i, pos] = (codes[i, pos] + rng.randint(1, 4, len(pos))) % 4
+    letters = np.frombuffer(b'ACGT', dtype=np.uint8)[codes]
+    seqs = [row.tobytes().decode('ascii') for row in letters]
+    return seqs, seq_otus
+
+
+def make_taxonomy(rng, notus):
+    """
+    Return a taxonomy string (k__...;s__) for each OTU. Genera nest in
+    families and so on, and some OTUs are unannotated below some level.
+    """
+    ngenera = max(5, int(np.sqrt(notus) * 3))
+    genera = rng.randint(0, ngenera, notus)
+    depth = rng.choice(np.arange(2, len(TAXONOMIC_LEVELS) + 1), notus,
+                       p=[0.02, 0.03, 0.05, 0.2, 0.5, 0.2])
+    taxonomy = []
+    for g, d in zip(genera, depth):
+        # Parent taxa are derived from the genus so the levels are nested
+        names = ['Bacteria', 'P{}'.format(g // 60), 'C{}'.format(g // 30), 'O{}'.format(g // 15),
+                 'F{}'.format(g // 5), 'G{}'.format(g), 'S{}'.format(g)]
+        taxonomy.append(';'.join(level[0] + '__' + (name if i < d else '')
+                                 for i, (level, name) in enumerate(zip(TAXONOMIC_LEVELS, names))))
+    return taxonomy
+
+
+def sample_reads(rng, weights, nreads):
+    """
+    Draw nreads sequence indices with probability proportional to weights.
+    Returns (unique indices, counts).
+    """
+    reads = rng.choice(len(weights), nreads, p=weights / weights.sum())
+    return np.unique(reads, return_counts=True)
+
+
+def write_dataset(out_dir, dataset, samples, seqs, min_count):
+    """
+    Write a dataset's raw_trimmed fasta, dereplication map and
+    raw_dereplicated fasta.
+
+    Parameters
+    ----------
+    samples : list of (sample_id, seq_indices, counts) tuples
+    seqs : list of str
+
+    Returns
+    -------
+    origs : dict
+        {seq index: (origID, total count)} for the sequences kept in
+        the dereplicated files
+    nreads : int
+    """
+    nreads = 0
+    totals = {}
+    by_seq = {}
+    fasta = os.path.join(out_dir, 'raw_trimmed', dataset + '.raw_trimmed.fasta')
+    with open(fasta, 'w', buffering=1 << 20) as f:
+        for sample, idx, counts in samples:
+            n = 0
+            for i, c in zip(idx.tolist(), counts.tolist()):
+                seq = seqs[i]
+                for _ in range(c):
+                    f.write('>{}_{}\n{}\n'.format(sample, n, seq))
+                    n += 1
+                totals[i] = totals.get(i, 0) + c
+                by_seq.setdefault(i, []).append('{}:{}'.format(sample, c))
+            nreads += n
+
+    # Like derep_engine.py: largest first, IDs from 1, drop rare sequences
+    kept = sorted([i for i in totals if totals[i] >= min_count], key=lambda i: (-totals[i], i))
+    origs = {}
+    derep_dir = os.path.join(out_dir, 'derep_datasets')
+    with open(os.path.join(derep_dir, dataset + '.map'), 'w') as fmap, \
+            open(os.path.join(derep_dir, dataset + '.raw_dereplicated.fasta'), 'w') as fderep:
+        for orig, i in enumerate(kept, 1):
+            origs[i] = (orig, totals[i])
+            fmap.write('{}\t{}\n'.format(orig, ' '.join(by_seq[i])))
+            fderep.write('>{};size={}\n{}\n'.format(orig, totals[i], seqs[i]))
+    return origs, nreads
+
+
+def write_master(out_dir, dataset_origs, seqs, seq_otus):
+    """
+    Write the master dereplication map and fasta (in sequence order, like
+    merge_derep.py) and a usearch clustering_results table.
+
+    Returns
+    -------
+    nseqs : int
+        number of sequences in the master map
+    """
+    members = {}
+    for dataset in sorted(dataset_origs):
+        label = '-'.join(dataset.split('_'))
+        for i, (orig, size) in dataset_origs[dataset].items():
+            members.setdefault(i, []).append(('{}--{};size={}:1'.format(orig, label, size), size))
+
+    prefix = os.path.join(out_dir, 'derep_concat', CLUSTER_PREFIX)
+    master = {}
+    with open(prefix + '.map', 'w', buffering=1 << 20) as fmap, \
+            open(prefix + '.raw_dereplicated.fasta', 'w', buffering=1 << 20) as ffasta:
+        for seqid, i in enumerate(sorted(members, key=lambda i: seqs[i]), 1):
+            total = sum(size for _, size in members[i])
+            master[i] = (seqid, total)
+            fmap.write('{}\t{}\n'.format(seqid, ' '.join(m for m, _ in members[i])))
+            ffasta.write('>{};size={}\n{}\n'.format(seqid, total, seqs[i]))
+
+    # usearch goes through sequences in descending size, and the first
+    # sequence of each OTU becomes its centroid
+    centroids = {}
+    with open(prefix + '.clustering_results.tab', 'w', buffering=1 << 20) as f:
+        for i in sorted(master, key=lambda i: (-master[i][1], master[i][0])):
+            seqid, total = master[i]
+            otu = seq_otus[i]
+            if otu not in centroids:
+                centroids[otu] = seqid
+                f.write('{};size={};\totu\t*\t*\t*\n'.format(seqid, total))
+            else:
+                f.write('{};size={};\tmatch\t99.3\t*\t{}\n'.format(seqid, total, centroids[otu]))
+    return len(master)
+
+
+def write_metadata(rng, out_dir, dataset, sample_ids, ncolumns):
+    """
+    Write a metadata TSV with a few full columns and ncolumns mostly
+    empty ones, plus the clean feather metadata.
+    """
+    n = len(sample_ids)
+    meta = pd.DataFrame(index=pd.Index(sample_ids, name='sample_id'))
+    meta['disease'] = rng.choice(['H', 'CRC', 'IBD', 'OB'], n)
+    meta['age'] = rng.randint(18, 90, n)
+    meta['sex'] = rng.choice(['M', 'F'], n)
+    for c in range(ncolumns):
+        col = pd.Series(rng.choice(['a', 'b', 'c', 'yes', 'no'], n), index=meta.index, dtype=object)
+        col[rng.rand(n) > 0.1] = None
+        meta['{}_field{}'.format(dataset, c)] = col
+    meta.to_csv(os.path.join(out_dir, 'metadata', dataset + '.metadata.txt'), sep='\t')
+    write_feather(meta[['disease', 'age', 'sex']], os.path.join(out_dir, 'clean', dataset + '.metadata.clean.feather'))
+    return meta
+
+
+def write_clean_otu_table(out_dir, dataset, samples, seq_otus, otu_names):
+    """Write the dataset's samples x OTUs counts as a clean feather OTU table."""
+    rows = []
+    for sample, idx, counts in samples:
+        rows.append(pd.Series(np.bincount(seq_otus[idx], weights=counts, minlength=len(otu_names)),
+                              index=otu_names, name=sample))
+    df = pd.DataFrame(rows)
+    df = df.loc[:, (df > 0).any()]
+    write_feather(df, os.path.join(out_dir, 'clean', dataset + '.otu_table.clean.feather'))
+    return df.shape
+
+
+def generate(out_dir, scale=1, seed=0, **params):
+    """
+    Write all the synthetic inputs for one scale to out_dir.
+
+    Parameters
+    ----------
+    out_dir : str
+    scale : int
+        number of samples and unique sequences, relative to DEFAULTS
+    seed : int
+        random seed. The same scale and seed always give the same files.
+    params
+        override DEFAULTS (sizes at scale 1)
+
+    Returns
+    -------
+    manifest : dict
+        file locations and record counts, also written to out_dir/manifest.json
+    """
+    p = dict(DEFAULTS)
+    p.update(params)
+    rng = np.random.RandomState(seed)
+    for d in ['raw_trimmed', 'derep_datasets', 'derep_concat', 'metadata', 'clean']:
+        if not os.path.isdir(os.path.join(out_dir, d)):
+            os.makedirs(os.path.join(out_dir, d))
+
+    notus = p['otus'] * scale
+    seqs, seq_otus = make_sequences(rng, notus, p['variants'], p['length'])
+    taxonomy = make_taxonomy(rng, notus)
+    otu_names = ['{};d__denovo{}'.format(t, i) for i, t in enumerate(taxonomy)]
+    base_weights = rng.lognormal(0, 2, len(seqs))
+
+    datasets = ['dataset_{}'.format(chr(ord('a') + i)) for i in range(p['datasets'])]
+    dataset_origs = {}
+    nreads = 0
+    nsamples = 0
+    nmap_lines = 0
+    for dataset in datasets:
+        # Each dataset sees about 60% of the sequences, at its own abundances
+        present = rng.rand(len(seqs)) < 0.6
+        weights = base_weights * present * rng.lognormal(0, 0.5, len(seqs))
+        sample_ids = ['S{}'.format(j) for j in range(p['samples'] * scale)]
+        samples = [(s,) + sample_reads(rng, weights, p['reads']) for s in sample_ids]
+
+        origs, n = write_dataset(out_dir, dataset, samples, seqs, p['min_count'])
+        dataset_origs[dataset] = origs
+        nreads += n
+        nsamples += len(samples)
+        nmap_lines += len(origs)
+        write_metadata(rng, out_dir, dataset, sample_ids, p['metadata_columns'])
+        write_clean_otu_table(out_dir, dataset, samples, seq_otus, otu_names)
+
+    nmaster = write_master(out_dir, dataset_origs, seqs, seq_otus)
+
+    prefix = os.path.join('derep_concat', CLUSTER_PREFIX)
+    manifest = {
+        'scale': scale, 'seed': seed, 'params': p, 'datasets': datasets,
+        'records': {'reads': nreads, 'samples': nsamples, 'dataset_map_lines': nmap_lines,
+                    'master_map_lines': nmaster, 'otus': notus},
+        'files': {'raw_trimmed_dir': 'raw_trimmed', 'derep_dir': 'derep_datasets',
+                  'metadata_dir': 'metadata', 'clean_dir': 'clean',
+                  'master_map': prefix + '.map',
+                  'master_fasta': prefix + '.raw_dereplicated.fasta',
+                  'clustering_results': prefix + '.clustering_results.tab'},
+    }
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('out_dir', help='directory to write the synthetic data to')
+    parser.add_argument('-s', '--scale', help='size relative to the default (1) dataset', type=int, default=1)
+    parser.add_argument('--seed', help='random seed (default: 0)', type=int, default=0)
+    args = parser.parse_args()
+
+    manifest = generate(args.out_dir, args.scale, args.seed)
+    print(json.dumps(manifest['records'], sort_keys=True))
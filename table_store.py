@@ -0,0 +1,498 @@
+"""
+Chunked on-disk OTU table store, for reading some samples or some OTUs
+of the combined table without parsing all of it.
+
+A store is a directory with the table in both layouts, split into chunks
+of chunksize rows (CSR) or columns (CSC), each chunk as .npy files:
+
+    store.json              shape, chunksize, nnz, dtype, generations
+    sample_ids.txt          row labels (dataset--sample), one per line
+    otu_ids.txt             column labels, one per line
+    rows/000000.indptr.npy  CSR chunks: rows 0 .. chunksize-1, with
+    rows/000000.indices.npy     OTU (column) indices
+    rows/000000.data.npy
+    cols/000000.*.npy       CSC chunks: OTUs 0 .. chunksize-1, with
+                                sample (row) indices
+
+Chunks are memory-mapped when a query first needs them, and only the
+parts of them holding the requested rows or columns get read.
+
+append_rows never changes a file in place: the chunks and ID lists it
+rewrites get new names with the store's next generation number (e.g.
+rows/000003.g2.indptr.npy, sample_ids.g2.txt), and store.json, which
+lists the generation of each file, is replaced last. So readers see
+either the old table or the new one, and an interrupted append leaves
+the store as it was.
+
+    store = TableStore('v4_datasets.otu_table.store')
+    # All samples from two datasets, all OTUs (as CSR)
+    table, sample_ids, otu_ids = store.samples(['crc_baxter--', 'ibd_gevers--'])
+    # Three OTUs, in every sample (as CSC)
+    table, sample_ids, otu_ids = store.otus(['4', '11', '20'])
+
+From the command line, convert a TSV (or npz) OTU table into a store:
+
+    python table_store.py convert v4_datasets.otu_table.txt v4_datasets.otu_table.store
+
+and write part of one to a TSV:
+
+    python table_store.py query v4_datasets.otu_table.store out.txt -s crc_baxter-- -o 4 11
+"""
+import os
+import json
+import shutil
+import argparse
+from bisect import bisect_left
+
+import numpy as np
+import scipy.sparse as sp
+
+from otu_table import read_npz_table, read_tsv_table, write_tsv_table
+
+FORMAT_VERSION = 2
+
+
+def _write_ids(fname, ids):
+    with open(fname, 'w') as f:
+        for i in ids:
+            f.write(str(i) + '\n')
+
+
+def _read_ids(fname):
+    with open(fname, 'r') as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def _chunk_prefix(path, layout, n, gen=0):
+    name = '{:06d}'.format(n) if gen == 0 else '{:06d}.g{}'.format(n, gen)
+    return os.path.join(path, layout, name)
+
+
+def _ids_file(path, kind, gen=0):
+    """sample_ids.txt or otu_ids.txt of generation gen"""
+    return os.path.join(path, kind + '_ids.txt' if gen == 0 else '{}_ids.g{}.txt'.format(kind, gen))
+
+
+def _read_meta(path):
+    """store.json, with generation numbers filled in for version 1 stores."""
+    with open(os.path.join(path, 'store.json'), 'r') as f:
+        meta = json.load(f)
+    if meta['version'] not in (1, FORMAT_VERSION):
+        raise ValueError('{}: unsupported store version {}'.format(path, meta['version']))
+    meta.setdefault('generation', 0)
+    for kind in ('sample', 'otu'):
+        meta.setdefault(kind + '_ids_gen', 0)
+    for layout in ('row', 'col'):
+        meta.setdefault(layout + '_gens', [0] * meta[layout + '_chunks'])
+    return meta
+
+
+def _meta_files(path, meta):
+    """Every file the store in meta is made of."""
+    files = {os.path.join(path, 'store.json'), _ids_file(path, 'sample', meta['sample_ids_gen']),
+             _ids_file(path, 'otu', meta['otu_ids_gen'])}
+    for layout in ('rows', 'cols'):
+        for n, gen in enumerate(meta[layout[:-1] + '_gens']):
+            prefix = _chunk_prefix(path, layout, n, gen)
+            files.update(prefix + '.' + part + '.npy' for part in ('indptr', 'indices', 'data'))
+    return files
+
+
+def _save_chunk(prefix, chunk, dtype):
+    np.save(prefix + '.indptr.npy', chunk.indptr.astype(np.int64))
+    np.save(prefix + '.indices.npy', chunk.indices.astype(np.int32))
+    np.save(prefix + '.data.npy', chunk.data.astype(dtype))
+
+
+def _load_chunk(prefix, mmap_mode=None):
+    return tuple(np.load(prefix + '.' + part + '.npy', mmap_mode=mmap_mode)
+                 for part in ('indptr', 'indices', 'data'))
+
+
+def _write_chunks(chunk_dir, table, chunksize, dtype):
+    """Write a CSR table's rows (or a CSC table's columns) chunksize at a time."""
+    os.makedirs(chunk_dir)
+    csr = sp.isspmatrix_csr(table)
+    n = table.shape[0] if csr else table.shape[1]
+    nchunks = 0
+    # An empty table still gets one (empty) chunk
+    for start in range(0, max(n, 1), chunksize):
+        chunk = table[start:start + chunksize] if csr else table[:, start:start + chunksize]
+        _save_chunk(os.path.join(chunk_dir, '{:06d}'.format(nchunks)), chunk, dtype)
+        nchunks += 1
+    return nchunks
+
+
+def write_store(path, table, sample_ids, otu_ids, chunksize=4096):
+    """
+    Write a table to a store directory, replacing any store already there.
+
+    Parameters
+    ----------
+    path : str
+        store directory
+    table : scipy.sparse matrix
+        samples in rows, OTUs in columns
+    sample_ids, otu_ids : list
+        row and column labels
+    chunksize : int
+        rows or columns per chunk
+    """
+    table = sp.csr_matrix(table)
+    table.sum_duplicates()
+    # Counts are stored as integers unless there are fractional ones
+    dtype = np.int64 if np.all(np.mod(table.data, 1) == 0) else np.float64
+
+    tmp = path.rstrip(os.sep) + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    _write_ids(os.path.join(tmp, 'sample_ids.txt'), sample_ids)
+    _write_ids(os.path.join(tmp, 'otu_ids.txt'), otu_ids)
+    row_chunks = _write_chunks(os.path.join(tmp, 'rows'), table, chunksize, dtype)
+    col_chunks = _write_chunks(os.path.join(tmp, 'cols'), table.tocsc(), chunksize, dtype)
+    meta = {'version': FORMAT_VERSION, 'shape': list(table.shape), 'nnz': int(table.nnz),
+            'chunksize': chunksize, 'dtype': np.dtype(dtype).name,
+            'row_chunks': row_chunks, 'col_chunks': col_chunks, 'generation': 0,
+            'sample_ids_gen': 0, 'otu_ids_gen': 0,
+            'row_gens': [0] * row_chunks, 'col_gens': [0] * col_chunks}
+    with open(os.path.join(tmp, 'store.json'), 'w') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+
+def convert(table_file, path, chunksize=4096):
+    """
+    Write a TSV (or .npz) OTU table file to a store. Returns the
+    table's shape.
+    """
+    if table_file.endswith('.npz'):
+        table, sample_ids, otu_ids = read_npz_table(table_file)
+    else:
+        table, sample_ids, otu_ids = read_tsv_table(table_file)
+    write_store(path, table, sample_ids, otu_ids, chunksize)
+    return table.shape
+
+
+def append_rows(path, table, sample_ids, otu_ids):
+    """
+    Add samples (e.g. a new dataset) to a store, adding columns for any
+    OTUs it doesn't have yet.
+
+    Only the last row chunk, the column chunks of OTUs the new samples
+    have counts for, and the chunks of new OTUs are rewritten, so the
+    cost depends on the new samples rather than on the whole table
+    (plus copying the ID lists). They're written under the next
+    generation's names and committed by replacing store.json; files
+    the previous generation had already replaced are removed then.
+
+    Parameters
+    ----------
+    path : str
+        store directory
+    table : scipy.sparse matrix
+        new samples in rows, OTUs in columns
+    sample_ids, otu_ids : list
+        row and column labels of table (an OTU listed more than once
+        gets the sum of its columns)
+
+    Returns
+    -------
+    new_otus : list
+        OTU IDs that were added to the store
+    """
+    meta = _read_meta(path)
+    store_samples = _read_ids(_ids_file(path, 'sample', meta['sample_ids_gen']))
+    store_otus = _read_ids(_ids_file(path, 'otu', meta['otu_ids_gen']))
+    already = set(store_samples).intersection(sample_ids)
+    if already:
+        raise ValueError('{} already has samples {}'.format(path, ', '.join(sorted(already)[:10])))
+
+    table = sp.csr_matrix(table)
+    table.sum_duplicates()
+    dtype = np.dtype(meta['dtype'])
+    if dtype.kind == 'i' and not np.all(np.mod(table.data, 1) == 0):
+        raise ValueError('{} holds whole-number counts'.format(path))
+
+    # Map the table's columns to store columns, adding new OTUs at the end
+    otu_index = {o: i for i, o in enumerate(store_otus)}
+    new_otus = []
+    cols = np.empty(len(otu_ids), dtype=np.int64)
+    for i, otu in enumerate(otu_ids):
+        if otu not in otu_index:
+            otu_index[otu] = len(store_otus) + len(new_otus)
+            new_otus.append(otu)
+        cols[i] = otu_index[otu]
+
+    nrows, ncols = meta['shape']
+    chunksize = meta['chunksize']
+    gen = meta['generation'] + 1
+    gens = {'rows': list(meta['row_gens']), 'cols': list(meta['col_gens'])}
+    total_rows = nrows + table.shape[0]
+    total_cols = ncols + len(new_otus)
+    new = sp.csr_matrix((table.data, cols[table.indices], table.indptr),
+                        shape=(table.shape[0], total_cols))
+    # Columns of an OTU listed twice in otu_ids are summed
+    new.sum_duplicates()
+    # New rows as they'll be numbered in the store
+    new_rows = sp.vstack([sp.csr_matrix((nrows, total_cols), dtype=new.dtype), new], format='csr')
+
+    def merge(layout, n, nchunks, old_size, total_size):
+        start = n * chunksize
+        end = min(start + chunksize, total_size)
+        if layout == 'rows':
+            part = new_rows[start:end]
+            shape = (min(end, old_size) - start, total_cols)
+        else:
+            part = new_rows[:, start:end].tocsc()
+            shape = (nrows, end - start)
+        if n < nchunks and shape[0] > 0 and shape[1] > 0:
+            indptr, indices, data = _load_chunk(_chunk_prefix(path, layout, n, gens[layout][n]))
+            # Old chunks just get wider (rows) or taller (cols)
+            if layout == 'rows':
+                old = sp.csr_matrix((data, indices, indptr[:shape[0] + 1]), shape=shape)
+                part = sp.vstack([old, part[shape[0]:]], format='csr')
+            else:
+                indptr = np.concatenate([indptr, np.repeat(indptr[-1:], shape[1] + 1 - len(indptr))])
+                old = sp.csc_matrix((data, indices, indptr), shape=(total_rows, shape[1]))
+                part = (old + part).tocsc()
+        _save_chunk(_chunk_prefix(path, layout, n, gen), part, dtype)
+        if n < len(gens[layout]):
+            gens[layout][n] = gen
+        else:
+            gens[layout].append(gen)
+
+    # Row chunks from the last one on
+    row_chunks = max(-(-total_rows // chunksize), 1)
+    for n in range(meta['row_chunks'] - 1, row_chunks):
+        merge('rows', n, meta['row_chunks'], nrows, total_rows)
+
+    # Column chunks with new counts, and any for new OTUs
+    col_chunks = max(-(-total_cols // chunksize), 1)
+    touched = set((cols[np.unique(table.indices)] // chunksize).tolist())
+    if new_otus:
+        touched.update(range(meta['col_chunks'] - 1, col_chunks))
+    for n in sorted(touched):
+        merge('cols', n, meta['col_chunks'], ncols, total_cols)
+
+    _write_ids(_ids_file(path, 'sample', gen), store_samples + [str(s) for s in sample_ids])
+    otus_gen = meta['otu_ids_gen']
+    if new_otus:
+        _write_ids(_ids_file(path, 'otu', gen), store_otus + [str(o) for o in new_otus])
+        otus_gen = gen
+
+    # Nothing readers see has changed until store.json is replaced
+    old_files = _meta_files(path, meta)
+    new_meta = dict(meta, version=FORMAT_VERSION, shape=[total_rows, total_cols],
+                    nnz=meta['nnz'] + int(new.nnz), row_chunks=row_chunks, col_chunks=col_chunks,
+                    generation=gen, sample_ids_gen=gen, otu_ids_gen=otus_gen,
+                    row_gens=gens['rows'], col_gens=gens['cols'])
+    tmp = os.path.join(path, 'store.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(new_meta, f, indent=2, sort_keys=True)
+    os.rename(tmp, os.path.join(path, 'store.json'))
+
+    # Readers that opened the previous generation may still need its files;
+    # anything older (or left by an interrupted append) can go
+    keep = old_files | _meta_files(path, new_meta)
+    candidates = [os.path.join(path, f) for f in os.listdir(path) if f.startswith(('sample_ids', 'otu_ids'))]
+    for layout in ('rows', 'cols'):
+        candidates.extend(os.path.join(path, layout, f) for f in os.listdir(os.path.join(path, layout)))
+    for fname in candidates:
+        if fname not in keep:
+            os.remove(fname)
+    return new_otus
+
+
+class TableStore(object):
+    """
+    A table store written by write_store, opened for queries.
+
+    Parameters
+    ----------
+    path : str
+        store directory
+
+    Attributes
+    ----------
+    shape : tuple
+        (samples, OTUs)
+    sample_ids, otu_ids : list
+        row and column labels
+    sample_index, otu_index : dict
+        {label: row or column number}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = _read_meta(path)
+        self.shape = tuple(self.meta['shape'])
+        self.chunksize = self.meta['chunksize']
+        self.sample_ids = _read_ids(_ids_file(path, 'sample', self.meta['sample_ids_gen']))
+        self.otu_ids = _read_ids(_ids_file(path, 'otu', self.meta['otu_ids_gen']))
+        self.sample_index = {s: i for i, s in enumerate(self.sample_ids)}
+        self.otu_index = {o: i for i, o in enumerate(self.otu_ids)}
+        # Sample IDs in sorted order, for prefix lookups
+        self._sorted_samples = sorted(zip(self.sample_ids, range(len(self.sample_ids))))
+        self._sorted_names = [s for s, _ in self._sorted_samples]
+        self._chunks = {}
+
+    def __repr__(self):
+        return '<TableStore {}: {} samples x {} OTUs, {} nonzero>'.format(
+            self.path, self.shape[0], self.shape[1], self.meta['nnz'])
+
+    def _chunk(self, layout, n):
+        """(indptr, indices, data) of chunk n of 'rows' or 'cols', memory-mapped."""
+        try:
+            return self._chunks[layout, n]
+        except KeyError:
+            gens = self.meta['row_gens' if layout == 'rows' else 'col_gens']
+            arrays = _load_chunk(_chunk_prefix(self.path, layout, n, gens[n]), mmap_mode='r')
+            self._chunks[layout, n] = arrays
+            return arrays
+
+    def _take(self, layout, idx):
+        """
+        Gather rows (or columns) idx, which must be sorted, from their
+        chunks. Returns (indptr, indices, data) of the selection.
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        indptrs = [np.zeros(1, dtype=np.int64)]
+        indices = []
+        data = []
+        offset = 0
+        chunk_of = idx // self.chunksize
+        for n in np.unique(chunk_of).tolist():
+            local = idx[chunk_of == n] - n * self.chunksize
+            c_indptr, c_indices, c_data = self._chunk(layout, n)
+            starts = c_indptr[local]
+            lengths = c_indptr[local + 1] - starts
+            ptr = np.cumsum(lengths)
+            # Position in the chunk of each entry of the selected rows
+            pos = np.repeat(starts - (ptr - lengths), lengths) + np.arange(ptr[-1] if len(ptr) else 0)
+            indptrs.append(ptr + offset)
+            indices.append(np.asarray(c_indices[pos]))
+            data.append(np.asarray(c_data[pos]))
+            offset += int(ptr[-1]) if len(ptr) else 0
+        dtype = np.dtype(self.meta['dtype'])
+        return (np.concatenate(indptrs),
+                np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32),
+                np.concatenate(data) if data else np.zeros(0, dtype=dtype))
+
+    def sample_rows(self, prefixes):
+        """
+        Row numbers of the samples whose IDs start with any of prefixes
+        (e.g. 'crc_baxter--' for a whole dataset, or a full sample ID),
+        in row order.
+        """
+        if isinstance(prefixes, str):
+            prefixes = [prefixes]
+        rows = set()
+        for prefix in prefixes:
+            i = bisect_left(self._sorted_names, prefix)
+            while i < len(self._sorted_names) and self._sorted_names[i].startswith(prefix):
+                rows.add(self._sorted_samples[i][1])
+                i += 1
+        return sorted(rows)
+
+    def otu_cols(self, otus):
+        """Column numbers of otus, in the order given."""
+        missing = [o for o in otus if o not in self.otu_index]
+        if missing:
+            raise KeyError('OTUs not in {}: {}'.format(self.path, ', '.join(missing)))
+        return [self.otu_index[o] for o in otus]
+
+    def rows(self, rows):
+        """CSR matrix of the given rows (all OTUs), in the order given."""
+        rows = np.asarray(rows, dtype=np.int64)
+        order = np.argsort(rows, kind='stable')
+        indptr, indices, data = self._take('rows', rows[order])
+        table = sp.csr_matrix((data, indices, indptr), shape=(len(rows), self.shape[1]))
+        if np.any(order != np.arange(len(order))):
+            table = table[np.argsort(order)]
+        return table
+
+    def cols(self, cols):
+        """CSC matrix of the given columns (all samples), in the order given."""
+        cols = np.asarray(cols, dtype=np.int64)
+        order = np.argsort(cols, kind='stable')
+        indptr, indices, data = self._take('cols', cols[order])
+        table = sp.csc_matrix((data, indices, indptr), shape=(self.shape[0], len(cols)))
+        if np.any(order != np.arange(len(order))):
+            table = table[:, np.argsort(order)]
+        return table
+
+    def samples(self, prefixes, otus=None):
+        """
+        Samples whose IDs start with any of prefixes, optionally only
+        for the given OTUs.
+
+        Returns
+        -------
+        table : scipy.sparse.csr_matrix
+            samples in rows, OTUs in columns
+        sample_ids, otu_ids : list
+            row and column labels
+        """
+        rows = self.sample_rows(prefixes)
+        table = self.rows(rows)
+        otu_ids = self.otu_ids
+        if otus is not None:
+            table = table[:, self.otu_cols(otus)]
+            otu_ids = list(otus)
+        return table, [self.sample_ids[i] for i in rows], list(otu_ids)
+
+    def otus(self, otus, prefixes=None):
+        """
+        The given OTUs, in all samples or only in those whose IDs start
+        with any of prefixes.
+
+        Returns
+        -------
+        table : scipy.sparse.csc_matrix
+            samples in rows, OTUs in columns
+        sample_ids, otu_ids : list
+            row and column labels
+        """
+        table = self.cols(self.otu_cols(otus))
+        sample_ids = self.sample_ids
+        if prefixes is not None:
+            rows = self.sample_rows(prefixes)
+            table = table[rows]
+            sample_ids = [self.sample_ids[i] for i in rows]
+        return table, list(sample_ids), list(otus)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('convert', help='write a TSV or npz OTU table to a store')
+    p.add_argument('table_file', help='OTU table (samples in rows), .txt or .npz')
+    p.add_argument('store', help='store directory to write')
+    p.add_argument('--chunksize', help='rows or columns per chunk (default: 4096)', type=int, default=4096)
+
+    p = subparsers.add_parser('query', help='write some samples and/or OTUs of a store to a TSV')
+    p.add_argument('store', help='store directory')
+    p.add_argument('table_out', help='TSV file to write')
+    p.add_argument('-s', help='sample ID prefixes (e.g. dataset--)', nargs='+', default=None)
+    p.add_argument('-o', help='OTU IDs', nargs='+', default=None)
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        shape = convert(args.table_file, args.store, args.chunksize)
+        print('Wrote {} samples x {} OTUs to {}'.format(shape[0], shape[1], args.store))
+    elif args.command == 'query':
+        store = TableStore(args.store)
+        if args.s is not None:
+            table, sample_ids, otu_ids = store.samples(args.s, args.o)
+        elif args.o is not None:
+            table, sample_ids, otu_ids = store.otus(args.o)
+        else:
+            parser.error('give sample prefixes (-s) and/or OTU IDs (-o)')
+        write_tsv_table(args.table_out, table, sample_ids, otu_ids)
+    else:
+        parser.print_help()
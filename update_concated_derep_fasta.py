@@ -4,46 +4,211 @@ to the concatenated dataset (i.e. "samples" in this map
 are actually original sequences from individual datasets)
 and a corresponding raw_dereplicated fasta and updates
 the fasta with the correct sizes.
-"""
 
+Sequences are written in descending size. The fasta is sorted
+with an external merge sort: records are buffered until they
+reach the memory budget (-m), then sorted and spilled to a
+temporary run file, and the runs are merged as they're written
+out. So peak memory is set by -m rather than by the total size
+of the sequences. Buffered sequences are packed 2 bits per base
+(see seqpack.SeqStore), so about four times as many fit in a run.
+
+With --indexed, the fasta is instead indexed (see fasta_index.py) and
+each record is copied from the memory-mapped file in size order, so
+only the sizes and the index are held in memory. That reads the fasta
+in random order, so it's only faster when the file fits in the page
+cache (or is on an SSD).
+
+With --metrics, each step's time, throughput and memory use are
+logged as JSON lines (see instrument.py).
+"""
+import os
+import heapq
+import shutil
 import argparse
-import util
-
-parser = argparse.ArgumentParser()
-parser.add_argument('map_file', help='dereplication map (seqID    sample:count sample2:count)')
-parser.add_argument('fasta_in', help='raw_dereplicated fasta corresponding to map')
-parser.add_argument('fasta_out', help='relabled fasta file')
-args = parser.parse_args()
-
-## Parse the dereplication map and get total size per sequence
-print('Parsing dereplication map: {}'.format(args.map_file))
-seq_sizes = {}
-
-with open(args.map_file, 'r') as f:
-    lines = f.readlines()
-
-for line in lines:
-    line = line.strip().split('\t')
-    seqID = line[0]
-    total_size = sum([int(i.split('size=')[1].split(':1')[0]) for i in line[1].split(' ')])
-    seq_sizes[seqID] = total_size
-
-## Read in the entire fasta file into a dict {seqID: sequence}
-print('Reading fasta file: {}'.format(args.fasta_in))
-fasta = {}
-for sid, seq in util.iter_fst(args.fasta_in):
-    # sid in the fasta is something like >444;size=8
-    # sid.split(';')[0][1:] returns 444, which is a key in seq_sizes
-    sid = sid.split(';')[0][1:]
-    newsid = '>' + sid + ';size=' + str(seq_sizes[sid])
-    fasta[sid] = {}
-    fasta[sid]['new_sid'] = newsid
-    fasta[sid]['seq'] = seq
-
-## Get list of sequence IDs in descending size (i.e. largest first)
-ordered_seqs = sorted(seq_sizes, key=lambda k: seq_sizes[k], reverse=True)
-
-## Write new fasta file in descending size
-print('Writing sorted and relabled fasta: {}'.format(args.fasta_out))
-with open(args.fasta_out, 'w') as f:
-    f.write('\n'.join([fasta[s]['new_sid'] + '\n' + fasta[s]['seq'] for s in ordered_seqs]))
+import tempfile
+from array import array
+
+import numpy as np
+
+import instrument
+from seqpack import SeqStore
+from fasta_io import iter_fasta
+from fasta_index import FastaIndex, record_id
+
+# Rough per-record overhead of a buffered record's sid str and offsets, in bytes
+RECORD_OVERHEAD = 80
+
+
+def parse_sizes(map_file):
+    """
+    Parse the dereplication map and get total size per sequence.
+
+    Parameters
+    ----------
+    map_file : str
+        dereplication map with lines like
+        seqID    origID--dataset;size=123:1 origID--dataset2;size=12:1
+
+    Returns
+    -------
+    seq_sizes : dict
+        {seqID: total_size}
+    """
+    seq_sizes = {}
+    with open(map_file, 'r') as f:
+        for line in f:
+            line = line.strip().split('\t')
+            seqID = line[0]
+            total_size = sum([int(i.split('size=')[1].split(':1')[0]) for i in line[1].split(' ')])
+            seq_sizes[seqID] = total_size
+    return seq_sizes
+
+
+def relabeled_records(fasta_in, seq_sizes):
+    """
+    Yield (size, new_sid, seq) for each record in fasta_in.
+    """
+    for sid, seq in iter_fasta(fasta_in):
+        # sid in the fasta is something like >444;size=8
+        # sid.split(';')[0][1:] returns 444, which is a key in seq_sizes
+        sid = sid.split(';')[0][1:]
+        yield seq_sizes[sid], '>' + sid + ';size=' + str(seq_sizes[sid]), seq
+
+
+def _buffered_records(sizes, sids, seqs):
+    """Yield the buffered (size, sid, seq) records in descending size, stably."""
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        yield sizes[i], sids[i], seqs[i]
+
+
+def _write_run(records, fname):
+    with open(fname, 'w', buffering=1 << 20) as f:
+        for size, sid, seq in records:
+            f.write(str(size) + '\t' + sid + '\t' + seq + '\n')
+
+
+def _read_run(fname):
+    with open(fname, 'r', buffering=1 << 20) as f:
+        for line in f:
+            size, sid, seq = line.rstrip('\n').split('\t')
+            yield int(size), sid, seq
+
+
+def sorted_by_size(records, max_mem, tmp_dir):
+    """
+    Yield records in descending size, holding at most about max_mem
+    bytes of records in memory. Ties keep their input order.
+
+    Parameters
+    ----------
+    records : iterable
+        (size, new_sid, seq) tuples
+    max_mem : int
+        memory budget for buffered records, in bytes
+    tmp_dir : str
+        directory for spilled runs
+    """
+    runs = []
+    sizes, sids, seqs = array('q'), [], SeqStore()
+    buf_bytes = 0
+    for size, sid, seq in records:
+        sizes.append(size)
+        sids.append(sid)
+        seqs.append(seq)
+        buf_bytes += len(sid) + (len(seq) + 3) // 4 + RECORD_OVERHEAD
+        if buf_bytes >= max_mem:
+            runs.append(os.path.join(tmp_dir, 'run{}.txt'.format(len(runs))))
+            _write_run(_buffered_records(sizes, sids, seqs), runs[-1])
+            sizes, sids, seqs = array('q'), [], SeqStore()
+            buf_bytes = 0
+    buf = _buffered_records(sizes, sids, seqs)
+
+    if not runs:
+        for record in buf:
+            yield record
+        return
+
+    # heapq.merge takes from earlier runs first on ties, so input order is kept
+    for record in heapq.merge(*([_read_run(r) for r in runs] + [buf]), key=lambda r: -r[0]):
+        yield record
+
+
+def write_sorted_fasta(map_file, fasta_in, fasta_out, max_mem=1 << 30, tmp_dir=None):
+    """
+    Write fasta_in to fasta_out relabeled with the sizes in map_file,
+    in descending size, with an external merge sort. Ties keep their
+    order in fasta_in.
+    """
+    print('Parsing dereplication map: {}'.format(map_file))
+    with instrument.stage('parse_sizes', inputs=[map_file]) as s:
+        seq_sizes = parse_sizes(map_file)
+        s.records = len(seq_sizes)
+
+    print('Sorting fasta file: {}'.format(fasta_in))
+    tmp = tempfile.mkdtemp(dir=tmp_dir or os.path.dirname(os.path.abspath(fasta_out)),
+                           prefix='.sort_tmp.')
+    try:
+        # Runs are spilled while records are read, and merged while they're written
+        with instrument.stage('sort_and_write', inputs=[fasta_in], outputs=[fasta_out]) as s:
+            records = sorted_by_size(relabeled_records(fasta_in, seq_sizes), max_mem, tmp)
+            print('Writing sorted and relabled fasta: {}'.format(fasta_out))
+            nrecords = 0
+            with open(fasta_out, 'w', buffering=1 << 20) as f:
+                for size, sid, seq in records:
+                    f.write(sid + '\n' + seq + '\n')
+                    nrecords += 1
+            s.records = nrecords
+    finally:
+        shutil.rmtree(tmp)
+
+
+def write_sorted_fasta_indexed(map_file, fasta_in, fasta_out):
+    """
+    Same as write_sorted_fasta, but copies each record from an index of
+    fasta_in (see fasta_index.py) in size order instead of sorting them.
+    """
+    print('Parsing dereplication map: {}'.format(map_file))
+    with instrument.stage('parse_sizes', inputs=[map_file]) as s:
+        seq_sizes = parse_sizes(map_file)
+        s.records = len(seq_sizes)
+
+    print('Indexing fasta file: {}'.format(fasta_in))
+    with instrument.stage('index_fasta', inputs=[fasta_in]) as s:
+        index = FastaIndex(fasta_in)
+        s.records = len(index)
+
+    with index:
+        # sid in the fasta is something like 444;size=8, and its ID 444 is a key in seq_sizes
+        ids = [record_id(name) for name in index.names]
+        sizes = np.array([seq_sizes[i] for i in ids], dtype=np.int64)
+        del seq_sizes
+        order = np.argsort(-sizes, kind='stable')
+
+        print('Writing sorted and relabled fasta: {}'.format(fasta_out))
+        with instrument.stage('write_sorted', inputs=[fasta_in], outputs=[fasta_out], records=len(order)), \
+                open(fasta_out, 'wb', buffering=1 << 20) as f:
+            for i in order.tolist():
+                index.write_record(i, f, ids[i] + ';size=' + str(sizes[i]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('map_file', help='dereplication map (seqID    sample:count sample2:count)')
+    parser.add_argument('fasta_in', help='raw_dereplicated fasta corresponding to map')
+    parser.add_argument('fasta_out', help='relabled fasta file')
+    parser.add_argument('-m', help='memory budget for sorting sequences, in MB (default: 1024)',
+                        type=int, default=1024)
+    parser.add_argument('--tmp_dir', help='directory for temporary sorted runs (default: next to fasta_out)',
+                        default=None)
+    parser.add_argument('--indexed', help='copy records in size order from an index of fasta_in '
+                        + 'instead of sorting them (random reads; for fastas that fit in the page cache)',
+                        action='store_true', default=False)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.configure_from_args(args)
+
+    if args.indexed:
+        write_sorted_fasta_indexed(args.map_file, args.fasta_in, args.fasta_out)
+    else:
+        write_sorted_fasta(args.map_file, args.fasta_in, args.fasta_out,
+                           max_mem=args.m * (1 << 20), tmp_dir=args.tmp_dir)